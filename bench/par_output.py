@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Check that sparks run in worker processes do not change the output.
+
+Runs every program given on the command line (default: the programs in
+test_programs that call par) with and without worker processes and
+compares what they print on stdout. The exit status is 1 if any differ.
+
+By default the programs run untranslated through targetrunspj.py; with
+--binary they are run by a translated runspj instead.
+
+usage: par_output.py [--binary RUNSPJ] [--workers N] [PROGRAM ...]
+
+Needs the PyPy source tree on PYTHONPATH, like targetrunspj.py.
+"""
+
+import glob
+import os
+import re
+import subprocess
+import sys
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def run(command, source):
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(source)
+    return out
+
+def uses_par(path):
+    return re.search(r'\bpar\b', open(path).read()) is not None
+
+def main(argv):
+    command = [sys.executable, os.path.join(TOP, 'targetrunspj.py')]
+    nworkers = 2
+    paths = []
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '--binary':
+            i += 1
+            command = [argv[i]]
+        elif arg == '--workers':
+            i += 1
+            nworkers = int(argv[i])
+        elif arg.startswith('-'):
+            print __doc__
+            return 2
+        else:
+            paths.append(arg)
+        i += 1
+    if not paths:
+        paths = [path for path in
+                 sorted(glob.glob(os.path.join(TOP, 'test_programs', '*.hs')))
+                 if uses_par(path)]
+
+    status = 0
+    for path in paths:
+        source = open(path).read()
+        sequential = run(command, source)
+        parallel = run(command + ['--workers', str(nworkers)], source)
+        if sequential == parallel:
+            print '%-28s same output' % os.path.basename(path)
+        else:
+            print '%-28s DIFFERENT: %r with workers, %r without' % (
+                os.path.basename(path), parallel, sequential)
+            status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Compare the throughput of the packrat and the hand-written parser.
+
+Generates a program of N supercombinators (default 2000) using every
+construct of the language, mixed operators without parentheses
+included, parses it with both parsers untranslated, checks that they
+build the same AST and prints definitions and kilobytes parsed per
+second.
+
+usage: parse_bench.py [N] [--hand-only]
+
+Needs the PyPy source tree on PYTHONPATH, like targetrunspj.py.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from spj import parser, handparser
+from spj.language import PrettyPrinter
+
+TEMPLATES = [
+    'f%(i)d x y = (x + (y * %(i)d)) - (f%(j)d y x);',
+    'g%(i)d xs = case xs of\n'
+    '  <1> -> %(i)d;\n'
+    '  <2> y ys -> y + (g%(j)d ys);;',
+    'h%(i)d n = let a = n + 1;\n'
+    '              b = a * a;\n'
+    '          in if (a < b) (Pack{2, 2} a b) Pack{1, 0};',
+    'k%(i)d f = letrec xs = Pack{2, 2} %(i)d xs; in f (\\x y -> x) xs;',
+    'p%(i)d = (+) %(i)d ((-) 2 3);',
+    # Unparenthesised: one precedence level, left to right.
+    'q%(i)d x y = x + y * %(i)d - x / 2 == y && x < %(i)d;',
+    'r%(i)d x = f%(j)d x 1 + f%(j)d x 2 * r%(j)d %(i)d;',
+]
+
+def gen_program(n):
+    defs = []
+    for i in xrange(n):
+        template = TEMPLATES[i % len(TEMPLATES)]
+        defs.append(template % {'i': i, 'j': max(i - len(TEMPLATES), 0)})
+    defs.append('main = 0;')
+    return '\n\n'.join(defs) + '\n'
+
+class StringStream(object):
+    def __init__(self):
+        self.buf = []
+
+    def write(self, s):
+        self.buf.append(s)
+
+    def getvalue(self):
+        return ''.join(self.buf)
+
+def show(ast):
+    out = StringStream()
+    p = PrettyPrinter(out)
+    for sc in ast:
+        p.write(sc)
+    return out.getvalue()
+
+def bench(name, read_program, source, ndefs):
+    start = time.time()
+    ast = read_program(source)
+    elapsed = time.time() - start
+    print '%-8s %8.3fs  %9.0f defs/s  %8.1f KB/s' % (
+        name, elapsed, ndefs / elapsed, len(source) / 1024.0 / elapsed)
+    return ast
+
+def main(argv):
+    args = [arg for arg in argv[1:] if not arg.startswith('--')]
+    n = int(args[0]) if args else 2000
+    source = gen_program(n)
+    print '%d definitions, %.1f KB' % (n + 1, len(source) / 1024.0)
+    hand_ast = bench('hand', handparser.read_program, source, n + 1)
+    if '--hand-only' not in argv:
+        packrat_ast = bench('packrat', parser.read_program, source, n + 1)
+        if show(hand_ast) != show(packrat_ast):
+            print 'the parsers disagree'
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Report how many TIM steps each peephole pass saves.
+
+Runs every program given on the command line (default: test_programs/*.hs)
+untranslated, first without the peephole optimiser and then enabling the
+passes one at a time, and prints the step count after each pass together
+with the saving relative to the previous column. A program that runs
+for more than STEP_BUDGET steps without the optimiser, such as one that
+loops forever, is skipped.
+
+Needs the PyPy source tree on PYTHONPATH, like targetrunspj.py.
+"""
+
+import glob
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from spj.parser import read_program
+from spj.timc import compile
+from spj.config import Config
+from spj.errors import InterpError
+from spj import peephole
+
+STEP_BUDGET = 5000000
+
+def count_steps(source, passes):
+    config = Config()
+    config.peephole = passes
+    state = compile(read_program(source), config)
+    state.set_limits(STEP_BUDGET, 0, 0, 0)
+    state.eval()
+    return state.stat.nsteps
+
+def report(path):
+    source = open(path).read()
+    names = peephole.all_pass_names()
+    try:
+        base = count_steps(source, [])
+    except InterpError as e:
+        print '%-28s skipped: %s' % (os.path.basename(path), e.what)
+        return
+    cols = ['%8d' % base]
+    prev = base
+    for i in xrange(len(names)):
+        steps = count_steps(source, names[:i + 1])
+        cols.append('%8d %-8s' % (steps, '(%+d)' % (steps - prev)))
+        prev = steps
+    saved = 100.0 * (base - prev) / base
+    print '%-28s %s  %.1f%%' % (os.path.basename(path), '  '.join(cols),
+                                saved)
+
+def main(argv):
+    paths = argv[1:]
+    if not paths:
+        top = os.path.join(os.path.dirname(__file__), '..')
+        paths = sorted(glob.glob(os.path.join(top, 'test_programs', '*.hs')))
+    header = ['    none'] + ['%17s' % ('+%s' % name) for name in
+                               peephole.all_pass_names()]
+    print '%-28s %s  saved' % ('program', '  '.join(header))
+    for path in paths:
+        report(path)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,12 @@
+foldl f acc xs = case xs of
+  <1> -> acc;
+  <2> y ys -> foldl f (f acc y) ys;;
+
+foldr f z xs = case xs of
+  <1> -> z;
+  <2> y ys -> f y (foldr f z ys);;
+
+upto a b = if (a > b) Pack{1, 0} (Pack{2, 2} a (upto (a + 1) b));
+
+main = let xs = upto 1 1000;
+       in (foldl (\acc x -> acc + (x * x)) 0 xs) + (foldr (+) 0 xs);
@@ -0,0 +1,3 @@
+nfib n = if (n < 2) 1 (1 + ((nfib (n - 1)) + (nfib (n - 2))));
+
+main = nfib 14;
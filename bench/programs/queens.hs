@@ -0,0 +1,16 @@
+safe q d qs = case qs of
+  <1> -> 1;
+  <2> q2 rest -> if (q == q2) 0
+                   (if (q == (q2 + d)) 0
+                     (if (q == (q2 - d)) 0 (safe q (d + 1) rest)));;
+
+place n k qs = if (k == 0) 1 (tryCol n k qs n);
+
+tryCol n k qs c = if (c == 0)
+                     0
+                     ((if (safe c 1 qs) (place n (k - 1) (Pack{2, 2} c qs)) 0)
+                      + (tryCol n k qs (c - 1)));
+
+queens n = place n n Pack{1, 0};
+
+main = queens 6;
@@ -0,0 +1,11 @@
+upto a b = if (a > b) Pack{1, 0} (Pack{2, 2} a (upto (a + 1) b));
+
+sumFrom acc t xs = case xs of
+  <1> -> acc + t;
+  <2> y ys -> if (acc < 0) 0 (sumFrom (acc + y) t ys);;
+
+sumList n = let xs = upto 1 n;
+                t = n * 2;
+            in sumFrom 0 t xs;
+
+main = sumList 3000;
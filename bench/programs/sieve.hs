@@ -0,0 +1,19 @@
+from n m = if (n > m) Pack{1, 0} (Pack{2, 2} n (from (n + 1) m));
+
+rem x y = x - ((x / y) * y);
+
+dropMults p xs = case xs of
+  <1> -> Pack{1, 0};
+  <2> y ys -> if ((rem y p) == 0)
+                 (dropMults p ys)
+                 (Pack{2, 2} y (dropMults p ys));;
+
+sieve xs = case xs of
+  <1> -> Pack{1, 0};
+  <2> p ps -> Pack{2, 2} p (sieve (dropMults p ps));;
+
+length xs = case xs of
+  <1> -> 0;
+  <2> y ys -> 1 + (length ys);;
+
+main = length (sieve (from 2 300));
@@ -0,0 +1,32 @@
+insert x xs = case xs of
+  <1> -> Pack{2, 2} x Pack{1, 0};
+  <2> y ys -> if (x <= y)
+                 (Pack{2, 2} x xs)
+                 (Pack{2, 2} y (insert x ys));;
+
+isort xs = case xs of
+  <1> -> Pack{1, 0};
+  <2> y ys -> insert y (isort ys);;
+
+next seed = let s = (seed * 75) + 74;
+            in s - ((s / 65537) * 65537);
+
+randoms seed n = if (n == 0)
+                    Pack{1, 0}
+                    (Pack{2, 2} (seed - ((seed / 1000) * 1000))
+                                (randoms (next seed) (n - 1)));
+
+sortedFrom x xs = case xs of
+  <1> -> 1;
+  <2> y ys -> if (x <= y) (sortedFrom y ys) 0;;
+
+sorted xs = case xs of
+  <1> -> 1;
+  <2> y ys -> sortedFrom y ys;;
+
+length xs = case xs of
+  <1> -> 0;
+  <2> y ys -> 1 + (length ys);;
+
+main = let xs = isort (randoms 42 150);
+       in (sorted xs) * (length xs);
@@ -0,0 +1,5 @@
+tak x y z = if (y < x)
+               (tak (tak (x - 1) y z) (tak (y - 1) z x) (tak (z - 1) x y))
+               z;
+
+main = tak 12 8 4;
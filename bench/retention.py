@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Measure how much of the heap frame trimming keeps alive.
+
+Runs each program with and without --no-trim-frames, taking a heap
+census every N steps (default 100), and prints the most closures seen
+live at once. The default program is bench/programs/retain.hs, where a
+thunk made next to a long list would keep the whole list alive through
+the frame it shares with it.
+
+usage: retention.py [-n N] [PROGRAM.hs ...]
+
+Needs the PyPy source tree on PYTHONPATH, like targetrunspj.py.
+"""
+
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+from spj.parser import read_program
+from spj.timc import compile_program
+from spj.config import parse_args
+
+def max_live(source, options, interval):
+    config = parse_args(['runspj'] + options)
+    state = compile_program(read_program(source), config).mk_state()
+    state.start_census(interval)
+    result = state.eval()
+    return result.to_s(), state.census.max_live
+
+def main(argv):
+    interval = 100
+    paths = []
+    i = 1
+    while i < len(argv):
+        if argv[i] == '-n':
+            i += 1
+            interval = int(argv[i])
+        elif argv[i].startswith('-'):
+            print __doc__
+            return 2
+        else:
+            paths.append(argv[i])
+        i += 1
+    if not paths:
+        paths = [os.path.join(BENCH_DIR, 'programs', 'retain.hs')]
+    print '%-20s %12s %12s' % ('program', 'shared', 'trimmed')
+    for path in paths:
+        source = open(path).read()
+        shared_result, shared = max_live(source, ['--no-trim-frames'],
+                                         interval)
+        trimmed_result, trimmed = max_live(source, [], interval)
+        if shared_result != trimmed_result:
+            print '%s: %s with shared frames, %s with trimmed ones' % (
+                path, shared_result, trimmed_result)
+            return 1
+        print '%-20s %12d %12d' % (os.path.basename(path), shared, trimmed)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""Run the benchmark suite and check it against a baseline.
+
+Runs every program in bench/programs under every mode in MODES, checks
+its result and records its Stat counters and wall-clock time in a JSON
+file. When a baseline is given, a counter that grew or a time that grew
+by more than the tolerance is reported as a regression, and the exit
+status is 1.
+
+By default the programs run untranslated in this process. With --binary
+they are run by a translated runspj instead and the counters are read
+from its -s output.
+
+usage: run_bench.py [-o RESULTS] [--baseline FILE] [--save-baseline]
+                    [--time-tolerance PERCENT] [--binary RUNSPJ]
+                    [--modes M1,M2] [BENCHMARK ...]
+
+Needs the PyPy source tree on PYTHONPATH, like targetrunspj.py.
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+from spj.parser import read_program
+from spj.timc import compile_program
+from spj.config import parse_args
+from spj import gmc
+
+# name -> expected result
+BENCHMARKS = [('nfib', 1219),
+              ('tak', 5),
+              ('queens', 4),
+              ('sieve', 62),
+              ('sort', 150),
+              ('folds', 334334000),
+              ('retain', 4507500)]
+
+# name -> runspj options
+MODES = [('default', []),
+         ('no-peephole', ['--no-peephole']),
+         ('no-ast-opt', ['--no-ast-opt']),
+         ('strict', ['--strict']),
+         ('no-trim-frames', ['--no-trim-frames']),
+         ('gmachine', ['--engine', 'gmachine'])]
+
+# Those the Stat of an engine does not have are left out of its records.
+COUNTERS = ['nsteps', 'nenters', 'nclosure_made', 'nupdates',
+            'max_stackdepth', 'max_vstackdepth',
+            'nint_closures', 'ncode_closures', 'nlabel_closures',
+            'nframes_made', 'nunwinds', 'nevals', 'nnodes_made',
+            'max_dumpdepth']
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+def run_in_process(source, options):
+    config = parse_args(['runspj'] + options)
+    start = time.time()
+    if config.engine == 'gmachine':
+        program = gmc.compile_program(read_program(source), config)
+    else:
+        program = compile_program(read_program(source), config)
+    compiled = time.time()
+    state = program.mk_state()
+    result = state.eval()
+    done = time.time()
+    record = {'result': result.to_s(),
+              'compile_time': compiled - start,
+              'run_time': done - compiled}
+    for counter in COUNTERS:
+        if hasattr(state.stat, counter):
+            record[counter] = getattr(state.stat, counter)
+    return record
+
+STAT_PATTERNS = [('nsteps', r'@step (\d+)'),
+                 ('nenters', r'Number of enters: (\d+)'),
+                 ('nclosure_made', r'Number of closures made: (\d+)'),
+                 ('nupdates', r'Number of updates: (\d+)'),
+                 ('nint_closures', r'Closures made int/code/label: (\d+)/'),
+                 ('ncode_closures',
+                  r'Closures made int/code/label: \d+/(\d+)/'),
+                 ('nlabel_closures',
+                  r'Closures made int/code/label: \d+/\d+/(\d+)'),
+                 ('nframes_made', r'Frames/boxes made: (\d+)/'),
+                 ('max_stackdepth', r'Max stackdepth/(?:v|dump): (\d+)/'),
+                 ('max_vstackdepth', r'Max stackdepth/v: \d+/(\d+)'),
+                 ('nunwinds', r'Number of unwinds: (\d+)'),
+                 ('nevals', r'Number of evals: (\d+)'),
+                 ('nnodes_made', r'Number of nodes made: (\d+)'),
+                 ('max_dumpdepth', r'Max stackdepth/dump: \d+/(\d+)')]
+
+def run_binary(binary, source, options):
+    start = time.time()
+    proc = subprocess.Popen([binary, '-s'] + options,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    out, err = proc.communicate(source)
+    done = time.time()
+    record = {'result': out.strip().splitlines()[-1],
+              'run_time': done - start}
+    for counter, pattern in STAT_PATTERNS:
+        m = re.search(pattern, err)
+        if m:
+            record[counter] = int(m.group(1))
+    return record
+
+def run_suite(names, modes, binary):
+    results = {}
+    for name, expected in BENCHMARKS:
+        if names and name not in names:
+            continue
+        source = open(os.path.join(BENCH_DIR, 'programs',
+                                   name + '.hs')).read()
+        for mode, options in MODES:
+            if modes and mode not in modes:
+                continue
+            if binary:
+                record = run_binary(binary, source, options)
+            else:
+                record = run_in_process(source, options)
+            record['ok'] = record['result'] == '#<W_Int %d>' % expected
+            results['%s/%s' % (name, mode)] = record
+            print '%-24s %-20s %9s steps %8.3fs%s' % (
+                name + '/' + mode, record['result'], record['nsteps'],
+                record['run_time'], '' if record['ok'] else '  WRONG')
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        new = results[key]
+        old = baseline[key]
+        for counter in COUNTERS:
+            if (new.get(counter) is not None and
+                    old.get(counter) is not None and
+                    new[counter] > old[counter]):
+                regressions.append('%s: %s %d -> %d' % (
+                    key, counter, old[counter], new[counter]))
+        if new['run_time'] > old['run_time'] * (1 + tolerance / 100.0):
+            regressions.append('%s: run_time %.3fs -> %.3fs' % (
+                key, old['run_time'], new['run_time']))
+    return regressions
+
+def main(argv):
+    out_path = None
+    baseline_path = None
+    save_baseline = False
+    tolerance = 50.0
+    binary = None
+    modes = []
+    names = []
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '-o':
+            i += 1
+            out_path = argv[i]
+        elif arg == '--baseline':
+            i += 1
+            baseline_path = argv[i]
+        elif arg == '--save-baseline':
+            save_baseline = True
+        elif arg == '--time-tolerance':
+            i += 1
+            tolerance = float(argv[i])
+        elif arg == '--binary':
+            i += 1
+            binary = argv[i]
+        elif arg == '--modes':
+            i += 1
+            modes = argv[i].split(',')
+        elif arg.startswith('-'):
+            print __doc__
+            return 2
+        else:
+            names.append(arg)
+        i += 1
+    if baseline_path is None:
+        baseline_path = DEFAULT_BASELINE
+
+    results = run_suite(names, modes, binary)
+    if out_path:
+        with open(out_path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+    if save_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+        print 'saved baseline to %s' % baseline_path
+        return 0
+
+    status = 0
+    if not all(record['ok'] for record in results.values()):
+        status = 1
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, tolerance)
+        for regression in regressions:
+            print 'REGRESSION %s' % regression
+        if regressions:
+            status = 1
+        else:
+            print 'no regressions against %s' % baseline_path
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
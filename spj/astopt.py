@@ -0,0 +1,276 @@
+from spj.language import (W_ScDefn, W_EAp, W_EInt, W_EVar, W_ELet, W_ECase,
+                          W_EConstr, W_EAlt, W_EPrimOp)
+from spj.timrun import (IntBinOp, compute_binop, OP_ADD, OP_SUB, OP_MUL,
+                        OP_DIV, OP_LT, OP_LE, OP_GT, OP_GE, OP_EQ, OP_NE)
+from spj.primitive import module
+from spj.lambdalift import free_vars, extend_scope
+
+# Optimisations on the lambda-lifted program, before it is compiled:
+#
+#  - arithmetic on literals is folded, as is an if on a literal condition
+#    and a reference to a CAF whose body folds to a literal;
+#  - a literal right operand is moved to the left, where the compiled code
+#    can use PushVIntOp;
+#  - saturated calls to small non-recursive supercombinators are replaced
+#    by their bodies. Literal and variable arguments are substituted, the
+#    others let-bound, so that they are still evaluated at most once.
+
+INLINE_SIZE = 12 # Largest body, in nodes, that is inlined.
+INLINE_DEPTH = 4 # How many inlinings deep an inlined body is optimised.
+
+def optimise_program(prog, inline_size=INLINE_SIZE):
+    opt = AstOptimiser(prog, inline_size)
+    return opt.optimise_program(), opt.inlined
+
+# For --inline-report: the inlined list made by optimise_program.
+def write_inline_report(inlined, out):
+    for (caller, callee, count) in inlined:
+        out.write('inlined %s into %s (%d site%s)\n' %
+                  (callee, caller, count, '' if count == 1 else 's'))
+
+class AstOptimiser(object):
+    def __init__(self, prog, inline_size):
+        self.prog = prog
+        self.inline_size = inline_size
+        self.scs = {} # name -> W_ScDefn
+        for sc in prog:
+            self.scs[sc.name] = sc
+        self.recursive = find_recursive(prog, self.scs)
+        self.caf_values = {} # name -> W_EInt, or None if not a constant
+        self.sc_name = '?'
+        self.ninlined = 0
+        # [(caller, callee, number of sites)], in the order first seen
+        self.inlined = []
+
+    def optimise_program(self):
+        res = []
+        for sc in self.prog:
+            self.sc_name = sc.name
+            self.ninlined = 0
+            scope = extend_scope({}, sc.args)
+            res.append(W_ScDefn(sc.name, sc.args,
+                                self.opt(sc.body, scope, INLINE_DEPTH)))
+        return res
+
+    def opt(self, expr, scope, depth):
+        if isinstance(expr, W_EVar):
+            if expr.name not in scope:
+                value = self.caf_value(expr.name)
+                if value is not None:
+                    return value
+            return expr
+        elif isinstance(expr, W_EAp):
+            return self.opt_ap(expr, scope, depth)
+        elif isinstance(expr, W_ELet):
+            new_scope = extend_scope(scope, [name for (name, _) in
+                                             expr.defns])
+            if expr.isrec:
+                defn_scope = new_scope
+            else:
+                defn_scope = scope
+            defns = [(name, self.opt(e, defn_scope, depth))
+                     for (name, e) in expr.defns]
+            return W_ELet(defns, self.opt(expr.expr, new_scope, depth),
+                          expr.isrec)
+        elif isinstance(expr, W_ECase):
+            alts = [W_EAlt(alt.tag, alt.components,
+                           self.opt(alt.body,
+                                    extend_scope(scope, alt.components),
+                                    depth))
+                    for alt in expr.alts]
+            return W_ECase(self.opt(expr.expr, scope, depth), alts)
+        return expr
+
+    def opt_ap(self, expr, scope, depth):
+        revargs = [] # [argn, ..., arg1]
+        func = expr
+        while isinstance(func, W_EAp):
+            revargs.append(func.a)
+            func = func.f
+        nargs = len(revargs)
+        args = [self.opt(revargs[i], scope, depth)
+                for i in xrange(nargs - 1, -1, -1)] # [arg1, ..., argn]
+        if isinstance(func, W_EVar) and func.name not in scope:
+            name = func.name
+            if name in module.ops and nargs == module.ops[name].get_arity():
+                return fold_primop(func, args)
+            if name == 'if' and nargs >= 3 and isinstance(args[0], W_EInt):
+                if args[0].ival != 0:
+                    branch = args[1]
+                else:
+                    branch = args[2]
+                return mk_ap(branch, args[3:])
+            if depth > 0 and self.can_inline(name, nargs, scope):
+                return self.opt(self.inline(self.scs[name], args), scope,
+                                depth - 1)
+        else:
+            func = self.opt(func, scope, depth)
+        return mk_ap(func, args)
+
+    def can_inline(self, name, nargs, scope):
+        sc = self.scs.get(name, None)
+        if (sc is None or sc.arity == 0 or nargs < sc.arity or
+                name in self.recursive or
+                expr_size(sc.body) > self.inline_size):
+            return False
+        # The globals the body refers to must not be shadowed here.
+        fvs = {}
+        free_vars(sc.body, extend_scope({}, sc.args), fvs)
+        for fv in fvs.keys():
+            if fv in scope:
+                return False
+        return True
+
+    def inline(self, sc, args):
+        self.note_inlined(sc.name)
+        bound = {}
+        binders(sc.body, bound)
+        mapping = {}
+        defns = []
+        for i in xrange(sc.arity):
+            arg = args[i]
+            if (isinstance(arg, W_EInt) or isinstance(arg, W_EConstr) or
+                    (isinstance(arg, W_EVar) and arg.name not in bound)):
+                mapping[sc.args[i]] = arg
+            else:
+                self.ninlined += 1
+                name = '%s$%s%d' % (self.sc_name, sc.args[i], self.ninlined)
+                defns.append((name, arg))
+                mapping[sc.args[i]] = W_EVar(name)
+        body = subst(sc.body, mapping)
+        if defns:
+            body = W_ELet(defns, body, False)
+        return mk_ap(body, args[sc.arity:])
+
+    def note_inlined(self, callee):
+        for i in xrange(len(self.inlined)):
+            (caller, name, count) = self.inlined[i]
+            if caller == self.sc_name and name == callee:
+                self.inlined[i] = (caller, name, count + 1)
+                return
+        self.inlined.append((self.sc_name, callee, 1))
+
+    def caf_value(self, name):
+        if name in self.caf_values:
+            return self.caf_values[name]
+        self.caf_values[name] = None
+        sc = self.scs.get(name, None)
+        if sc is not None and sc.arity == 0 and name not in self.recursive:
+            caller = self.sc_name
+            self.sc_name = name
+            body = self.opt(sc.body, {}, 0)
+            self.sc_name = caller
+            if isinstance(body, W_EInt):
+                self.caf_values[name] = body
+        return self.caf_values[name]
+
+# A literal left operand saves a vstack push, so move literals left,
+# flipping the operator where needed.
+flipped_ops = {OP_ADD: '+', OP_MUL: '*', OP_EQ: '==', OP_NE: '/=',
+               OP_LT: '>', OP_LE: '>=', OP_GT: '<', OP_GE: '<='}
+
+def fold_primop(func, args):
+    prim_op = module.ops[func.name]
+    if isinstance(prim_op, IntBinOp):
+        lhs = args[0]
+        rhs = args[1]
+        op = prim_op.opcode
+        if isinstance(lhs, W_EInt) and isinstance(rhs, W_EInt):
+            if not (op == OP_DIV and rhs.ival == 0):
+                return W_EInt(compute_binop(op, lhs.ival, rhs.ival))
+        elif isinstance(rhs, W_EInt):
+            if op in flipped_ops:
+                return mk_ap(W_EPrimOp(flipped_ops[op]), [rhs, lhs])
+            elif op == OP_SUB:
+                return mk_ap(W_EPrimOp('+'), [W_EInt(-rhs.ival), lhs])
+    elif func.name == 'negate' and isinstance(args[0], W_EInt):
+        return W_EInt(-args[0].ival)
+    return mk_ap(func, args)
+
+def mk_ap(func, args):
+    for arg in args:
+        func = W_EAp(func, arg)
+    return func
+
+# Supercombinators that can reach themselves through the globals their
+# bodies refer to.
+def find_recursive(prog, scs):
+    callees = {} # name -> [name]
+    for sc in prog:
+        fvs = {}
+        free_vars(sc.body, extend_scope({}, sc.args), fvs)
+        callees[sc.name] = [name for name in fvs.keys() if name in scs]
+    recursive = {}
+    for sc in prog:
+        seen = {}
+        todo = callees[sc.name][:]
+        while todo:
+            name = todo.pop()
+            if name == sc.name:
+                recursive[sc.name] = None
+                break
+            if name not in seen:
+                seen[name] = None
+                todo.extend(callees[name])
+    return recursive
+
+def expr_size(expr):
+    if isinstance(expr, W_EAp):
+        return 1 + expr_size(expr.f) + expr_size(expr.a)
+    elif isinstance(expr, W_ELet):
+        size = 1 + expr_size(expr.expr)
+        for (_, e) in expr.defns:
+            size += expr_size(e)
+        return size
+    elif isinstance(expr, W_ECase):
+        size = 1 + expr_size(expr.expr)
+        for alt in expr.alts:
+            size += expr_size(alt.body)
+        return size
+    return 1
+
+# Add the names bound anywhere inside <expr> to <bound>.
+def binders(expr, bound):
+    if isinstance(expr, W_EAp):
+        binders(expr.f, bound)
+        binders(expr.a, bound)
+    elif isinstance(expr, W_ELet):
+        for (name, e) in expr.defns:
+            bound[name] = None
+            binders(e, bound)
+        binders(expr.expr, bound)
+    elif isinstance(expr, W_ECase):
+        binders(expr.expr, bound)
+        for alt in expr.alts:
+            for name in alt.components:
+                bound[name] = None
+            binders(alt.body, bound)
+
+# Replace the free variables of <expr> found in <mapping>. The values
+# must not be captured by binders inside <expr>.
+def subst(expr, mapping):
+    if isinstance(expr, W_EVar):
+        return mapping.get(expr.name, expr)
+    elif isinstance(expr, W_EAp):
+        return W_EAp(subst(expr.f, mapping), subst(expr.a, mapping))
+    elif isinstance(expr, W_ELet):
+        inner = without(mapping, [name for (name, _) in expr.defns])
+        if expr.isrec:
+            defn_mapping = inner
+        else:
+            defn_mapping = mapping
+        defns = [(name, subst(e, defn_mapping)) for (name, e) in expr.defns]
+        return W_ELet(defns, subst(expr.expr, inner), expr.isrec)
+    elif isinstance(expr, W_ECase):
+        alts = [W_EAlt(alt.tag, alt.components,
+                       subst(alt.body, without(mapping, alt.components)))
+                for alt in expr.alts]
+        return W_ECase(subst(expr.expr, mapping), alts)
+    return expr
+
+def without(mapping, names):
+    res = mapping.copy()
+    for name in names:
+        if name in res:
+            del res[name]
+    return res
@@ -0,0 +1,96 @@
+# Heap censuses for State.run: every <interval> steps, count the closures
+# that can be reached from the machine state, i.e. the part of the heap
+# the program still keeps alive. Each census can also be written to a
+# stream as one line of a time series, with a column per count:
+#
+#   step live ints thunks values stack vstack dump
+#
+# where live = ints + thunks + values, thunks are closures not updated
+# yet and values the other closures that are not integers.
+
+SERIES_HEADER = '# step live ints thunks values stack vstack dump\n'
+
+class Sample(object):
+    def __init__(self, step):
+        self.step = step
+        self.nints = 0
+        self.nthunks = 0
+        self.nvalues = 0
+        self.stackdepth = 0
+        self.vstackdepth = 0
+        self.dumpdepth = 0
+
+    def nlive(self):
+        return self.nints + self.nthunks + self.nvalues
+
+    def to_line(self):
+        return '%d %d %d %d %d %d %d %d\n' % (
+            self.step, self.nlive(), self.nints, self.nthunks, self.nvalues,
+            self.stackdepth, self.vstackdepth, self.dumpdepth)
+
+class Census(object):
+    def __init__(self, interval, series_out=None):
+        self.interval = interval
+        self.countdown = interval
+        self.nsamples = 0
+        self.max_live = 0
+        self.max_live_step = 0
+        self.series_out = series_out
+        if series_out is not None:
+            series_out.write(SERIES_HEADER)
+
+    def step(self, state):
+        self.countdown -= 1
+        if self.countdown > 0:
+            return
+        self.countdown = self.interval
+        sample = take_sample(state)
+        self.nsamples += 1
+        if sample.nlive() > self.max_live:
+            self.max_live = sample.nlive()
+            self.max_live_step = sample.step
+        if self.series_out is not None:
+            self.series_out.write(sample.to_line())
+
+    def write_report(self, out):
+        out.write('Heap census: at most %d live closures (step %d), '
+                  '%d samples\n' % (self.max_live, self.max_live_step,
+                                    self.nsamples))
+
+# The closures reachable from the stack, the current frames, the dump and
+# the CAFs, by kind. A closure reaches the closures in its frame.
+def take_sample(state):
+    sample = Sample(state.stat.nsteps)
+    seen = {}
+    todo = []
+    push_frame(todo, state.stack)
+    push_frame(todo, state.frameptr)
+    push_frame(todo, state.dataframe)
+    push_frame(todo, state.cafs)
+    for uf in state.dump:
+        todo.append(uf.closure)
+    if state.curr_closure is not None:
+        todo.append(state.curr_closure)
+    while todo:
+        cl = todo.pop()
+        if cl in seen:
+            continue
+        seen[cl] = None
+        if state.is_int_closure(cl):
+            sample.nints += 1
+        elif state.is_unevaluated(cl):
+            sample.nthunks += 1
+        else:
+            sample.nvalues += 1
+        push_frame(todo, cl.frameptr)
+    sample.stackdepth = len(state.stack)
+    sample.vstackdepth = state.vstack_depth()
+    sample.dumpdepth = len(state.dump)
+    return sample
+
+def push_frame(todo, frameptr):
+    if frameptr is None:
+        return
+    for cl in frameptr:
+        if cl is not None:
+            todo.append(cl)
@@ -0,0 +1,221 @@
+from spj.errors import InterpError
+
+# Trace levels, from least to most verbose.
+TRACE_QUIET = 0 # Only the result is printed.
+TRACE_STAT = 1  # Print the final Stat.
+TRACE_STEP = 2  # Print the whole machine state before every step.
+
+class Config(object):
+    def __init__(self):
+        self.trace_level = TRACE_QUIET
+        self.trace_path = None
+        self.dump_code = False
+        self.peephole = None # Names of the peephole passes, None for all.
+        self.strictness = False # Evaluate strict arguments before calls.
+        self.ast_opt = True # Fold constants and inline before compiling.
+        self.inline_size = 12 # Largest supercombinator body to inline.
+        self.inline_report = False
+        self.trim_frames = True # Closures only keep the slots they read.
+        self.profile = False
+        self.profile_dot_path = None
+        self.census_interval = 0 # Steps between heap censuses, 0 for none.
+        self.census_path = None # Time series of the censuses.
+        self.nworkers = 0 # Processes evaluating sparks, 0 to ignore them.
+        # Limits of State.set_limits, 0 for none.
+        self.max_steps = 0
+        self.max_stackdepth = 0
+        self.max_vstackdepth = 0
+        self.max_allocs = 0
+        self.cache_path = None # Compiled program to reuse or write.
+        self.parser = 'packrat' # or 'hand', see spj.handparser
+        self.engine = 'tim' # or 'gmachine', see spj.gmc
+        self.trace_out = None # Stream, opened by the entrypoint.
+
+    def has_limits(self):
+        return (self.max_steps > 0 or self.max_stackdepth > 0 or
+                self.max_vstackdepth > 0 or self.max_allocs > 0)
+
+usage = '''\
+usage: %s [options] < program.hs
+  -q, --quiet           only print the result (default)
+  -s, --stat            print summary statistics when done
+  -t, --trace           print the machine state before every step
+  --trace-file PATH     write traces and statistics to PATH (implies -t)
+  --parser NAME         parse with the packrat parser (default) or the
+                        hand-written one (hand)
+  --engine NAME         run on the TIM (tim, the default) or on the
+                        G-machine (gmachine), which ignores the TIM code
+                        options --peephole, --strict and --no-trim-frames
+  -p, --profile         print steps, enters, closures made and vpushes,
+                        then closures and frames made by kind, per
+                        supercombinator and code fragment when done
+  --profile-dot PATH    write the call graph of the profile to PATH as a
+                        Graphviz dot file (implies -p)
+  --census N            count the live closures every N steps and print
+                        the most seen when done
+  --census-file PATH    write every census to PATH as a time series of
+                        live closures by kind and stack depths (implies
+                        --census 1000 unless given)
+  -j, --workers N       evaluate the closures sparked by par in up to N
+                        worker processes (default 0: ignore sparks)
+  --max-steps N         stop with an error after N steps
+  --max-stack N         stop with an error when the stack or the dump
+                        grows deeper than N
+  --max-vstack N        stop with an error when the vstack grows deeper
+                        than N
+  --max-allocs N        stop with an error after N closures and frames
+                        have been made
+  -d, --dump-code       print the compiled program before running it
+  --peephole PASSES     run only these comma-separated peephole passes
+                        (dce, enter-arg, move-code, vint-op)
+  --no-peephole         do not run the peephole optimiser
+  --no-ast-opt          do not fold constants or inline supercombinators
+  --inline-size N       inline bodies of at most N nodes (default 12)
+  --inline-report       print which supercombinators were inlined where
+  --no-trim-frames      make closures share the whole frame they are made
+                        in instead of copying the slots they read
+  --strict              evaluate arithmetic arguments of strict parameters
+                        before the call instead of building thunks
+  -c, --cache PATH      run the program compiled in PATH if it was compiled
+                        from the same source with the same options;
+                        otherwise compile it and save it there
+  -h, --help            show this message'''
+
+def parse_args(argv):
+    config = Config()
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '-q' or arg == '--quiet':
+            config.trace_level = TRACE_QUIET
+        elif arg == '-s' or arg == '--stat':
+            config.trace_level = TRACE_STAT
+        elif arg == '-t' or arg == '--trace':
+            config.trace_level = TRACE_STEP
+        elif arg == '--trace-file':
+            i += 1
+            if i >= len(argv):
+                raise InterpError('%s: missing argument' % arg)
+            config.trace_path = argv[i]
+            if config.trace_level == TRACE_QUIET:
+                config.trace_level = TRACE_STEP
+        elif arg == '--parser':
+            i += 1
+            if i >= len(argv):
+                raise InterpError('%s: missing argument' % arg)
+            if argv[i] != 'packrat' and argv[i] != 'hand':
+                raise InterpError('%s: unknown parser' % argv[i])
+            config.parser = argv[i]
+        elif arg == '--engine':
+            i += 1
+            if i >= len(argv):
+                raise InterpError('%s: missing argument' % arg)
+            if argv[i] != 'tim' and argv[i] != 'gmachine':
+                raise InterpError('%s: unknown engine' % argv[i])
+            config.engine = argv[i]
+        elif arg == '-p' or arg == '--profile':
+            config.profile = True
+        elif arg == '--profile-dot':
+            i += 1
+            if i >= len(argv):
+                raise InterpError('%s: missing argument' % arg)
+            config.profile_dot_path = argv[i]
+            config.profile = True
+        elif arg == '--census':
+            i += 1
+            if i >= len(argv):
+                raise InterpError('%s: missing argument' % arg)
+            try:
+                config.census_interval = int(argv[i])
+            except ValueError:
+                raise InterpError('%s: not a number' % argv[i])
+            if config.census_interval <= 0:
+                raise InterpError('%s: not a positive number' % argv[i])
+        elif arg == '--census-file':
+            i += 1
+            if i >= len(argv):
+                raise InterpError('%s: missing argument' % arg)
+            config.census_path = argv[i]
+        elif arg == '-j' or arg == '--workers':
+            i += 1
+            if i >= len(argv):
+                raise InterpError('%s: missing argument' % arg)
+            try:
+                config.nworkers = int(argv[i])
+            except ValueError:
+                raise InterpError('%s: not a number' % argv[i])
+            if config.nworkers < 0:
+                raise InterpError('%s: must be 0 or more' % argv[i])
+        elif arg == '--max-steps':
+            i += 1
+            config.max_steps = positive_arg(argv, i)
+        elif arg == '--max-stack':
+            i += 1
+            config.max_stackdepth = positive_arg(argv, i)
+        elif arg == '--max-vstack':
+            i += 1
+            config.max_vstackdepth = positive_arg(argv, i)
+        elif arg == '--max-allocs':
+            i += 1
+            config.max_allocs = positive_arg(argv, i)
+        elif arg == '-d' or arg == '--dump-code':
+            config.dump_code = True
+        elif arg == '--peephole':
+            i += 1
+            if i >= len(argv):
+                raise InterpError('%s: missing argument' % arg)
+            config.peephole = argv[i].split(',')
+        elif arg == '--no-peephole':
+            config.peephole = []
+        elif arg == '--no-ast-opt':
+            config.ast_opt = False
+        elif arg == '--inline-size':
+            i += 1
+            if i >= len(argv):
+                raise InterpError('%s: missing argument' % arg)
+            try:
+                config.inline_size = int(argv[i])
+            except ValueError:
+                raise InterpError('%s: not a number' % argv[i])
+        elif arg == '--inline-report':
+            config.inline_report = True
+        elif arg == '--no-trim-frames':
+            config.trim_frames = False
+        elif arg == '--strict':
+            config.strictness = True
+        elif arg == '-c' or arg == '--cache':
+            i += 1
+            if i >= len(argv):
+                raise InterpError('%s: missing argument' % arg)
+            config.cache_path = argv[i]
+        elif arg == '-h' or arg == '--help':
+            return None
+        else:
+            raise InterpError('%s: unknown option' % arg)
+        i += 1
+    if config.census_path is not None and config.census_interval == 0:
+        config.census_interval = 1000
+    if config.engine == 'gmachine':
+        if config.profile:
+            raise InterpError('--profile: not supported by the G-machine')
+        if config.census_interval > 0:
+            raise InterpError('--census: not supported by the G-machine')
+        if config.nworkers > 0:
+            raise InterpError('--workers: not supported by the G-machine')
+        if config.cache_path is not None:
+            raise InterpError('--cache: not supported by the G-machine')
+        if config.has_limits():
+            raise InterpError('--max-*: not supported by the G-machine')
+    return config
+
+# argv[i], the argument of the option argv[i - 1], as a positive number.
+def positive_arg(argv, i):
+    if i >= len(argv):
+        raise InterpError('%s: missing argument' % argv[i - 1])
+    try:
+        n = int(argv[i])
+    except ValueError:
+        raise InterpError('%s: not a number' % argv[i])
+    if n <= 0:
+        raise InterpError('%s: not a positive number' % argv[i])
+    return n
@@ -1,21 +1,127 @@
-from pypy.rlib.streamio import fdopen_as_stream
+from pypy.rlib.streamio import fdopen_as_stream, open_file_as_stream
 
-from spj.parser import read_program
+from spj import parser, handparser, gmc
 from spj.language import ppr
-from spj.timc import compile
-from spj.errors import InterpError
+from spj.timc import compile_program
+from spj.serialize import program_key, dump_program, load_program
+from spj.errors import InterpError, LimitExceeded
+from spj.config import parse_args, usage
+from spj.utils import stdout
 
 def main(argv):
+    try:
+        config = parse_args(argv)
+    except InterpError as e:
+        print e.what
+        print usage % argv[0]
+        return 2
+    if config is None:
+        print usage % argv[0]
+        return 0
+
     stdin = fdopen_as_stream(0, 'r')
     source = stdin.readall()
+    if config.trace_path is not None:
+        config.trace_out = open_file_as_stream(config.trace_path, 'w')
+    else:
+        config.trace_out = fdopen_as_stream(2, 'w')
     try:
-        ast = read_program(source)
-        code = compile(ast)
-        result = code.eval()
+        if config.engine == 'gmachine':
+            result = run_gmachine(source, config)
+        else:
+            result = run_tim(source, config)
+    except LimitExceeded as e:
+        print e.what
+        ppr(e.stat, config.trace_out)
+        return 1
     except InterpError as e:
         print e.what
         return 1
+    finally:
+        stdout.flush()
+        if config.trace_path is not None:
+            config.trace_out.close()
+        else:
+            config.trace_out.flush()
 
     print result.to_s()
     return 0
 
+def read_source(source, config):
+    if config.parser == 'hand':
+        return handparser.read_program(source)
+    return parser.read_program(source)
+
+def run_gmachine(source, config):
+    program = gmc.compile_program(read_source(source, config), config)
+    return program.mk_state(config.trace_level, config.trace_out).eval()
+
+def run_tim(source, config):
+    key = ''
+    program = None
+    if config.cache_path is not None:
+        key = program_key(source, config)
+        program = read_cache(config.cache_path, key)
+        if program is not None and config.dump_code:
+            ppr(program, config.trace_out)
+    if program is None:
+        program = compile_program(read_source(source, config), config)
+        if config.cache_path is not None:
+            write_cache(config.cache_path, dump_program(program, key))
+    code = program.mk_state(config.trace_level, config.trace_out)
+    if config.profile:
+        code.start_profile()
+    census_out = None
+    if config.census_path is not None:
+        census_out = open_file_as_stream(config.census_path, 'w')
+    if config.census_interval > 0:
+        code.start_census(config.census_interval, census_out)
+    if config.nworkers > 0:
+        code.start_parallel(config.nworkers)
+    if config.has_limits():
+        code.set_limits(config.max_steps, config.max_stackdepth,
+                        config.max_vstackdepth, config.max_allocs)
+    try:
+        result = code.eval()
+    finally:
+        if census_out is not None:
+            census_out.close()
+    if config.profile:
+        write_profile(code.profile, config)
+    if config.census_interval > 0:
+        code.census.write_report(config.trace_out)
+    return result
+
+# The program saved in <path> for <key>, or None if there is none.
+def read_cache(path, key):
+    try:
+        f = open_file_as_stream(path, 'rb')
+        try:
+            data = f.readall()
+        finally:
+            f.close()
+        return load_program(data, key)
+    except OSError:
+        return None
+    except InterpError:
+        return None
+
+def write_cache(path, data):
+    try:
+        f = open_file_as_stream(path, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+    except OSError:
+        print '%s: cannot write compiled program' % path
+
+def write_profile(profile, config):
+    profile.write_report(config.trace_out)
+    profile.write_alloc_report(config.trace_out)
+    if config.profile_dot_path is not None:
+        f = open_file_as_stream(config.profile_dot_path, 'w')
+        try:
+            profile.write_dot(f)
+        finally:
+            f.close()
@@ -3,3 +3,9 @@ class InterpError(Exception):
     def __init__(self, what):
         self.what = what
 
+# A program ran past one of the limits set by State.set_limits. <stat> is
+# the Stat of the machine when it stopped.
+class LimitExceeded(InterpError):
+    def __init__(self, what, stat):
+        InterpError.__init__(self, what)
+        self.stat = stat
@@ -0,0 +1,365 @@
+from spj.errors import InterpError
+from spj.language import (W_Root, W_EAp, W_EInt, W_EVar, W_ELet, W_ECase,
+                          W_EConstr, W_EAlt, W_ScDefn, ppr)
+from spj.gmrun import (Unwind, Eval, Push, Pushglobal, Pushint, Mkap, Update,
+                       Pop, Slide, Alloc, Binop, PrimOp, Jump, JumpFalse,
+                       Label, Pack, Casejump, Split, Assembler, assemble,
+                       Program)
+from spj.timrun import IntBinOp
+from spj.primitive import module, output_ops
+from spj import lambdalift, astopt
+from spj.timc import live_scs
+from spj.lambdalift import free_vars
+
+# The compilation schemes of the book's G-machine Mk6 for spj.gmrun, on
+# the same lambda-lifted and optimised program as spj.timc. An
+# environment maps a local name to its position on the stack, counted up
+# from the root of the redex: a name at position p is Push (d - p) when
+# d nodes are above the root. Schemes:
+#
+#   R: the body of a supercombinator, in tail position
+#   E: evaluate to weak head normal form and leave it on top
+#   C: build the graph of an expression without evaluating it
+
+def compile_program(prog, config):
+    prog = lambdalift.lift_program(prog)
+    if config.ast_opt:
+        prog, inlined = astopt.optimise_program(prog, config.inline_size)
+        if config.inline_report and config.trace_out:
+            astopt.write_inline_report(inlined, config.trace_out)
+    prog = live_scs(prog, 'main')
+    cc = ProgramCompiler()
+    cc.compile_program(prog)
+    if config.dump_code:
+        ppr(cc, config.trace_out)
+    asm = cc.link()
+    initinstrs = [Pushglobal('main'), Eval()]
+    globals = [assemble(name, cc.globalenv[name], asm)
+               for name in cc.global_names]
+    arities = [cc.arities[name] for name in cc.global_names]
+    return Program(assemble('<main>', initinstrs, asm), globals,
+                   cc.global_names, arities)
+
+class ProgramCompiler(W_Root):
+    def __init__(self):
+        self.globalenv = {} # name -> [Instr]
+        self.arities = {}
+        self.todo = [] # W_ScDefns made while compiling, still to compile
+        self.nlifted = 0
+        self.global_names = [] # global index -> name, set by link()
+
+    def ppr(self, p):
+        p.writeln('<GmProgCompiler>')
+        with p.block(2):
+            p.writeln('Globals:')
+            p.write_dict(self.globalenv.items())
+            p.newline()
+
+    def compile_program(self, prog):
+        for sc in prog:
+            self.arities[sc.name] = sc.arity
+        self.todo = prog[:]
+        while self.todo:
+            sc = self.todo.pop()
+            cc = Compiler(self, sc.name)
+            cc.compile_sc(sc)
+            self.globalenv[sc.name] = cc.code
+
+    # The global a name refers to, made on first use for prim-ops and if,
+    # which are compiled from their own saturated application, for par,
+    # which does not spark anything here, and for the list prims.
+    def global_name(self, name):
+        if name in self.arities:
+            return name
+        if name == 'par':
+            self.add_sc(W_ScDefn(name, ['x', 'y'], W_EVar('y')))
+        elif name == 'nil':
+            self.add_sc(W_ScDefn(name, [], W_EConstr(1, 0)))
+        elif name == 'cons':
+            pack = W_EAp(W_EAp(W_EConstr(2, 2), W_EVar('h')), W_EVar('t'))
+            self.add_sc(W_ScDefn(name, ['h', 't'], pack))
+        elif name == 'casePair':
+            consf = W_EAp(W_EAp(W_EVar('consf'), W_EVar('h')), W_EVar('t'))
+            body = W_ECase(W_EVar('xs'), [W_EAlt(1, [], W_EVar('nilv')),
+                                          W_EAlt(2, ['h', 't'], consf)])
+            self.add_sc(W_ScDefn(name, ['xs', 'consf', 'nilv'], body))
+        elif name in output_ops:
+            self.add_output_op(name, output_ops[name])
+        elif name in module.ops or name == 'if':
+            if name == 'if':
+                arity = 3
+            else:
+                arity = module.ops[name].get_arity()
+            args = ['x%d' % i for i in xrange(arity)]
+            body = W_EVar(name)
+            for arg in args:
+                body = W_EAp(body, W_EVar(arg))
+            self.add_sc(W_ScDefn(name, args, body))
+        return name
+
+    # The output prim-op <prim_op> on its integer argument, if any, then
+    # the last argument, which is what the global reduces to.
+    def add_output_op(self, name, prim_op):
+        arity = prim_op.get_arity() + 1
+        code = []
+        if prim_op.get_arity() == 1:
+            code.append(Push(0))
+            code.append(Eval())
+        code.append(PrimOp(prim_op.index))
+        code.append(Pop(1))
+        code.append(Push(arity - 1))
+        code.append(Update(arity))
+        code.append(Pop(arity))
+        code.append(Unwind())
+        self.arities[name] = arity
+        self.globalenv[name] = code
+
+    # Constructors are globals too: [Pack t a, Update 0, Unwind].
+    def constr_name(self, tag, arity):
+        name = 'Pack{%d,%d}' % (tag, arity)
+        if name not in self.arities:
+            self.arities[name] = arity
+            self.globalenv[name] = [Pack(tag, arity), Update(0), Unwind()]
+        return name
+
+    # A case in a lazy context is lifted out into a supercombinator of
+    # its free local variables.
+    def lift_case(self, owner, expr, env):
+        bound = {}
+        fvs = {}
+        free_vars(expr, bound, fvs)
+        args = [name for name in fvs.keys() if name in env]
+        args.sort()
+        name = '%s$case%d' % (owner, self.nlifted)
+        self.nlifted += 1
+        self.add_sc(W_ScDefn(name, args, expr))
+        return name, args
+
+    def add_sc(self, sc):
+        self.arities[sc.name] = sc.arity
+        self.todo.append(sc)
+
+    def link(self):
+        names = self.globalenv.keys()
+        names.sort()
+        global_indices = {}
+        for i in xrange(len(names)):
+            global_indices[names[i]] = i
+        self.global_names = names
+        if 'main' not in global_indices:
+            raise InterpError('main: undefined name')
+        for code in self.globalenv.values():
+            for instr in code:
+                if (isinstance(instr, Pushglobal) and
+                        instr.name not in global_indices):
+                    raise InterpError('%s: undefined name' % instr.name)
+        return Assembler(global_indices)
+
+class Compiler(object):
+    def __init__(self, progcc, name):
+        self.progcc = progcc
+        self.name = name
+        self.code = []
+        self.nlabels = 0
+
+    def emit(self, instr):
+        self.code.append(instr)
+
+    def new_label(self):
+        self.nlabels += 1
+        return self.nlabels
+
+    def compile_sc(self, sc):
+        env = {}
+        for i, name in enumerate(sc.args):
+            env[name] = sc.arity - i
+        self.compile_r(sc.body, env, sc.arity)
+
+    def compile_r(self, expr, env, d):
+        if isinstance(expr, W_ELet):
+            new_env, n = self.compile_defns(expr, env, d)
+            self.compile_r(expr.expr, new_env, d + n)
+        elif isinstance(expr, W_ECase):
+            self.compile_e(expr.expr, env, d)
+            self.compile_alts(expr, env, d, True, -1)
+        elif self.is_if(expr, env):
+            cond, true_expr, false_expr = if_args(expr)
+            false_label = self.new_label()
+            self.compile_e(cond, env, d)
+            self.emit(JumpFalse(false_label))
+            self.compile_r(true_expr, env, d)
+            self.emit(Label(false_label))
+            self.compile_r(false_expr, env, d)
+        else:
+            if self.is_strict_value(expr, env):
+                self.compile_e(expr, env, d)
+            else:
+                self.compile_c(expr, env, d)
+            self.emit(Update(d))
+            if d > 0:
+                self.emit(Pop(d))
+            self.emit(Unwind())
+
+    def compile_e(self, expr, env, d):
+        if isinstance(expr, W_EInt):
+            self.emit(Pushint(expr.ival))
+        elif isinstance(expr, W_ELet):
+            new_env, n = self.compile_defns(expr, env, d)
+            self.compile_e(expr.expr, new_env, d + n)
+            self.emit(Slide(n))
+        elif isinstance(expr, W_ECase):
+            self.compile_e(expr.expr, env, d)
+            end_label = self.new_label()
+            self.compile_alts(expr, env, d, False, end_label)
+            self.emit(Label(end_label))
+        elif self.is_if(expr, env):
+            cond, true_expr, false_expr = if_args(expr)
+            false_label = self.new_label()
+            end_label = self.new_label()
+            self.compile_e(cond, env, d)
+            self.emit(JumpFalse(false_label))
+            self.compile_e(true_expr, env, d)
+            self.emit(Jump(end_label))
+            self.emit(Label(false_label))
+            self.compile_e(false_expr, env, d)
+            self.emit(Label(end_label))
+        elif self.prim_op(expr, env) is not None:
+            prim_op = self.prim_op(expr, env)
+            args = app_args(expr)
+            for i in xrange(len(args) - 1, -1, -1):
+                self.compile_e(args[i], env, d + len(args) - 1 - i)
+            if isinstance(prim_op, IntBinOp):
+                self.emit(Binop(prim_op.opcode))
+            else:
+                self.emit(PrimOp(prim_op.index))
+        elif saturated_constr(expr) is not None:
+            self.compile_c(expr, env, d)
+        else:
+            self.compile_c(expr, env, d)
+            self.emit(Eval())
+
+    def compile_c(self, expr, env, d):
+        if isinstance(expr, W_EInt):
+            self.emit(Pushint(expr.ival))
+        elif isinstance(expr, W_EVar):
+            if expr.name in env:
+                self.emit(Push(d - env[expr.name]))
+            else:
+                self.emit(Pushglobal(self.progcc.global_name(expr.name)))
+        elif isinstance(expr, W_EConstr):
+            self.emit(Pushglobal(self.progcc.constr_name(expr.tag,
+                                                         expr.arity)))
+        elif saturated_constr(expr) is not None:
+            constr = saturated_constr(expr)
+            args = app_args(expr)
+            for i in xrange(len(args) - 1, -1, -1):
+                self.compile_c(args[i], env, d + len(args) - 1 - i)
+            self.emit(Pack(constr.tag, constr.arity))
+        elif isinstance(expr, W_EAp):
+            self.compile_c(expr.a, env, d)
+            self.compile_c(expr.f, env, d + 1)
+            self.emit(Mkap())
+        elif isinstance(expr, W_ELet):
+            new_env, n = self.compile_defns(expr, env, d)
+            self.compile_c(expr.expr, new_env, d + n)
+            self.emit(Slide(n))
+        elif isinstance(expr, W_ECase):
+            name, args = self.progcc.lift_case(self.name, expr, env)
+            call = W_EVar(name)
+            for arg in args:
+                call = W_EAp(call, W_EVar(arg))
+            self.compile_c(call, env, d)
+        else:
+            raise InterpError('compile_c(%s): not implemented' % expr.to_s())
+
+    # Build the bindings of a let or letrec above the d nodes on the
+    # stack. Returns the environment of its body and the number of
+    # bindings.
+    def compile_defns(self, expr, env, d):
+        n = len(expr.defns)
+        new_env = env.copy()
+        if expr.isrec:
+            self.emit(Alloc(n))
+            for i, (name, e) in enumerate(expr.defns):
+                new_env[name] = d + i + 1
+            for i, (name, e) in enumerate(expr.defns):
+                self.compile_c(e, new_env, d + n)
+                self.emit(Update(n - 1 - i))
+        else:
+            for i, (name, e) in enumerate(expr.defns):
+                self.compile_c(e, env, d + i)
+                new_env[name] = d + i + 1
+        return new_env, n
+
+    # Casejump to the alternatives of <expr>, whose scrutinee is on top.
+    # In the R scheme each one ends by unwinding, otherwise by jumping to
+    # <end_label> with its value on top.
+    def compile_alts(self, expr, env, d, tail, end_label):
+        labels = []
+        for alt in expr.alts:
+            while len(labels) <= alt.tag:
+                labels.append(-1)
+        self.emit(Casejump(labels))
+        for alt in expr.alts:
+            if labels[alt.tag] != -1:
+                continue
+            labels[alt.tag] = self.new_label()
+            self.emit(Label(labels[alt.tag]))
+            n = len(alt.components)
+            alt_env = env.copy()
+            for i, name in enumerate(alt.components):
+                alt_env[name] = d + n - i
+            self.emit(Split(n))
+            if tail:
+                self.compile_r(alt.body, alt_env, d + n)
+            else:
+                self.compile_e(alt.body, alt_env, d + n)
+                self.emit(Slide(n))
+                self.emit(Jump(end_label))
+
+    # The prim-op <expr> is a saturated application of, if any.
+    def prim_op(self, expr, env):
+        args = app_args(expr)
+        func = app_func(expr)
+        if (args and isinstance(func, W_EVar) and func.name not in env and
+                func.name in module.ops and
+                len(args) == module.ops[func.name].get_arity()):
+            return module.ops[func.name]
+        return None
+
+    def is_if(self, expr, env):
+        func = app_func(expr)
+        return (isinstance(func, W_EVar) and func.name == 'if' and
+                func.name not in env and len(app_args(expr)) == 3)
+
+    # Whether the R scheme should evaluate <expr> rather than build it.
+    def is_strict_value(self, expr, env):
+        return (isinstance(expr, W_EInt) or
+                self.prim_op(expr, env) is not None or
+                saturated_constr(expr) is not None)
+
+def app_func(expr):
+    while isinstance(expr, W_EAp):
+        expr = expr.f
+    return expr
+
+# The arguments of an application, first one first.
+def app_args(expr):
+    args = []
+    while isinstance(expr, W_EAp):
+        args.append(expr.a)
+        expr = expr.f
+    args.reverse()
+    return args
+
+def if_args(expr):
+    args = app_args(expr)
+    return args[0], args[1], args[2]
+
+# The constructor <expr> is a saturated application of, if any.
+def saturated_constr(expr):
+    func = app_func(expr)
+    if (isinstance(func, W_EConstr) and func.arity > 0 and
+            len(app_args(expr)) == func.arity):
+        return func
+    return None
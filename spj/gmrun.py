@@ -0,0 +1,596 @@
+from pypy.rlib.jit import JitDriver
+
+from spj.errors import InterpError
+from spj.language import W_Root, ppr
+from spj.config import TRACE_QUIET, TRACE_STAT, TRACE_STEP
+from spj.timrun import (Instr, Code, W_Value, W_Int, get_primop,
+                        compute_binop, binop_names)
+
+# The G-machine of the book (Mk6: a dump for Eval, arithmetic and if
+# compiled inline in strict contexts, and constructors), as a second
+# engine next to the TIM. It runs the code made by spj.gmc on a graph of
+# Nodes, with a single stack: the part of it below stackbase belongs to
+# the Evals on the dump.
+
+class Stat(W_Root):
+    def __init__(self):
+        self.nsteps = 0
+        self.nunwinds = 0
+        self.nevals = 0
+        self.nnodes_made = 0
+        self.nupdates = 0
+        self.max_stackdepth = 0
+        self.max_dumpdepth = 0
+
+    def ppr(self, p):
+        p.writeln('G-machine Stat @step %d:' % self.nsteps)
+        with p.block(2):
+            p.writeln('Number of unwinds: %d' % self.nunwinds)
+            p.writeln('Number of evals: %d' % self.nevals)
+            p.writeln('Number of nodes made: %d' % self.nnodes_made)
+            p.writeln('Number of updates: %d' % self.nupdates)
+            p.writeln('Max stackdepth/dump: %d/%d' %
+                      (self.max_stackdepth, self.max_dumpdepth))
+
+# Graph nodes. Update overwrites the root of a redex with its value by
+# setting ind, which every other node is read through.
+class Node(W_Root):
+    ind = None
+
+    def to_s(self):
+        return '#<Node>'
+
+class NNum(Node):
+    def __init__(self, ival):
+        self.ival = ival
+
+    def to_s(self):
+        return '#<NNum %d>' % self.ival
+
+class NAp(Node):
+    def __init__(self, f, a):
+        self.f = f
+        self.a = a
+
+    def to_s(self):
+        return '#<NAp>'
+
+class NGlobal(Node):
+    def __init__(self, name, arity, code):
+        self.name = name
+        self.arity = arity
+        self.code = code
+
+    def to_s(self):
+        return '#<NGlobal %s>' % self.name
+
+class NConstr(Node):
+    def __init__(self, tag, fields):
+        self.tag = tag
+        self.fields = fields # [Node]
+
+    def to_s(self):
+        return '#<NConstr %d>' % self.tag
+
+# Made by Alloc for a letrec binding, and updated with it.
+class NHole(Node):
+    def to_s(self):
+        return '#<NHole>'
+
+class DumpFrame(W_Root):
+    def __init__(self, code, pc, stackbase):
+        self.code = code
+        self.pc = pc
+        self.stackbase = stackbase
+
+    def to_s(self):
+        return '#<DumpFrame %s:%d @%d>' % (self.code.name, self.pc,
+                                            self.stackbase)
+
+def get_printable_location(pc, code):
+    return '%s:%d' % (code.name, pc)
+
+jitdriver = JitDriver(greens=['pc', 'code'], reds=['self'],
+                      get_printable_location=get_printable_location)
+
+class State(W_Root):
+    _immutable_fields_ = ['trace_level', 'trace_out']
+
+    def __init__(self, initcode, globals, trace_level=TRACE_QUIET,
+                 trace_out=None):
+        self.code = initcode
+        self.pc = 0
+        self.stack = []
+        self.stackbase = 0
+        self.dump = [] # [DumpFrame]
+        self.globals = globals # global index -> NGlobal
+        self.stat = Stat()
+        self.trace_level = trace_level
+        self.trace_out = trace_out
+
+    def ppr(self, p):
+        if self.is_final():
+            currinstr = 'X'
+        else:
+            currinstr = self.code.instr_at(self.pc).to_s()
+        p.writeln('G-machine state %s' % currinstr)
+        with p.block(2):
+            p.write('Stack: ')
+            p.writeln(self.stack)
+            p.write('Dump: ')
+            p.writeln(self.dump)
+            p.writeln(self.stat)
+
+    def is_final(self):
+        return self.pc >= len(self.code.ops)
+
+    def stack_push(self, node):
+        self.stack.append(node)
+        self.stat.max_stackdepth = max(len(self.stack),
+                                       self.stat.max_stackdepth)
+
+    def stack_pop(self):
+        if len(self.stack) <= self.stackbase:
+            raise InterpError('G-machine: empty stack')
+        return self.stack.pop()
+
+    # The node n places below the top.
+    def stack_ref(self, n):
+        i = len(self.stack) - 1 - n
+        if i < self.stackbase:
+            raise InterpError('G-machine: stack underflow')
+        return self.stack[i]
+
+    def stack_drop(self, n):
+        if len(self.stack) - n < self.stackbase:
+            raise InterpError('G-machine: stack underflow')
+        del self.stack[len(self.stack) - n:]
+
+    def mk_num(self, ival):
+        if SMALL_INT_MIN <= ival <= SMALL_INT_MAX:
+            return small_ints[ival - SMALL_INT_MIN]
+        self.stat.nnodes_made += 1
+        return NNum(ival)
+
+    def pop_int(self):
+        node = self.stack_pop()
+        if not isinstance(node, NNum):
+            raise InterpError('%s: not a number' % node.to_s())
+        return node.ival
+
+    def update(self, n):
+        node = self.stack_pop()
+        self.stat.nupdates += 1
+        self.stack_ref(n).ind = node
+
+    # Whether the node on top, which is replaced by its value if it has
+    # been updated, is in weak head normal form.
+    def whnf_on_top(self):
+        top = len(self.stack) - 1
+        node = self.stack[top]
+        while node.ind is not None:
+            node = node.ind
+        self.stack[top] = node
+        return isinstance(node, NNum) or isinstance(node, NConstr)
+
+    # Evaluate the node on top on a new stack, and carry on at <pc> with
+    # its value.
+    def eval_top(self, pc):
+        self.stat.nevals += 1
+        self.dump.append(DumpFrame(self.code, pc, self.stackbase))
+        self.stat.max_dumpdepth = max(len(self.dump),
+                                      self.stat.max_dumpdepth)
+        self.stackbase = len(self.stack) - 1
+        self.unwind()
+
+    # Unwind the spine on top of the stack until the code of a global
+    # can be run or a value returned to the Eval that asked for it.
+    def unwind(self):
+        while True:
+            self.stat.nunwinds += 1
+            top = len(self.stack) - 1
+            node = self.stack[top]
+            if node.ind is not None:
+                self.stack[top] = node.ind
+            elif isinstance(node, NAp):
+                self.stack_push(node.f)
+            elif isinstance(node, NGlobal):
+                if top - self.stackbase < node.arity:
+                    # A partial application: its root is the value.
+                    self.return_node(self.stack[self.stackbase])
+                else:
+                    self.rearrange(node.arity)
+                    self.code = node.code
+                    self.pc = 0
+                return
+            elif isinstance(node, NHole):
+                raise InterpError('G-machine: <<loop>>')
+            else:
+                self.return_node(node)
+                return
+
+    def return_node(self, node):
+        if not self.dump:
+            raise InterpError('Unwind: empty dump')
+        frame = self.dump.pop()
+        del self.stack[self.stackbase:]
+        self.stackbase = frame.stackbase
+        self.stack_push(node)
+        self.code = frame.code
+        self.pc = frame.pc
+
+    # Replace the global and the application nodes above the root of the
+    # redex by their arguments, the first one on top.
+    def rearrange(self, arity):
+        top = len(self.stack) - 1
+        for i in xrange(1, arity + 1):
+            ap = self.stack[top - i]
+            assert isinstance(ap, NAp)
+            self.stack[top - i + 1] = ap.a
+        # The root of the redex stays below them, for Update.
+
+    def eval(self):
+        self.run()
+        if self.trace_level >= TRACE_STEP:
+            ppr(self, self.trace_out)
+        elif self.trace_level >= TRACE_STAT:
+            ppr(self.stat, self.trace_out)
+        node = self.stack[len(self.stack) - 1]
+        while node.ind is not None:
+            node = node.ind
+        if isinstance(node, NConstr):
+            return W_NodeConstr(node.tag, node.fields)
+        if not isinstance(node, NNum):
+            raise InterpError('%s: not a value' % node.to_s())
+        return W_Int(node.ival)
+
+    def run(self):
+        code = self.code
+        pc = self.pc
+        while True:
+            jitdriver.jit_merge_point(pc=pc, code=code, self=self)
+            if pc >= len(code.ops):
+                break
+            if self.trace_level >= TRACE_STEP:
+                self.code = code
+                self.pc = pc
+                ppr(self, self.trace_out)
+            self.stat.nsteps += 1
+            ops = code.ops
+            op = ops[pc]
+            if op == GM_UNWIND:
+                self.unwind()
+                code = self.code
+                pc = self.pc
+                jitdriver.can_enter_jit(pc=pc, code=code, self=self)
+            elif op == GM_EVAL:
+                if self.whnf_on_top():
+                    pc += 1
+                else:
+                    self.code = code
+                    self.eval_top(pc + 1)
+                    code = self.code
+                    pc = self.pc
+            elif op == GM_PUSH:
+                self.stack_push(self.stack_ref(ops[pc + 1]))
+                pc += 2
+            elif op == GM_PUSHGLOBAL:
+                self.stack_push(self.globals[ops[pc + 1]])
+                pc += 2
+            elif op == GM_PUSHINT:
+                self.stack_push(self.mk_num(ops[pc + 1]))
+                pc += 2
+            elif op == GM_MKAP:
+                f = self.stack_pop()
+                a = self.stack_pop()
+                self.stat.nnodes_made += 1
+                self.stack_push(NAp(f, a))
+                pc += 1
+            elif op == GM_UPDATE:
+                self.update(ops[pc + 1])
+                pc += 2
+            elif op == GM_POP:
+                self.stack_drop(ops[pc + 1])
+                pc += 2
+            elif op == GM_SLIDE:
+                node = self.stack_pop()
+                self.stack_drop(ops[pc + 1])
+                self.stack_push(node)
+                pc += 2
+            elif op == GM_ALLOC:
+                for i in xrange(ops[pc + 1]):
+                    self.stat.nnodes_made += 1
+                    self.stack_push(NHole())
+                pc += 2
+            elif op == GM_BINOP:
+                a = self.pop_int()
+                b = self.pop_int()
+                self.stack_push(self.mk_num(compute_binop(ops[pc + 1], a,
+                                                          b)))
+                pc += 2
+            elif op == GM_PRIMOP:
+                prim_op = get_primop(ops[pc + 1])
+                args = [self.pop_int() for i in xrange(prim_op.get_arity())]
+                self.stack_push(self.mk_num(prim_op.compute(args)))
+                pc += 2
+            elif op == GM_JUMP_FALSE:
+                if self.pop_int() == 0:
+                    pc = ops[pc + 1]
+                else:
+                    pc += 2
+            elif op == GM_JUMP:
+                pc = ops[pc + 1]
+            elif op == GM_PACK:
+                nfields = ops[pc + 2]
+                fields = [self.stack_pop() for i in xrange(nfields)]
+                self.stat.nnodes_made += 1
+                self.stack_push(NConstr(ops[pc + 1], fields))
+                pc += 3
+            elif op == GM_CASEJUMP:
+                node = self.stack_ref(0)
+                if not isinstance(node, NConstr):
+                    raise InterpError('%s: not a constructor' % node.to_s())
+                tag = node.tag
+                nalts = ops[pc + 1]
+                target = -1
+                if 0 <= tag < nalts:
+                    target = ops[pc + 2 + tag]
+                if target < 0:
+                    raise InterpError('Casejump: no alternative for tag %d'
+                                      % tag)
+                pc = target
+            elif op == GM_SPLIT:
+                node = self.stack_pop()
+                assert isinstance(node, NConstr)
+                nfields = ops[pc + 1]
+                if nfields > len(node.fields):
+                    raise InterpError('case: %s has no field %d' %
+                                      (node.to_s(), nfields - 1))
+                for i in xrange(nfields - 1, -1, -1):
+                    self.stack_push(node.fields[i])
+                pc += 2
+            else:
+                raise InterpError('unknown G-machine opcode %d' % op)
+        self.code = code
+        self.pc = pc
+
+# A linked G-machine program, as made by spj.gmc.
+class Program(W_Root):
+    def __init__(self, initcode, globals, global_names, arities):
+        self.initcode = initcode
+        self.globals = globals # global index -> Code
+        self.global_names = global_names
+        self.arities = arities
+
+    # The globals are nodes that CAFs are updated in, so every run gets
+    # its own.
+    def mk_state(self, trace_level=TRACE_QUIET, trace_out=None):
+        nodes = [NGlobal(self.global_names[i], self.arities[i],
+                         self.globals[i])
+                 for i in xrange(len(self.globals))]
+        return State(self.initcode, nodes, trace_level, trace_out)
+
+class W_NodeConstr(W_Value):
+    def __init__(self, tag, fields):
+        self.tag = tag
+        self.fields = fields # [Node]
+
+    def to_s(self):
+        return '#<W_Constr %d [%s]>' % (self.tag, ', '.join(
+            [field.to_s() for field in self.fields]))
+
+# Jumps are resolved against the labels of the code they are in.
+class Assembler(object):
+    def __init__(self, global_indices):
+        self.global_indices = global_indices # name -> global index
+        self.labels = {} # label -> pc, in the code being assembled
+
+    def global_index(self, name):
+        return self.global_indices[name]
+
+    def label_pc(self, label):
+        return self.labels.get(label, -1)
+
+# Labels take no room, so a first pass finds where they are.
+def assemble(name, instrs, asm):
+    asm.labels = {}
+    ops = []
+    for instr in instrs:
+        if isinstance(instr, Label):
+            asm.labels[instr.n] = len(ops)
+        instr.encode(ops, asm)
+    ops = []
+    offsets = []
+    for instr in instrs:
+        if isinstance(instr, Label):
+            offsets.append(-1)
+        else:
+            offsets.append(len(ops))
+        instr.encode(ops, asm)
+    return Code(name, instrs, ops, offsets)
+
+# Opcodes
+GM_UNWIND = 0
+GM_EVAL = 1
+GM_PUSH = 2
+GM_PUSHGLOBAL = 3
+GM_PUSHINT = 4
+GM_MKAP = 5
+GM_UPDATE = 6
+GM_POP = 7
+GM_SLIDE = 8
+GM_ALLOC = 9
+GM_BINOP = 10
+GM_PRIMOP = 11
+GM_JUMP_FALSE = 12
+GM_JUMP = 13
+GM_PACK = 14
+GM_CASEJUMP = 15
+GM_SPLIT = 16
+
+class Unwind(Instr):
+    opcode = GM_UNWIND
+
+    def to_s(self):
+        return '#<Unwind>'
+
+class Eval(Instr):
+    opcode = GM_EVAL
+
+    def to_s(self):
+        return '#<Eval>'
+
+class Mkap(Instr):
+    opcode = GM_MKAP
+
+    def to_s(self):
+        return '#<Mkap>'
+
+# The instructions with a single integer operand.
+class IntInstr(Instr):
+    def __init__(self, n):
+        self.n = n
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.n)
+
+class Push(IntInstr):
+    opcode = GM_PUSH
+
+    def to_s(self):
+        return '#<Push %d>' % self.n
+
+class Pushint(IntInstr):
+    opcode = GM_PUSHINT
+
+    def to_s(self):
+        return '#<Pushint %d>' % self.n
+
+class Update(IntInstr):
+    opcode = GM_UPDATE
+
+    def to_s(self):
+        return '#<Update %d>' % self.n
+
+class Pop(IntInstr):
+    opcode = GM_POP
+
+    def to_s(self):
+        return '#<Pop %d>' % self.n
+
+class Slide(IntInstr):
+    opcode = GM_SLIDE
+
+    def to_s(self):
+        return '#<Slide %d>' % self.n
+
+class Alloc(IntInstr):
+    opcode = GM_ALLOC
+
+    def to_s(self):
+        return '#<Alloc %d>' % self.n
+
+class Split(IntInstr):
+    opcode = GM_SPLIT
+
+    def to_s(self):
+        return '#<Split %d>' % self.n
+
+# n is the opcode of a timrun.IntBinOp.
+class Binop(IntInstr):
+    opcode = GM_BINOP
+
+    def to_s(self):
+        return '#<Binop %s>' % binop_names[self.n]
+
+# n is the index of a prim-op in timrun.all_primops.
+class PrimOp(IntInstr):
+    opcode = GM_PRIMOP
+
+    def to_s(self):
+        return '#<PrimOp %s>' % get_primop(self.n).to_s()
+
+class Pushglobal(Instr):
+    opcode = GM_PUSHGLOBAL
+
+    def __init__(self, name):
+        self.name = name
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(asm.global_index(self.name))
+
+    def to_s(self):
+        return '#<Pushglobal %s>' % self.name
+
+class Pack(Instr):
+    opcode = GM_PACK
+
+    def __init__(self, tag, arity):
+        self.tag = tag
+        self.arity = arity
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.tag)
+        ops.append(self.arity)
+
+    def to_s(self):
+        return '#<Pack %d %d>' % (self.tag, self.arity)
+
+# Where a jump goes. It is not run and takes no room.
+class Label(Instr):
+    def __init__(self, n):
+        self.n = n
+
+    def encode(self, ops, asm):
+        pass
+
+    def to_s(self):
+        return 'L%d:' % self.n
+
+class Jump(Instr):
+    opcode = GM_JUMP
+
+    def __init__(self, label):
+        self.label = label
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(asm.label_pc(self.label))
+
+    def to_s(self):
+        return '#<Jump L%d>' % self.label
+
+# Pop an integer and jump if it is 0: the false branch of an if.
+class JumpFalse(Jump):
+    opcode = GM_JUMP_FALSE
+
+    def to_s(self):
+        return '#<JumpFalse L%d>' % self.label
+
+# Jump to the alternative for the tag of the constructor on top: labels
+# is indexed by tag, with -1 where there is none.
+class Casejump(Instr):
+    opcode = GM_CASEJUMP
+
+    def __init__(self, labels):
+        self.labels = labels
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(len(self.labels))
+        for label in self.labels:
+            if label < 0:
+                ops.append(-1)
+            else:
+                ops.append(asm.label_pc(label))
+
+    def to_s(self):
+        return '#<Casejump %s>' % ' '.join(
+            ['-' if label < 0 else 'L%d' % label for label in self.labels])
+
+SMALL_INT_MIN = -16
+SMALL_INT_MAX = 256
+small_ints = [NNum(i) for i in range(SMALL_INT_MIN, SMALL_INT_MAX + 1)]
@@ -0,0 +1,263 @@
+from spj import language
+from spj.errors import InterpError
+
+# A hand-written lexer and recursive descent parser for the same language
+# as spj.parser, building the same AST. As in its grammar
+#
+#   expr = expr aexpr | expr binop aexpr | aexpr | ...
+#
+# application and every binary operator share one precedence level and
+# associate to the left, and the right operand of an operator is an
+# aexpr: 1 + 2 * 3 is (1 + 2) * 3 and f 1 + f 2 is ((f 1) + f) 2.
+
+# Token kinds
+T_EOF = 0
+T_VAR = 1 # text is the name
+T_INT = 2
+T_KEYWORD = 3 # let letrec in case of Pack
+T_OP = 4 # a binary operator
+T_PUNCT = 5 # = ; , { } ( ) \ ->
+
+keywords = ['let', 'letrec', 'in', 'case', 'of', 'Pack']
+
+# Longest first, so that e.g. '<=' is not read as '<' '='.
+symbols = ['->', '<=', '>=', '==', '/=', '&&', '||',
+           '+', '-', '*', '/', '<', '>', '.',
+           '=', ';', ',', '{', '}', '(', ')', '\\']
+
+binops = ['||', '&&', '==', '/=', '<', '<=', '>', '>=',
+          '+', '-', '*', '/', '.']
+
+class Token(object):
+    def __init__(self, kind, text, line):
+        self.kind = kind
+        self.text = text
+        self.line = line
+
+    def to_s(self):
+        if self.kind == T_EOF:
+            return 'end of input'
+        return "'%s'" % self.text
+
+def is_name_start(c):
+    return c == '_' or 'a' <= c <= 'z' or 'A' <= c <= 'Z'
+
+def is_name_char(c):
+    return is_name_start(c) or '0' <= c <= '9' or c == "'"
+
+def is_digit(c):
+    return '0' <= c <= '9'
+
+def match_symbol(source, i):
+    for sym in symbols:
+        if source[i:i + len(sym)] == sym:
+            return sym
+    return None
+
+def tokenize(source):
+    tokens = []
+    line = 1
+    i = 0
+    n = len(source)
+    while i < n:
+        c = source[i]
+        if c == '\n':
+            line += 1
+            i += 1
+        elif c == ' ' or c == '\t' or c == '\r':
+            i += 1
+        elif c == '-' and i + 1 < n and source[i + 1] == '-':
+            while i < n and source[i] != '\n':
+                i += 1
+        elif is_digit(c):
+            start = i
+            while i < n and is_digit(source[i]):
+                i += 1
+            tokens.append(Token(T_INT, source[start:i], line))
+        elif is_name_start(c):
+            start = i
+            while i < n and is_name_char(source[i]):
+                i += 1
+            text = source[start:i]
+            if text in keywords:
+                tokens.append(Token(T_KEYWORD, text, line))
+            elif 'a' <= c <= 'z' or c == '_':
+                tokens.append(Token(T_VAR, text, line))
+            else:
+                raise InterpError('line %d: unexpected name %s' %
+                                  (line, text))
+        else:
+            sym = match_symbol(source, i)
+            if sym is None:
+                raise InterpError('line %d: unexpected character %s' %
+                                  (line, c))
+            if sym in binops:
+                tokens.append(Token(T_OP, sym, line))
+            else:
+                tokens.append(Token(T_PUNCT, sym, line))
+            i += len(sym)
+    tokens.append(Token(T_EOF, '', line))
+    return tokens
+
+class Parser(object):
+    def __init__(self, source):
+        self.tokens = tokenize(source)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def next(self):
+        tok = self.tokens[self.pos]
+        if tok.kind != T_EOF:
+            self.pos += 1
+        return tok
+
+    def at(self, kind, text):
+        tok = self.tokens[self.pos]
+        return tok.kind == kind and tok.text == text
+
+    def error(self, expected):
+        tok = self.peek()
+        raise InterpError('line %d: expected %s, got %s' %
+                          (tok.line, expected, tok.to_s()))
+
+    def expect(self, kind, text):
+        if not self.at(kind, text):
+            self.error("'%s'" % text)
+        self.next()
+
+    def skip_semicolons(self):
+        self.expect(T_PUNCT, ';')
+        while self.at(T_PUNCT, ';'):
+            self.next()
+
+    def program(self):
+        scs = [self.scdefn()]
+        while self.peek().kind != T_EOF:
+            scs.append(self.scdefn())
+        return scs
+
+    def scdefn(self):
+        name = self.varname()
+        args = []
+        while not self.at(T_PUNCT, '='):
+            args.append(self.varname())
+        self.next()
+        body = self.expr()
+        self.skip_semicolons()
+        return language.W_ScDefn(name, args, body)
+
+    # A variable, or an operator in parentheses.
+    def varname(self):
+        tok = self.peek()
+        if tok.kind == T_VAR:
+            self.next()
+            return tok.text
+        if (tok.kind == T_PUNCT and tok.text == '(' and
+                self.tokens[self.pos + 1].kind == T_OP and
+                self.tokens[self.pos + 2].text == ')'):
+            self.pos += 3
+            return self.tokens[self.pos - 2].text
+        self.error('a variable')
+        return ''
+
+    def expr(self):
+        if self.at(T_KEYWORD, 'let') or self.at(T_KEYWORD, 'letrec'):
+            isrec = self.next().text == 'letrec'
+            defns = [self.defn()]
+            while not self.at(T_KEYWORD, 'in'):
+                defns.append(self.defn())
+            self.next()
+            return language.W_ELet(defns, self.expr(), isrec)
+        elif self.at(T_KEYWORD, 'case'):
+            self.next()
+            scrutinee = self.expr()
+            self.expect(T_KEYWORD, 'of')
+            alts = [self.alt()]
+            while self.at(T_OP, '<'):
+                alts.append(self.alt())
+            return language.W_ECase(scrutinee, alts)
+        elif self.at(T_PUNCT, '\\'):
+            self.next()
+            args = [self.varname()]
+            while not self.at(T_PUNCT, '->'):
+                args.append(self.varname())
+            self.next()
+            return language.W_ELam(args, self.expr())
+        return self.flat_expr()
+
+    # Applications and binary operators, left to right.
+    def flat_expr(self):
+        expr = self.aexpr()
+        while True:
+            if self.starts_aexpr():
+                expr = language.W_EAp(expr, self.aexpr())
+            elif self.peek().kind == T_OP:
+                op = self.next().text
+                expr = language.W_EAp(language.W_EAp(
+                    language.W_EPrimOp(op), expr), self.aexpr())
+            else:
+                return expr
+
+    def starts_aexpr(self):
+        tok = self.peek()
+        return (tok.kind == T_VAR or tok.kind == T_INT or
+                (tok.kind == T_KEYWORD and tok.text == 'Pack') or
+                (tok.kind == T_PUNCT and tok.text == '('))
+
+    def aexpr(self):
+        tok = self.peek()
+        if tok.kind == T_VAR:
+            self.next()
+            return language.W_EVar(tok.text)
+        elif tok.kind == T_INT:
+            self.next()
+            return language.W_EInt(int(tok.text))
+        elif tok.kind == T_KEYWORD and tok.text == 'Pack':
+            self.next()
+            self.expect(T_PUNCT, '{')
+            tag = self.integer()
+            self.expect(T_PUNCT, ',')
+            arity = self.integer()
+            self.expect(T_PUNCT, '}')
+            return language.W_EConstr(tag, arity)
+        elif tok.kind == T_PUNCT and tok.text == '(':
+            if (self.tokens[self.pos + 1].kind == T_OP and
+                    self.tokens[self.pos + 2].text == ')'):
+                return language.W_EVar(self.varname())
+            self.next()
+            expr = self.expr()
+            self.expect(T_PUNCT, ')')
+            return expr
+        self.error('an expression')
+        return None
+
+    def integer(self):
+        tok = self.peek()
+        if tok.kind != T_INT:
+            self.error('an integer')
+        self.next()
+        return int(tok.text)
+
+    def defn(self):
+        name = self.varname()
+        self.expect(T_PUNCT, '=')
+        expr = self.expr()
+        self.skip_semicolons()
+        return (name, expr)
+
+    def alt(self):
+        self.expect(T_OP, '<')
+        tag = self.integer()
+        self.expect(T_OP, '>')
+        components = []
+        while not self.at(T_PUNCT, '->'):
+            components.append(self.varname())
+        self.next()
+        body = self.expr()
+        self.expect(T_PUNCT, ';')
+        return language.W_EAlt(tag, components, body)
+
+def read_program(source):
+    return Parser(source).program()
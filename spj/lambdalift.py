@@ -0,0 +1,175 @@
+from spj.language import (W_ScDefn, W_EAp, W_EInt, W_EVar, W_ELet, W_ECase,
+                          W_EConstr, W_EAlt, W_ELam)
+
+# Fully lazy lambda lifting, after chapter 6 of the book. Lambdas are
+# lifted innermost first. Before a lambda is lifted, the maximal
+# subexpressions of its body that use none of the variables bound inside
+# it are let-bound just outside it, so that they are computed once
+# rather than on every application. The lambda then becomes a new
+# supercombinator taking its free local variables as extra leading
+# arguments, and is replaced by a partial application of it.
+#
+# Generated names contain a '$', which the parser never accepts, so they
+# cannot clash with the program's own.
+
+def lift_program(prog):
+    lifter = LambdaLifter()
+    for sc in prog:
+        lifter.lift_sc(sc)
+    return lifter.scs
+
+class LambdaLifter(object):
+    def __init__(self):
+        self.scs = [] # the program, with lifted supercombinators added
+        self.sc_name = '?'
+        self.nlambdas = 0
+        self.nfloated = 0
+
+    def lift_sc(self, sc):
+        self.sc_name = sc.name
+        self.nlambdas = 0
+        self.nfloated = 0
+        scope = {}
+        for arg in sc.args:
+            scope[arg] = None
+        body = self.lift(sc.body, scope)
+        self.scs.append(W_ScDefn(sc.name, sc.args, body))
+
+    # Return <expr> without lambdas. <scope> holds the local variables
+    # in scope, everything else being a global.
+    def lift(self, expr, scope):
+        if isinstance(expr, W_EAp):
+            return W_EAp(self.lift(expr.f, scope), self.lift(expr.a, scope))
+        elif isinstance(expr, W_ELet):
+            new_scope = extend_scope(scope, [name for (name, _) in
+                                             expr.defns])
+            if expr.isrec:
+                defn_scope = new_scope
+            else:
+                defn_scope = scope
+            defns = [(name, self.lift(e, defn_scope))
+                     for (name, e) in expr.defns]
+            return W_ELet(defns, self.lift(expr.expr, new_scope), expr.isrec)
+        elif isinstance(expr, W_ECase):
+            alts = [W_EAlt(alt.tag, alt.components,
+                           self.lift(alt.body,
+                                     extend_scope(scope, alt.components)))
+                    for alt in expr.alts]
+            return W_ECase(self.lift(expr.expr, scope), alts)
+        elif isinstance(expr, W_ELam):
+            return self.lift_lambda(expr, scope)
+        return expr
+
+    def lift_lambda(self, expr, scope):
+        body = self.lift(expr.body, extend_scope(scope, expr.args))
+        inner = {}
+        for arg in expr.args:
+            inner[arg] = None
+        floats = []
+        body = self.float_mfes(body, inner, floats)
+
+        fvs = {}
+        free_vars(body, {}, fvs)
+        lifted_args = []
+        for name in fvs.keys():
+            if name in scope and name not in inner:
+                lifted_args.append(name)
+        for (name, _) in floats:
+            if name in fvs:
+                lifted_args.append(name)
+        lifted_args.sort()
+
+        self.nlambdas += 1
+        name = '%s$lam%d' % (self.sc_name, self.nlambdas)
+        self.scs.append(W_ScDefn(name, lifted_args + expr.args, body))
+        res = W_EVar(name)
+        for arg in lifted_args:
+            res = W_EAp(res, W_EVar(arg))
+        if floats:
+            res = W_ELet(floats, res, False)
+        return res
+
+    # Replace the maximal free expressions of <expr> by fresh variables
+    # and append their bindings to <floats>. <inner> holds the variables
+    # bound inside the lambda being lifted.
+    def float_mfes(self, expr, inner, floats):
+        if is_floatable(expr):
+            fvs = {}
+            free_vars(expr, {}, fvs)
+            free = True
+            for name in fvs.keys():
+                if name in inner:
+                    free = False
+                    break
+            if free:
+                self.nfloated += 1
+                name = '%s$mfe%d' % (self.sc_name, self.nfloated)
+                floats.append((name, expr))
+                return W_EVar(name)
+        if isinstance(expr, W_EAp):
+            return W_EAp(self.float_mfes(expr.f, inner, floats),
+                         self.float_mfes(expr.a, inner, floats))
+        elif isinstance(expr, W_ELet):
+            new_inner = extend_scope(inner, [name for (name, _) in
+                                             expr.defns])
+            if expr.isrec:
+                defn_inner = new_inner
+            else:
+                defn_inner = inner
+            defns = [(name, self.float_mfes(e, defn_inner, floats))
+                     for (name, e) in expr.defns]
+            return W_ELet(defns, self.float_mfes(expr.expr, new_inner,
+                                                 floats), expr.isrec)
+        elif isinstance(expr, W_ECase):
+            alts = [W_EAlt(alt.tag, alt.components,
+                           self.float_mfes(alt.body,
+                                           extend_scope(inner,
+                                                        alt.components),
+                                           floats))
+                    for alt in expr.alts]
+            return W_ECase(self.float_mfes(expr.expr, inner, floats), alts)
+        return expr
+
+# Only work can be shared: atoms are not, and neither are applications
+# of a lifted supercombinator to its free variables, which are no more
+# than partial applications.
+def is_floatable(expr):
+    if isinstance(expr, W_ELet) or isinstance(expr, W_ECase):
+        return True
+    if not isinstance(expr, W_EAp):
+        return False
+    func = expr
+    while isinstance(func, W_EAp):
+        if not isinstance(func.a, W_EVar):
+            return True
+        func = func.f
+    return not (isinstance(func, W_EVar) and func.name.find('$lam') >= 0)
+
+# Add the free variables of <expr>, globals included, to <fvs>.
+def free_vars(expr, bound, fvs):
+    if isinstance(expr, W_EVar):
+        if expr.name not in bound:
+            fvs[expr.name] = None
+    elif isinstance(expr, W_EAp):
+        free_vars(expr.f, bound, fvs)
+        free_vars(expr.a, bound, fvs)
+    elif isinstance(expr, W_ELet):
+        new_bound = extend_scope(bound, [name for (name, _) in expr.defns])
+        for (_, e) in expr.defns:
+            if expr.isrec:
+                free_vars(e, new_bound, fvs)
+            else:
+                free_vars(e, bound, fvs)
+        free_vars(expr.expr, new_bound, fvs)
+    elif isinstance(expr, W_ECase):
+        free_vars(expr.expr, bound, fvs)
+        for alt in expr.alts:
+            free_vars(alt.body, extend_scope(bound, alt.components), fvs)
+    elif isinstance(expr, W_ELam):
+        free_vars(expr.body, extend_scope(bound, expr.args), fvs)
+
+def extend_scope(scope, names):
+    new_scope = scope.copy()
+    for name in names:
+        new_scope[name] = None
+    return new_scope
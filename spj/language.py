@@ -130,6 +130,22 @@ class W_EConstr(W_Expr):
     def ppr(self, p):
         p.write('Pack{%d, %d}' % (self.tag, self.arity))
 
+# Removed by spj.lambdalift before compiling.
+class W_ELam(W_Expr):
+    def __init__(self, args, body):
+        self.args = args
+        self.body = body
+
+    def to_s(self):
+        return '#<ELam %s>' % ' '.join(self.args)
+
+    def ppr(self, p):
+        p.write('(\\')
+        p.write(' '.join(self.args))
+        p.write(' -> ')
+        p.write(self.body)
+        p.write(')')
+
 class W_EAlt(W_Expr):
     def __init__(self, tag, components, body):
         self.tag = tag
@@ -0,0 +1,207 @@
+import os
+
+from pypy.rlib.rarithmetic import r_uint, intmask
+
+from spj.errors import InterpError
+from spj.utils import stdout
+
+# Parallel evaluation of the closures sparked by par, for State.run. A
+# spark goes into a pool; whenever a worker slot is free, the oldest
+# spark that is still an unevaluated thunk is handed to a new process
+# forked off for it, which evaluates it on its copy of the heap and sends
+# its integer value back through a pipe. Meanwhile the closure's code is
+# <await_code>: entering it waits for the worker and then updates the
+# closure with the value, or gives it its own code back if the worker
+# could not compute one. Workers evaluate their sparks sequentially.
+# A spark that prints fails in its worker, whose output would be lost,
+# so that the parent prints it when it evaluates the spark itself.
+#
+# A worker's message is a status byte, 'v' for a value or 'x' for a
+# failure, then the value and the number of steps taken, 8 bytes each.
+
+MSG_SIZE = 17
+SIGKILL = 9
+
+class Worker(object):
+    def __init__(self, index):
+        self.index = index
+        self.nsparks = 0 # sparks evaluated
+        self.nsteps = 0
+        self.nfailed = 0
+        # The spark being evaluated, if any, and the process doing it.
+        self.closure = None
+        self.code = None # the closure's own code
+        self.pid = 0
+        self.fd = -1
+
+    def is_busy(self):
+        return self.closure is not None
+
+class Scheduler(object):
+    def __init__(self, nworkers, await_code):
+        self.workers = [Worker(i) for i in xrange(nworkers)]
+        self.await_code = await_code
+        self.pool = [] # sparked closures not handed to a worker yet
+        self.in_worker = False
+        self.nsparks = 0
+        self.nstarted = 0
+        self.nfizzled = 0 # already evaluated when a worker was free
+        self.nwaited = 0 # entered before their worker was done
+        self.ncancelled = 0 # still running when the program was done
+
+    def spark(self, state, cl):
+        if self.in_worker:
+            return
+        self.nsparks += 1
+        self.pool.append(cl)
+        self.schedule(state)
+
+    # Reap the workers that are done and give the free ones new sparks.
+    def schedule(self, state):
+        for worker in self.workers:
+            if worker.is_busy():
+                pid, status = os.waitpid(worker.pid, os.WNOHANG)
+                if pid != 0:
+                    self.finish_worker(state, worker, True)
+        for worker in self.workers:
+            if worker.is_busy():
+                continue
+            cl = self.next_spark(state)
+            if cl is None:
+                return
+            self.start_worker(state, worker, cl)
+
+    def next_spark(self, state):
+        while self.pool:
+            cl = self.pool.pop(0)
+            if state.is_unevaluated(cl):
+                return cl
+            self.nfizzled += 1
+        return None
+
+    def start_worker(self, state, worker, cl):
+        state.flush_trace()
+        stdout.flush()
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            self.run_worker(state, cl, w)
+        os.close(w)
+        self.nstarted += 1
+        worker.closure = cl
+        worker.code = cl.code
+        worker.pid = pid
+        worker.fd = r
+        cl.code = self.await_code
+
+    # In the forked process: evaluate <cl>, write the message to <fd> and
+    # exit without returning. Whatever goes wrong, the parent's handlers
+    # must not run here, so any exception is reported as a failure.
+    def run_worker(self, state, cl, fd):
+        msg = 'x' + pack_int(0) + pack_int(0)
+        try:
+            self.in_worker = True
+            self.pool = []
+            for worker in self.workers:
+                if worker.is_busy():
+                    os.close(worker.fd)
+            stdout.refuse_writes('par: a spark cannot print')
+            ival = state.eval_spark(cl)
+            msg = 'v' + pack_int(ival) + pack_int(state.stat.nsteps)
+        except Exception:
+            msg = 'x' + pack_int(0) + pack_int(state.stat.nsteps)
+        finally:
+            try:
+                write_all(fd, msg)
+            finally:
+                os._exit(0)
+
+    # <cl> was entered while a worker evaluates it.
+    def wait_for(self, state, cl):
+        for worker in self.workers:
+            if worker.closure is cl:
+                if self.in_worker:
+                    # Sparked before this worker was forked: the value
+                    # goes to the parent, so compute it here too.
+                    cl.code = worker.code
+                else:
+                    self.nwaited += 1
+                    self.finish_worker(state, worker, False)
+                    self.schedule(state)
+                return
+        raise InterpError('par: no worker evaluates %s' % cl.to_s())
+
+    def finish_worker(self, state, worker, reaped):
+        msg = read_all(worker.fd)
+        os.close(worker.fd)
+        if not reaped:
+            os.waitpid(worker.pid, 0)
+        cl = worker.closure
+        code = worker.code
+        worker.closure = None
+        worker.code = None
+        worker.pid = 0
+        worker.fd = -1
+        worker.nsparks += 1
+        if len(msg) != MSG_SIZE:
+            worker.nfailed += 1
+            cl.code = code
+            return
+        worker.nsteps += unpack_int(msg, 9)
+        if msg[0] == 'v':
+            state.spark_value(cl, unpack_int(msg, 1))
+        else:
+            worker.nfailed += 1
+            cl.code = code
+
+    # Stop the workers whose values are no longer needed.
+    def finish(self):
+        if self.in_worker:
+            return
+        for worker in self.workers:
+            if worker.is_busy():
+                self.ncancelled += 1
+                os.kill(worker.pid, SIGKILL)
+                os.waitpid(worker.pid, 0)
+                os.close(worker.fd)
+                worker.closure.code = worker.code
+                worker.closure = None
+                worker.code = None
+                worker.pid = 0
+                worker.fd = -1
+        self.pool = []
+
+    def write_report(self, out):
+        out.write('Sparks: %d made, %d run, %d fizzled, %d waited for, '
+                  '%d cancelled\n' % (self.nsparks, self.nstarted,
+                                      self.nfizzled, self.nwaited,
+                                      self.ncancelled))
+        for worker in self.workers:
+            out.write('  Worker %d: %d sparks, %d steps, %d failed\n' % (
+                worker.index, worker.nsparks, worker.nsteps,
+                worker.nfailed))
+
+def pack_int(ival):
+    u = r_uint(ival)
+    return ''.join([chr(intmask((u >> (i * 8)) & 0xff)) for i in range(8)])
+
+def unpack_int(s, pos):
+    u = r_uint(0)
+    for i in xrange(8):
+        u |= r_uint(ord(s[pos + i])) << (i * 8)
+    return intmask(u)
+
+def write_all(fd, s):
+    while s:
+        n = os.write(fd, s)
+        s = s[n:]
+
+def read_all(fd):
+    chunks = []
+    while True:
+        data = os.read(fd, 4096)
+        if not data:
+            break
+        chunks.append(data)
+    return ''.join(chunks)
@@ -42,7 +42,7 @@ def mk_constr(tag, arity):
     return language.W_EConstr(tag, arity)
 
 def mk_lambda(lhs, rhs):
-    raise NotImplementedError
+    return language.W_ELam(lhs, rhs)
 
 class Parser(PackratParser):
     r"""
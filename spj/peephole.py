@@ -0,0 +1,80 @@
+from spj.errors import InterpError
+from spj.timrun import (Enter, Return, Cond, Call, PushArg, PushCode, Move,
+                        PushVInt, IntBinOp, EnterArg, MoveCode, PushVIntOp,
+                        ReturnConstr, Switch)
+
+# Peephole passes over the instruction lists made by spj.timc. Each pass
+# takes a code list and returns a new one; the lists shared with
+# spj.primitive are never modified.
+
+def is_jump(instr):
+    return (isinstance(instr, Enter) or isinstance(instr, Return) or
+            isinstance(instr, Cond) or isinstance(instr, Call) or
+            isinstance(instr, EnterArg) or isinstance(instr, ReturnConstr) or
+            isinstance(instr, Switch))
+
+# Nothing after a control transfer is ever run, e.g. the Return that
+# compile_b leaves after the Cond of an inlined if.
+def drop_dead_code(code):
+    for i in xrange(len(code)):
+        if is_jump(code[i]):
+            return code[:i + 1]
+    return code
+
+def fuse_pairs(code, fuse):
+    out = []
+    i = 0
+    while i < len(code):
+        if i + 1 < len(code):
+            fused = fuse(code[i], code[i + 1])
+            if fused is not None:
+                out.append(fused)
+                i += 2
+                continue
+        out.append(code[i])
+        i += 1
+    return out
+
+def fuse_enter_arg_pair(a, b):
+    if isinstance(a, PushArg) and isinstance(b, Enter):
+        return EnterArg(a.k)
+    return None
+
+def fuse_enter_arg(code):
+    return fuse_pairs(code, fuse_enter_arg_pair)
+
+def fuse_move_code_pair(a, b):
+    if isinstance(a, PushCode) and isinstance(b, Move):
+        return MoveCode(a.n, b.i)
+    return None
+
+def fuse_move_code(code):
+    return fuse_pairs(code, fuse_move_code_pair)
+
+def fuse_vint_op_pair(a, b):
+    if isinstance(a, PushVInt) and isinstance(b, IntBinOp):
+        return PushVIntOp(a.ival, b.opcode)
+    return None
+
+def fuse_vint_op(code):
+    return fuse_pairs(code, fuse_vint_op_pair)
+
+passes = [('dce', drop_dead_code),
+          ('enter-arg', fuse_enter_arg),
+          ('move-code', fuse_move_code),
+          ('vint-op', fuse_vint_op)]
+
+def all_pass_names():
+    return [name for (name, _) in passes]
+
+def check_pass_names(names):
+    known = all_pass_names()
+    for name in names:
+        if name not in known:
+            raise InterpError('%s: unknown peephole pass' % name)
+
+def optimise(code, enabled):
+    for (name, run_pass) in passes:
+        if name in enabled:
+            code = run_pass(code)
+    return code
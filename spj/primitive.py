@@ -1,12 +1,11 @@
-import functools
-
-from pypy.rlib.objectmodel import specialize
 from pypy.rlib.unroll import unrolling_iterable
 
 from spj.errors import InterpError
-#from spj.utils import write_str
-from spj.timrun import (BasePrimOp, Take, PushCode, PushArg, Enter,
-                        Return, Cond, W_Value, W_Int)
+from spj.utils import stdout
+from spj.timrun import (BasePrimOp, IntBinOp, Take, PushCode, PushArg, Enter,
+                        Return, Cond, Spark, ReturnConstr, Switch, MoveData,
+                        OP_ADD, OP_SUB, OP_MUL, OP_DIV, OP_LT,
+                        OP_LE, OP_GT, OP_GE, OP_EQ, OP_NE)
 
 class PrimOpManager(object):
     def __init__(self):
@@ -14,25 +13,28 @@ class PrimOpManager(object):
         self.ops = {}
         self.scs = {}
         self.codefrags = []
+        self.codefrag_owners = [] # the prim-op each fragment belongs to
 
     def add_op(self, name, prim_op):
         "NOT_RPYTHON"
         self.ops[name] = prim_op
 
-    def add_codefrag(self, code):
+    def add_codefrag(self, code, owner):
         "NOT_RPYTHON"
         i = len(self.codefrags)
         self.codefrags.append(code)
+        self.codefrag_owners.append(owner)
         return i
 
     def add_sc(self, name, sc):
         "NOT_RPYTHON"
         self.scs[name] = sc
 
-def mk_prim_op(name, func, argtypes):
+# Prim-ops take and return raw integers on the vstack.
+def mk_prim_op(name, func, arity):
     "NOT_RPYTHON"
     func._always_inline_ = True
-    arity = len(argtypes)
+    argrange = unrolling_iterable(range(arity))
     #
     class PrimOp(BasePrimOp):
         def to_s(self):
@@ -41,92 +43,67 @@ def mk_prim_op(name, func, argtypes):
         def get_arity(self):
             return arity
 
-        def call(self, state, args_w):
-            assert len(args_w) == arity
-            for i, argtype in enumerate(argtypes):
-                w_arg = args_w[i]
-                if not isinstance(w_arg, argtype):
-                    raise InterpError('%s: type error' % self.to_s())
-            w_result = func(args_w)
-            return w_result
+        def apply(self, state):
+            if state.vstack_depth() < arity:
+                raise InterpError('%s: not enough argument' % self.to_s())
+            args = ()
+            for i in argrange:
+                args += (state.vstack_pop(), )
+            state.vstack_push(int(func(*args)))
+
+        def compute(self, args):
+            argtuple = ()
+            for i in argrange:
+                argtuple += (args[i], )
+            return int(func(*argtuple))
     #
     PrimOp.__name__ = 'PrimOp:%s' % name
     return PrimOp()
 
 module = PrimOpManager()
 
-def register(name, argtypes, make_func=True):
+def make_prim_sc(name, prim_op):
+    "NOT_RPYTHON"
+    # Evaluate the arguments one by one onto the vstack, then run the op.
+    arity = prim_op.get_arity()
+    if arity == 2:
+        auxcode1 = [prim_op, Return()]
+        i1 = module.add_codefrag(auxcode1, name)
+        auxcode2 = [PushCode(i1), PushArg(0), Enter()]
+        i2 = module.add_codefrag(auxcode2, name)
+        sc = [Take(2), PushCode(i2), PushArg(1), Enter()]
+    elif arity == 1:
+        auxcode1 = [prim_op, Return()]
+        i1 = module.add_codefrag(auxcode1, name)
+        sc = [Take(1), PushCode(i1), PushArg(0), Enter()]
+    else:
+        assert 0, 'dont know how to make sc for %s' % prim_op.to_s()
+    module.add_sc(name, sc)
+
+def register(name, arity, make_func=True):
     "NOT_RPYTHON"
-    # MAGIC!
-    arity = len(argtypes)
-    arityrange = range(arity)
-    unboxers = [make_unboxer(arg) for arg in argtypes]
-    ipairs = unrolling_iterable(zip(arityrange, unboxers))
     def decorator(function):
         "NOT_RPYTHON"
-        @functools.wraps(function)
-        def wrapped_func(args):
-            assert len(args) == arity
-            tupleargs = ()
-            for i, unboxer in ipairs:
-                x = args[i]
-                assert isinstance(x, argtypes[i])
-                tupleargs += (unboxers[i](x), )
-            result = function(*tupleargs)
-            return box(result)
-        prim_op = mk_prim_op(name, wrapped_func, argtypes)
+        prim_op = mk_prim_op(name, function, arity)
         module.add_op(name, prim_op)
         if make_func:
-            if argtypes == [W_Int, W_Int]:
-                auxcode1 = [prim_op, Return()]
-                i1 = module.add_codefrag(auxcode1)
-                auxcode2 = [PushCode(i1), PushArg(0), Enter()]
-                i2 = module.add_codefrag(auxcode2)
-                sc = [Take(2), PushCode(i2), PushArg(1), Enter()]
-            elif argtypes == [W_Int]:
-                auxcode1 = [prim_op, Return()]
-                i1 = module.add_codefrag(auxcode1)
-                sc = [Take(1), PushCode(i1), PushArg(0), Enter()]
-            else:
-                assert 0, 'dont know how to make sc for %s' % prim_op.to_s()
-            module.add_sc(name, sc)
+            make_prim_sc(name, prim_op)
         return prim_op
     return decorator
 
-def make_unboxer(value_type):
+def add_binary_op(name, opcode):
     "NOT_RPYTHON"
-    if value_type == W_Int:
-        return lambda w_int: w_int.ival
-    if value_type == W_Value:
-        return lambda w_val: w_val
-    else:
-        assert 0, 'dont know how to unwrap this type: %s' % value_type
+    prim_op = IntBinOp(opcode)
+    module.add_op(name, prim_op)
+    make_prim_sc(name, prim_op)
 
-@specialize.argtype(0)
-def box(v):
-    if isinstance(v, int): # including bool
-        return W_Int(v)
-    elif isinstance(v, W_Value):
-        return v
-    assert 0
+for name, opcode in [('+', OP_ADD), ('-', OP_SUB), ('*', OP_MUL),
+                     ('/', OP_DIV), ('<', OP_LT), ('<=', OP_LE),
+                     ('>', OP_GT), ('>=', OP_GE), ('==', OP_EQ),
+                     ('/=', OP_NE)]:
+    add_binary_op(name, opcode)
 
-def mk_binary_op(name, py_op, value_types):
-    "NOT_RPYTHON"
-    code = '''
-def wrap(a, b):
-    return a %(py_op)s b ''' % locals()
-    d = {}
-    exec code in d
-    f = d['wrap']
-    f._always_inline_ = True
-    register(name, value_types)(f)
-
-for name in '+ - * / < <= > >= =='.split():
-    mk_binary_op(name, name, [W_Int, W_Int])
-
-mk_binary_op('/=', '!=', [W_Int, W_Int])
-
-@register('negate', [W_Int])
+@register('negate', 1)
 def int_negate(a):
     return -a
 
@@ -134,13 +111,91 @@ def int_negate(a):
 def add_if():
     true_code = [PushArg(1), Enter()]
     false_code = [PushArg(2), Enter()]
-    i1 = module.add_codefrag(true_code)
-    i2 = module.add_codefrag(false_code)
+    i1 = module.add_codefrag(true_code, 'if')
+    i2 = module.add_codefrag(false_code, 'if')
 
     cond_code = [Cond(i1, i2)]
-    i0 = module.add_codefrag(cond_code)
+    i0 = module.add_codefrag(cond_code, 'if')
 
     sc = [Take(3), PushCode(i0), PushArg(0), Enter()]
     module.add_sc('if', sc)
 add_if()
 
+# par x y = y, with x sparked: the scheduler of spj.par may evaluate it in
+# another process while y is computed.
+def add_par():
+    sc = [Take(2), Spark(0), PushArg(1), Enter()]
+    module.add_sc('par', sc)
+add_par()
+
+# Lists: nil is Pack{1,0} and cons Pack{2,2}.
+#
+#   casePair xs consf nilv = case xs of <1> -> nilv; <2> h t -> consf h t
+def add_pairs():
+    module.add_sc('nil', [Take(0), ReturnConstr(1)])
+    module.add_sc('cons', [Take(2), ReturnConstr(2)])
+    nil_code = [PushArg(2), Enter()]
+    cons_code = [MoveData(0, 3), MoveData(1, 4), PushArg(4), PushArg(3),
+                 PushArg(1), Enter()]
+    i1 = module.add_codefrag(nil_code, 'casePair')
+    i2 = module.add_codefrag(cons_code, 'casePair')
+    i0 = module.add_codefrag([Switch([-1, i1, i2])], 'casePair')
+    sc = [Take(5, 3), PushCode(i0), PushArg(0), Enter()]
+    module.add_sc('casePair', sc)
+add_pairs()
+
+# Prim-ops run for their output, which goes to the buffered
+# spj.utils.stdout. They are not in module.ops: programs only use them
+# through the supercombinators below, which continue with their last
+# argument. name -> prim-op, for machines that make their own.
+output_ops = {}
+
+class PrintInt(BasePrimOp):
+    def apply(self, state):
+        if state.vstack_depth() < 1:
+            raise InterpError('%s: not enough argument' % self.to_s())
+        stdout.write(str(state.vstack_pop()))
+
+    def compute(self, args):
+        stdout.write(str(args[0]))
+        return 0
+
+    def get_arity(self):
+        return 1
+
+    def to_s(self):
+        return '#<PrimOp:printInt>'
+
+class PrintStr(BasePrimOp):
+    def __init__(self, name, s):
+        "NOT_RPYTHON"
+        BasePrimOp.__init__(self)
+        self.name = name
+        self.s = s
+
+    def apply(self, state):
+        stdout.write(self.s)
+
+    def compute(self, args):
+        stdout.write(self.s)
+        return 0
+
+    def get_arity(self):
+        return 0
+
+    def to_s(self):
+        return '#<PrimOp:%s>' % self.name
+
+#   printInt x k: print the integer x, then k
+#   printComma k, printNl k: print a comma or a newline, then k
+def add_print_ops():
+    print_int = PrintInt()
+    output_ops['printInt'] = print_int
+    i1 = module.add_codefrag([print_int, PushArg(1), Enter()], 'printInt')
+    module.add_sc('printInt', [Take(2), PushCode(i1), PushArg(0), Enter()])
+    for name, s in [('printComma', ','), ('printNl', '\n')]:
+        print_str = PrintStr(name, s)
+        output_ops[name] = print_str
+        module.add_sc(name, [Take(1), print_str, PushArg(0), Enter()])
+add_print_ops()
+
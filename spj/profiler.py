@@ -0,0 +1,217 @@
+# Per-code profiles for State.run. Every step, the counters the last
+# instruction changed in the State's Stat are charged to the code it
+# belongs to: a supercombinator, or one of its fragments, named
+# '<supercombinator>#<fragment index>'. Control passing into a
+# supercombinator is counted as a call from the one that owns the code
+# it came from. Allocations are charged the same way, by kind.
+
+class ProfileEntry(object):
+    def __init__(self, name):
+        self.name = name
+        self.nsteps = 0
+        self.nenters = 0
+        self.nclosure_made = 0
+        self.nvpushes = 0
+        self.ncalls = 0 # times control passed into this code as a call
+        self.nint_closures = 0
+        self.ncode_closures = 0
+        self.nlabel_closures = 0
+        self.nframes_made = 0
+
+    def add(self, other):
+        self.nsteps += other.nsteps
+        self.nenters += other.nenters
+        self.nclosure_made += other.nclosure_made
+        self.nvpushes += other.nvpushes
+        self.ncalls += other.ncalls
+        self.nint_closures += other.nint_closures
+        self.ncode_closures += other.ncode_closures
+        self.nlabel_closures += other.nlabel_closures
+        self.nframes_made += other.nframes_made
+
+    def nallocs(self):
+        return self.nclosure_made + self.nframes_made
+
+class Profile(object):
+    def __init__(self, global_names):
+        self.entries = {} # code name -> ProfileEntry
+        self.global_names = {}
+        for name in global_names:
+            self.global_names[name] = None
+        self.edges = {} # caller -> {callee -> number of calls}
+        self.curr_code = None
+        self.curr_pc = 0
+        self.curr_entry = None
+        # The Stat counters when the current instruction started.
+        self.nenters = 0
+        self.nclosure_made = 0
+        self.nvpushes = 0
+        self.nint_closures = 0
+        self.ncode_closures = 0
+        self.nlabel_closures = 0
+        self.nframes_made = 0
+
+    def entry(self, name):
+        entry = self.entries.get(name, None)
+        if entry is None:
+            entry = ProfileEntry(name)
+            self.entries[name] = entry
+        return entry
+
+    # Called before the instruction at <pc> in <code> is run. Code only
+    # jumps forwards, except when it is entered again.
+    def step(self, code, pc, stat):
+        self.charge(stat)
+        if code is not self.curr_code or pc < self.curr_pc:
+            entry = self.entry(code.name)
+            if code.name in self.global_names:
+                entry.ncalls += 1
+                if self.curr_code is not None:
+                    self.add_edge(owner_of(self.curr_code.name), code.name)
+            self.curr_code = code
+            self.curr_entry = entry
+        self.curr_pc = pc
+        self.curr_entry.nsteps += 1
+
+    def add_edge(self, caller, callee):
+        callees = self.edges.get(caller, None)
+        if callees is None:
+            callees = {}
+            self.edges[caller] = callees
+        callees[callee] = callees.get(callee, 0) + 1
+
+    # Charge what happened since the last step to the current code.
+    def charge(self, stat):
+        entry = self.curr_entry
+        if entry is not None:
+            entry.nenters += stat.nenters - self.nenters
+            entry.nclosure_made += stat.nclosure_made - self.nclosure_made
+            entry.nvpushes += stat.nvpushes - self.nvpushes
+            entry.nint_closures += stat.nint_closures - self.nint_closures
+            entry.ncode_closures += stat.ncode_closures - self.ncode_closures
+            entry.nlabel_closures += (stat.nlabel_closures -
+                                      self.nlabel_closures)
+            entry.nframes_made += stat.nframes_made - self.nframes_made
+        self.nenters = stat.nenters
+        self.nclosure_made = stat.nclosure_made
+        self.nvpushes = stat.nvpushes
+        self.nint_closures = stat.nint_closures
+        self.ncode_closures = stat.ncode_closures
+        self.nlabel_closures = stat.nlabel_closures
+        self.nframes_made = stat.nframes_made
+
+    def finish(self, stat):
+        self.charge(stat)
+
+    # Most steps first, by name when tied.
+    def sorted_entries(self, entries):
+        res = []
+        for entry in entries.values():
+            i = len(res)
+            while i > 0 and comes_before(entry, res[i - 1]):
+                i -= 1
+            res.insert(i, entry)
+        return res
+
+    # The entries that allocated anything, most allocations first.
+    def sorted_by_allocs(self, entries):
+        res = []
+        for entry in entries.values():
+            if entry.nallocs() == 0:
+                continue
+            i = len(res)
+            while i > 0 and allocs_before(entry, res[i - 1]):
+                i -= 1
+            res.insert(i, entry)
+        return res
+
+    # The entries of the fragments added to those of their owners.
+    def owner_entries(self):
+        owners = {}
+        for entry in self.entries.values():
+            name = owner_of(entry.name)
+            owner = owners.get(name, None)
+            if owner is None:
+                owner = ProfileEntry(name)
+                owners[name] = owner
+            owner.add(entry)
+        return owners
+
+    def total_steps(self):
+        total = 0
+        for entry in self.entries.values():
+            total += entry.nsteps
+        return total
+
+    def write_report(self, out):
+        total = max(self.total_steps(), 1)
+        out.write('Profile:\n')
+        out.write(columns(['steps', '%', 'enters', 'closures', 'vpushes',
+                           'calls', 'code']))
+        for entry in self.sorted_entries(self.entries):
+            out.write(columns([str(entry.nsteps),
+                               percent(entry.nsteps, total),
+                               str(entry.nenters),
+                               str(entry.nclosure_made),
+                               str(entry.nvpushes), str(entry.ncalls),
+                               entry.name]))
+
+    # The closures and frames each code allocated, by kind.
+    def write_alloc_report(self, out):
+        out.write('Allocations:\n')
+        out.write(columns(['allocs', 'ints', 'codes', 'labels', 'frames',
+                           'code']))
+        for entry in self.sorted_by_allocs(self.entries):
+            out.write(columns([str(entry.nallocs()),
+                               str(entry.nint_closures),
+                               str(entry.ncode_closures),
+                               str(entry.nlabel_closures),
+                               str(entry.nframes_made), entry.name]))
+
+    # A Graphviz call graph of the supercombinators, fragments included.
+    def write_dot(self, out):
+        total = max(self.total_steps(), 1)
+        out.write('digraph profile {\n')
+        out.write('  node [shape=box];\n')
+        for entry in self.sorted_entries(self.owner_entries()):
+            out.write('  "%s" [label="%s\\nsteps %d (%s)\\n'
+                      'calls %d, closures %d"];\n' % (
+                          entry.name, entry.name, entry.nsteps,
+                          percent(entry.nsteps, total), entry.ncalls,
+                          entry.nclosure_made))
+        callers = self.edges.keys()
+        callers.sort()
+        for caller in callers:
+            callees = self.edges[caller].keys()
+            callees.sort()
+            for callee in callees:
+                out.write('  "%s" -> "%s" [label="%d"];\n' % (
+                    caller, callee, self.edges[caller][callee]))
+        out.write('}\n')
+
+def owner_of(name):
+    i = name.find('#')
+    if i < 0:
+        return name
+    return name[:i]
+
+def comes_before(a, b):
+    return a.nsteps > b.nsteps or (a.nsteps == b.nsteps and a.name < b.name)
+
+def allocs_before(a, b):
+    return (a.nallocs() > b.nallocs() or
+            (a.nallocs() == b.nallocs() and a.name < b.name))
+
+def percent(n, total):
+    tenths = n * 1000 / total
+    return '%d.%d%%' % (tenths / 10, tenths % 10)
+
+column_widths = [10, 7, 9, 9, 9, 7]
+
+# Right-align all but the last column.
+def columns(cells):
+    buf = []
+    for i in xrange(len(cells) - 1):
+        buf.append(' ' * (column_widths[i] - len(cells[i])) + cells[i])
+    buf.append(' ' + cells[len(cells) - 1] + '\n')
+    return ' '.join(buf)
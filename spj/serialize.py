@@ -0,0 +1,157 @@
+import sys
+
+from pypy.rlib.rmd5 import RMD5
+from pypy.rlib.rarithmetic import r_uint, intmask
+
+from spj.errors import InterpError
+from spj.timrun import Program, Code, disassemble, all_primops
+
+# A compiled program on disk:
+#
+#   'SPJC' version nprimops key
+#   initcode
+#   nglobals (name code)*
+#   ncodefrags (name code)*
+#   nint_consts int*
+#
+# where an int is 8 bytes, little-endian, a string is its length then its
+# bytes, and a code is its length in ops then the ops. Only the ops are
+# stored; the instructions are recovered with timrun.disassemble.
+#
+# The key is a digest of the source and of the options that change the
+# compiled code. A file whose version, number of prim-ops or key differ
+# is not used, so bump VERSION whenever the opcodes change.
+
+MAGIC = 'SPJC'
+VERSION = 4
+
+def program_key(source, config):
+    if config.peephole is None:
+        passes = '*'
+    else:
+        passes = ','.join(config.peephole)
+    options = ('peephole=%s strict=%d ast_opt=%d inline_size=%d '
+               'trim_frames=%d' % (passes, int(config.strictness),
+                                   int(config.ast_opt), config.inline_size,
+                                   int(config.trim_frames)))
+    return RMD5(options + '\n' + source).hexdigest()
+
+def dump_program(program, key):
+    w = Writer()
+    w.write_str(MAGIC)
+    w.write_int(VERSION)
+    w.write_int(len(all_primops))
+    w.write_str(key)
+    w.write_ops(program.initcode.ops)
+    w.write_int(len(program.globals))
+    for i in xrange(len(program.globals)):
+        w.write_str(program.global_names[i])
+        w.write_ops(program.globals[i].ops)
+    w.write_int(len(program.codefrags))
+    for code in program.codefrags:
+        w.write_str(code.name)
+        w.write_ops(code.ops)
+    w.write_int(len(program.int_consts))
+    for ival in program.int_consts:
+        w.write_int(ival)
+    return w.getvalue()
+
+# The program stored in <data>, or None if it was stored for another
+# source, other options or another version of the compiler.
+def load_program(data, key):
+    r = Reader(data)
+    if (r.read_str() != MAGIC or r.read_int() != VERSION or
+            r.read_int() != len(all_primops) or r.read_str() != key):
+        return None
+    initops = r.read_ops()
+    global_names = []
+    globalops = []
+    for i in xrange(r.read_int()):
+        global_names.append(r.read_str())
+        globalops.append(r.read_ops())
+    frag_names = []
+    fragops = []
+    for i in xrange(r.read_int()):
+        frag_names.append(r.read_str())
+        fragops.append(r.read_ops())
+    int_consts = []
+    for i in xrange(r.read_int()):
+        int_consts.append(r.read_int())
+    if not r.at_end():
+        raise InterpError('compiled program: trailing data')
+    # A fragment runs in the frame of the code that refers to it, so the
+    # frame it is checked against is only known once that code is read:
+    # until then it may use any slot, and it is checked again whenever a
+    # smaller frame turns up. Fragments no code refers to are never run.
+    nfrags = len(fragops)
+    frag_frames = [sys.maxint] * nfrags
+    initcode = disassemble('<main>', initops, global_names, int_consts, 0,
+                           frag_frames)
+    globals = [disassemble(global_names[i], globalops[i], global_names,
+                           int_consts, 0, frag_frames)
+               for i in xrange(len(global_names))]
+    codefrags = [None] * nfrags
+    checked = [-1] * nfrags # the frame size fragment i was checked with
+    changed = True
+    while changed:
+        changed = False
+        for i in xrange(nfrags):
+            if codefrags[i] is None or frag_frames[i] < checked[i]:
+                checked[i] = frag_frames[i]
+                codefrags[i] = disassemble(frag_names[i], fragops[i],
+                                           global_names, int_consts,
+                                           checked[i], frag_frames)
+                changed = True
+    return Program(initcode, globals, global_names, codefrags, int_consts)
+
+class Writer(object):
+    def __init__(self):
+        self.buf = []
+
+    def write_int(self, ival):
+        u = r_uint(ival)
+        for i in xrange(8):
+            self.buf.append(chr(intmask((u >> (i * 8)) & 0xff)))
+
+    def write_str(self, s):
+        self.write_int(len(s))
+        self.buf.append(s)
+
+    def write_ops(self, ops):
+        self.write_int(len(ops))
+        for op in ops:
+            self.write_int(op)
+
+    def getvalue(self):
+        return ''.join(self.buf)
+
+class Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read_int(self):
+        if self.pos + 8 > len(self.data):
+            raise InterpError('compiled program: truncated')
+        u = r_uint(0)
+        for i in xrange(8):
+            u |= r_uint(ord(self.data[self.pos + i])) << (i * 8)
+        self.pos += 8
+        return intmask(u)
+
+    def read_str(self):
+        n = self.read_int()
+        if n < 0 or self.pos + n > len(self.data):
+            raise InterpError('compiled program: truncated')
+        start = self.pos
+        self.pos += n
+        return self.data[start:self.pos]
+
+    def read_ops(self):
+        n = self.read_int()
+        if n < 0 or self.pos + 8 * n > len(self.data):
+            raise InterpError('compiled program: truncated')
+        return [self.read_int() for i in xrange(n)]
+
+    def at_end(self):
+        return self.pos == len(self.data)
@@ -0,0 +1,115 @@
+from spj.language import W_EAp, W_EInt, W_EVar, W_ELet, W_ECase, W_EConstr
+from spj.primitive import module
+
+# Strictness analysis by abstract interpretation, as in chapter 2 of the
+# book's companion text: an expression is abstracted to 0 if it is
+# certainly undefined and 1 if it may be defined. Each supercombinator
+# gets a table from argument vectors to results, computed as the least
+# fixed point starting from all 0.
+
+# Tables have 2 ** arity entries; wider supercombinators are not analysed.
+MAX_ARITY = 10
+
+class StrictnessAnalyser(object):
+    def __init__(self, prog):
+        self.scs = {} # name -> W_ScDefn
+        self.tables = {} # name -> [0 or 1], indexed by argument bits
+        for sc in prog:
+            if sc.arity <= MAX_ARITY:
+                self.scs[sc.name] = sc
+                self.tables[sc.name] = [0] * (1 << sc.arity)
+
+    def analyse(self):
+        changed = True
+        while changed:
+            changed = False
+            for name, sc in self.scs.items():
+                table = self.tables[name]
+                for bits in xrange(len(table)):
+                    if table[bits] == 1:
+                        continue
+                    env = {}
+                    for i in xrange(sc.arity):
+                        env[sc.args[i]] = (bits >> i) & 1
+                    if self.eval(sc.body, env) == 1:
+                        table[bits] = 1
+                        changed = True
+
+    # [bool] for each parameter of <name>, or None if it was not analysed.
+    def strict_params(self, name):
+        table = self.tables.get(name, None)
+        if table is None:
+            return None
+        arity = self.scs[name].arity
+        top = (1 << arity) - 1
+        return [table[top & ~(1 << i)] == 0 for i in xrange(arity)]
+
+    def eval(self, expr, env):
+        if isinstance(expr, W_EInt) or isinstance(expr, W_EConstr):
+            return 1
+        elif isinstance(expr, W_EVar):
+            return env.get(expr.name, 1)
+        elif isinstance(expr, W_EAp):
+            return self.eval_ap(expr, env)
+        elif isinstance(expr, W_ELet):
+            new_env = env.copy()
+            for (name, e) in expr.defns:
+                if expr.isrec:
+                    new_env[name] = 1
+                else:
+                    new_env[name] = self.eval(e, env)
+            return self.eval(expr.expr, new_env)
+        elif isinstance(expr, W_ECase):
+            res = 0
+            for alt in expr.alts:
+                alt_env = env.copy()
+                for name in alt.components:
+                    alt_env[name] = 1
+                res |= self.eval(alt.body, alt_env)
+            return self.eval(expr.expr, env) & res
+        return 1
+
+    def eval_ap(self, expr, env):
+        args = [] # [argn, ..., arg1]
+        func = expr
+        while isinstance(func, W_EAp):
+            args.append(func.a)
+            func = func.f
+        nargs = len(args)
+        if not isinstance(func, W_EVar):
+            return 1
+        name = func.name
+        if name in env:
+            # Applying an undefined function is undefined.
+            return env[name]
+        if name in module.ops and nargs == module.ops[name].get_arity():
+            res = 1
+            for arg in args:
+                res &= self.eval(arg, env)
+            return res
+        if name == 'if' and nargs >= 3:
+            cond = self.eval(args[nargs - 1], env)
+            if nargs > 3:
+                return cond
+            return cond & (self.eval(args[1], env) | self.eval(args[0], env))
+        if name == 'par' and nargs == 2:
+            return self.eval(args[0], env)
+        table = self.tables.get(name, None)
+        if table is not None:
+            arity = self.scs[name].arity
+            if nargs >= arity:
+                bits = 0
+                for i in xrange(arity):
+                    bits |= self.eval(args[nargs - 1 - i], env) << i
+                return table[bits]
+        return 1
+
+def analyse(prog):
+    sa = StrictnessAnalyser(prog)
+    sa.analyse()
+    result = {}
+    for sc in prog:
+        strict = sa.strict_params(sc.name)
+        if strict is not None:
+            result[sc.name] = strict
+    return result
@@ -1,26 +1,70 @@
 from spj.errors import InterpError
-from spj.language import W_Root, W_EAp, W_EInt, W_EVar, W_ELet, ppr
-from spj.timrun import (State, Take, Enter, Return, PushInt, PushLabel,
-                        PushArg, PushCode, PushVInt, Move, Cond, Closure)
+from spj.language import (W_Root, W_EAp, W_EInt, W_EVar, W_ELet, W_ECase,
+                          W_EConstr, ppr)
+from spj.timrun import (Take, Enter, Return, PushInt, PushLabel,
+                        PushArg, PushCode, PushVInt, Move, Cond,
+                        PushMarker, PushCAF, Call, Assembler, assemble,
+                        ReturnConstr, Switch, MoveData, MkIntClosure,
+                        MoveCode, EnterArg, PushTrimmedCode, MoveTrimmedCode,
+                        Spark, Program)
 from spj.primitive import module
+from spj import peephole, strictness, lambdalift, astopt
+from spj.config import Config
+from spj.lambdalift import free_vars
 
-def compile(prog):
+def compile(prog, config=None):
+    if config is None:
+        config = Config()
+    program = compile_program(prog, config)
+    return program.mk_state(config.trace_level, config.trace_out)
+
+def compile_program(prog, config):
+    prog = lambdalift.lift_program(prog)
+    if config.ast_opt:
+        prog, inlined = astopt.optimise_program(prog, config.inline_size)
+        if config.inline_report and config.trace_out:
+            astopt.write_inline_report(inlined, config.trace_out)
+    prog = live_scs(prog, 'main')
     cc = ProgramCompiler()
+    if config.strictness:
+        cc.strict_params = strictness.analyse(prog)
     cc.compile_program(prog)
-    ppr(cc)
+    if config.peephole is None:
+        cc.optimise(peephole.all_pass_names())
+    else:
+        peephole.check_pass_names(config.peephole)
+        cc.optimise(config.peephole)
+    initinstrs = [PushCAF('main'), Enter()]
+    cc.drop_unreachable([initinstrs])
+    if config.trim_frames:
+        cc.trim_frames()
+    if config.dump_code:
+        ppr(cc, config.trace_out)
 
-    initcode = [PushLabel('main'), Enter()]
-    initstack = [Closure('<init>', [], None)]
-    return State(initcode,
-                 None,
-                 initstack,
-                 cc.globalenv,
-                 cc.codefrags)
+    asm = cc.link([initinstrs])
+    globals, codefrags = cc.assemble(asm)
+    initcode = assemble('<main>', initinstrs, asm)
+    return Program(initcode, globals, cc.global_names, codefrags,
+                   asm.int_consts)
 
 class ProgramCompiler(W_Root):
     def __init__(self):
         self.codefrags = module.codefrags[:]
+        # fragment index -> the supercombinator it was compiled from
+        self.codefrag_owners = module.codefrag_owners[:]
         self.globalenv = module.scs.copy()
+        self.cafs = {} # names of zero-arity supercombinators
+        self.arities = {} # name -> arity of every supercombinator
+        for name, code in module.scs.items():
+            take = code[0]
+            assert isinstance(take, Take)
+            self.arities[name] = take.nargs
+            if take.nargs == 0:
+                self.cafs[name] = None
+        self.global_names = [] # global index -> name, set by link()
+        # name -> [bool] per parameter, from spj.strictness. Empty unless
+        # strict arguments are to be evaluated before the call.
+        self.strict_params = {}
 
     def ppr(self, p):
         p.writeln('<ProgCompiler>')
@@ -30,23 +74,124 @@ class ProgramCompiler(W_Root):
             p.newline(2)
             p.writeln('Anonymous codes:')
             for i, code in enumerate(self.codefrags):
-                p.write('%d:' % i)
+                p.write('%s:' % self.codefrag_name(i))
                 p.writeln(code)
             p.writeln('')
 
     def compile_program(self, prog):
+        for sc in prog:
+            self.arities[sc.name] = sc.arity
+            if sc.arity == 0:
+                self.cafs[sc.name] = None
         for sc in prog:
             cc = Compiler(self, sc.name, framesize=sc.arity)
             cc.compile_sc(sc)
             self.globalenv[sc.name] = cc.code
 
-    def add_code(self, code):
+    def optimise(self, passes):
+        for name, code in self.globalenv.items():
+            self.globalenv[name] = peephole.optimise(code, passes)
+        self.codefrags = [peephole.optimise(code, passes)
+                          for code in self.codefrags]
+
+    # Drop the globals, prim-op wrappers included, and the code fragments
+    # that <roots> cannot reach, then renumber the fragments that are left.
+    def drop_unreachable(self, roots):
+        live_names = {}
+        live_frags = {}
+        todo = roots[:]
+        while todo:
+            code = todo.pop()
+            for instr in code:
+                name = instr_label(instr)
+                if (name is not None and name not in live_names and
+                        name in self.globalenv):
+                    live_names[name] = None
+                    todo.append(self.globalenv[name])
+                for i in instr_frags(instr):
+                    if i >= 0 and i not in live_frags:
+                        live_frags[i] = None
+                        todo.append(self.codefrags[i])
+        old_indices = live_frags.keys()
+        old_indices.sort()
+        renumbered = {}
+        for i in xrange(len(old_indices)):
+            renumbered[old_indices[i]] = i
+        globalenv = {}
+        for name in live_names.keys():
+            globalenv[name] = renumber_frags(self.globalenv[name], renumbered)
+        self.globalenv = globalenv
+        self.codefrags = [renumber_frags(self.codefrags[i], renumbered)
+                          for i in old_indices]
+        self.codefrag_owners = [self.codefrag_owners[i] for i in old_indices]
+
+    # Make closures of code fragments over copies of the frame that only
+    # keep the slots the fragment reads, so that e.g. a thunk does not
+    # keep alive a list its supercombinator has already passed on.
+    def trim_frames(self):
+        usage = FrameUsage(self.codefrags)
+        globalenv = {}
+        for name, code in self.globalenv.items():
+            globalenv[name] = usage.trim(code, frame_size(code))
+        codefrags = []
+        for i in xrange(len(self.codefrags)):
+            owner = self.globalenv.get(self.codefrag_owners[i], None)
+            if owner is None:
+                codefrags.append(self.codefrags[i])
+            else:
+                codefrags.append(usage.trim(self.codefrags[i],
+                                            frame_size(owner)))
+        self.globalenv = globalenv
+        self.codefrags = codefrags
+
+    # Number the globals and resolve every label against them, so that
+    # undefined names are reported before the program runs.
+    def link(self, extra_codes):
+        names = self.globalenv.keys()
+        names.sort()
+        global_indices = {}
+        for i in xrange(len(names)):
+            global_indices[names[i]] = i
+        self.global_names = names
+        for code in self.globalenv.values():
+            check_labels(code, global_indices)
+        for code in self.codefrags:
+            check_labels(code, global_indices)
+        for code in extra_codes:
+            check_labels(code, global_indices)
+        return Assembler(global_indices)
+
+    def assemble(self, asm):
+        globals = [assemble(name, self.globalenv[name], asm)
+                   for name in self.global_names]
+        codefrags = [assemble(self.codefrag_name(i), self.codefrags[i], asm)
+                     for i in xrange(len(self.codefrags))]
+        return globals, codefrags
+
+    # Constructors are compiled to globals named after them, made on
+    # first use: [Take a a, ReturnConstr t].
+    def constr_name(self, tag, arity):
+        name = 'Pack{%d,%d}' % (tag, arity)
+        if name not in self.globalenv:
+            self.globalenv[name] = [Take(arity), ReturnConstr(tag)]
+            self.arities[name] = arity
+            if arity == 0:
+                self.cafs[name] = None
+        return name
+
+    def add_code(self, code, owner):
         i = len(self.codefrags)
         self.codefrags.append(code)
+        self.codefrag_owners.append(owner)
         return i
 
+    # Fragments are named after their supercombinator, for profiles.
+    def codefrag_name(self, i):
+        return '%s#%d' % (self.codefrag_owners[i], i)
+
 class Compiler(object):
-    def __init__(self, progcc, name='?', initcode=None, framesize=0):
+    def __init__(self, progcc, name='?', initcode=None, framesize=0,
+                 parent=None):
         self.progcc = progcc
         self.name = name
         if initcode is None:
@@ -54,6 +199,23 @@ class Compiler(object):
         else:
             self.code = initcode
         self.framesize = framesize
+        # Code fragments run on the frame of the supercombinator they are
+        # compiled in, so their frame slots are allocated from it.
+        self.parent = parent
+
+    def alloc_slot(self):
+        cc = self
+        while cc.parent is not None:
+            cc = cc.parent
+        slot = cc.framesize
+        cc.framesize += 1
+        return slot
+
+    def add_code(self, code):
+        cc = self
+        while cc.parent is not None:
+            cc = cc.parent
+        return self.progcc.add_code(code, cc.name)
 
     def emit(self, instr):
         self.code.append(instr)
@@ -71,9 +233,12 @@ class Compiler(object):
             self.emit(PushArg(addr_mode.ival))
         elif isinstance(addr_mode, IndirectArg):
             co = [PushArg(addr_mode.ival), Enter()]
-            self.emit(PushCode(self.progcc.add_code(co)))
+            self.emit(PushCode(self.add_code(co)))
         elif isinstance(addr_mode, Label):
-            self.emit(PushLabel(addr_mode.name))
+            if addr_mode.name in self.progcc.cafs:
+                self.emit(PushCAF(addr_mode.name))
+            else:
+                self.emit(PushLabel(addr_mode.name))
         else:
             assert 0
 
@@ -81,6 +246,8 @@ class Compiler(object):
         local_env = mk_func_env(sc.args)
         self.compile_r(sc.body, local_env)
         self.code = [Take(self.framesize, sc.arity)] + self.code
+        if sc.arity == 0:
+            self.code = [PushMarker()] + self.code
 
     # Compile apply e to args (sort of like unwind)
     def compile_r(self, expr, env):
@@ -88,34 +255,108 @@ class Compiler(object):
         if self.compile_b(expr, env, [Return()]):
             return
         if isinstance(expr, W_EAp):
-            self.compile_a(expr.a, env)
-            self.compile_r(expr.f, env)
-        elif isinstance(expr, W_EInt) or isinstance(expr, W_EVar):
+            args = [] # [argn, ..., arg1]
+            func = expr
+            while isinstance(func, W_EAp):
+                args.append(func.a)
+                func = func.f
+            name = self.global_name(func, env)
+            if (name is not None and self.progcc.arities.get(name, -1) > 0
+                    and self.progcc.arities[name] <= len(args)):
+                self.compile_call(name, args, env)
+            else:
+                for arg in args:
+                    self.compile_a(arg, env)
+                self.compile_r(func, env)
+        elif (isinstance(expr, W_EInt) or isinstance(expr, W_EVar) or
+              isinstance(expr, W_EConstr)):
             self.compile_a(expr, env)
             self.emit(Enter())
+        elif isinstance(expr, W_ECase):
+            self.compile_case(expr, env)
         elif isinstance(expr, W_ELet):
             new_env = env.copy()
             if expr.isrec:
                 rec_env = new_env.copy()
                 for i, (name, e) in enumerate(expr.defns):
-                    frameslot = self.framesize
-                    self.framesize += 1
+                    frameslot = self.alloc_slot()
                     new_env[name] = Arg(frameslot)
                     rec_env[name] = IndirectArg(frameslot)
                 for i, (name, e) in enumerate(expr.defns):
-                    self.compile_a(e, rec_env)
+                    # Thunks only run after every slot is filled, so they
+                    # can refer to the slots directly. Atomic bindings are
+                    # pushed right now and still need the indirection.
+                    if is_atomic(e):
+                        self.compile_a(e, rec_env)
+                    else:
+                        self.compile_a(e, new_env)
                     self.emit_move(new_env[name])
             else:
                 for i, (name, e) in enumerate(expr.defns):
                     self.compile_a(e, env)
-                    frameslot = self.framesize
-                    self.framesize += 1
+                    frameslot = self.alloc_slot()
                     new_env[name] = Arg(frameslot)
                     self.emit_move(new_env[name])
             self.compile_r(expr.expr, new_env)
         else:
             raise InterpError('compile_r(%s): not implemented' % expr.to_s())
 
+    # Push <args> and Call the supercombinator <name>. Arithmetic
+    # arguments it is strict in are evaluated on the vstack first and
+    # pushed as int closures, instead of being pushed as thunks.
+    def compile_call(self, name, args, env):
+        strict = self.progcc.strict_params.get(name, None)
+        if strict is None:
+            for arg in args:
+                self.compile_a(arg, env)
+            self.emit(Call(name))
+            return
+        # Evaluating an argument may need a continuation, so build the
+        # code backwards from the Call: arg1 is pushed last.
+        nargs = len(args)
+        code = [Call(name)]
+        for i in xrange(nargs):
+            arg = args[nargs - 1 - i]
+            cc = Compiler(self.progcc, '<arg %d of %s>' % (i, name),
+                          parent=self)
+            if i < len(strict) and strict[i] and is_arith(arg, env):
+                cc.compile_b(arg, env, [MkIntClosure()] + code,
+                             use_fallback=True)
+            else:
+                cc.compile_a(arg, env)
+                cc.code.extend(code)
+            code = cc.code
+        for instr in code:
+            self.emit(instr)
+
+    # The global an expression refers to, or None if it is not one.
+    def global_name(self, expr, env):
+        if isinstance(expr, W_EVar) and expr.name not in env:
+            return expr.name
+        if isinstance(expr, W_EConstr):
+            return self.progcc.constr_name(expr.tag, expr.arity)
+        return None
+
+    # Push a continuation that switches on the tag of the constructor
+    # <expr.expr> returns. Each alternative first moves the fields it
+    # names into fresh frame slots.
+    def compile_case(self, expr, env):
+        frags = []
+        for alt in expr.alts:
+            cc = Compiler(self.progcc, '<alt %d>' % alt.tag, parent=self)
+            alt_env = env.copy()
+            for i, name in enumerate(alt.components):
+                slot = self.alloc_slot()
+                cc.emit(MoveData(i, slot))
+                alt_env[name] = Arg(slot)
+            cc.compile_r(alt.body, alt_env)
+            while len(frags) <= alt.tag:
+                frags.append(-1)
+            if frags[alt.tag] == -1:
+                frags[alt.tag] = self.add_code(cc.code)
+        self.emit(PushCode(self.add_code([Switch(frags)])))
+        self.compile_r(expr.expr, env)
+
     # Compile atomic expression (addressing mode?)
     def compile_a(self, expr, env):
         if isinstance(expr, W_EInt):
@@ -125,11 +366,16 @@ class Compiler(object):
                 self.emit_push(env[expr.name])
             else:
                 self.emit_push(Label(expr.name))
-        elif isinstance(expr, W_EAp):
-            # Create a shared closure
-            cc = Compiler(self.progcc, expr.to_s())
+        elif isinstance(expr, W_EConstr):
+            self.emit_push(Label(self.progcc.constr_name(expr.tag,
+                                                         expr.arity)))
+        elif (isinstance(expr, W_EAp) or isinstance(expr, W_ELet) or
+              isinstance(expr, W_ECase)):
+            # Create a shared closure, updated with its value when entered
+            cc = Compiler(self.progcc, expr.to_s(), parent=self)
+            cc.emit(PushMarker())
             cc.compile_r(expr, env)
-            fragindex = self.progcc.add_code(cc.code)
+            fragindex = self.add_code(cc.code)
             self.emit(PushCode(fragindex))
         else:
             raise InterpError('compile_a(%s): not implemented' % expr.to_s())
@@ -150,7 +396,8 @@ class Compiler(object):
                 # We can just inline the arith
                 for i in xrange(len(revargs) - 1, -1, -1):
                     arg = revargs[i]
-                    cc = Compiler(self.progcc, '<cont for %s>' % func.name)
+                    cc = Compiler(self.progcc, '<cont for %s>' % func.name,
+                                  parent=self)
                     cc.compile_b(arg, env, cont, use_fallback=True)
                     cont = cc.code
                 for instr in cont:
@@ -161,18 +408,24 @@ class Compiler(object):
                 condexpr = revargs[2]
                 trueexpr = revargs[1]
                 falseexpr = revargs[0]
-                cc1 = Compiler(self.progcc, '<cont for true>')
+                cc1 = Compiler(self.progcc, '<cont for true>', parent=self)
                 cc1.compile_r(trueexpr, env)
                 truecode = cc1.code
-                truefrag = self.progcc.add_code(truecode)
+                truefrag = self.add_code(truecode)
 
-                cc2 = Compiler(self.progcc, '<cont for false>')
+                cc2 = Compiler(self.progcc, '<cont for false>', parent=self)
                 cc2.compile_r(falseexpr, env)
                 falsecode = cc2.code
-                falsefrag = self.progcc.add_code(falsecode)
+                falsefrag = self.add_code(falsecode)
 
+                # Both branches end by returning to the continuation on
+                # the stack, so anything else to do after the if has to
+                # be pushed as one first.
+                if not (len(cont) == 1 and isinstance(cont[0], Return)):
+                    self.emit(PushCode(self.add_code(cont)))
+                    cont = [Return()]
                 newcont = [Cond(truefrag, falsefrag)] + cont
-                self.compile_b(condexpr, env, newcont)
+                self.compile_b(condexpr, env, newcont, use_fallback=True)
                 return True
         elif isinstance(expr, W_EInt):
             self.emit(PushVInt(expr.ival))
@@ -181,11 +434,124 @@ class Compiler(object):
             return True
         # Otherwise
         if use_fallback:
-            i = self.progcc.add_code(cont)
+            i = self.add_code(cont)
             self.emit(PushCode(i))
             self.compile_r(expr, env)
         return False
 
+# Which frame slots the code fragments use. A fragment runs on the frame
+# of the code that made its closure, or jumped to it, and other fragments
+# made or jumped to from it run on the same frame, so what they use is
+# added to what it uses.
+class FrameUsage(object):
+    def __init__(self, codefrags):
+        self.codefrags = codefrags
+        # fragment index -> {slot: None}
+        self.reads = {} # slots it may read before writing them
+        self.writes = {} # slots it or the code it jumps to may write
+        self.touches = {} # fragment index -> whether it uses a frame at all
+
+    def scan_frag(self, n):
+        if n in self.reads:
+            return
+        reads = {}
+        writes = {}
+        touches = False
+        for instr in self.codefrags[n]:
+            instr_reads, instr_writes = self.instr_slots(instr)
+            for slot in instr_reads:
+                if slot not in writes:
+                    reads[slot] = None
+            for slot in instr_writes:
+                writes[slot] = None
+            if instr_reads or instr_writes:
+                touches = True
+            for i in instr_frags(instr):
+                if i >= 0 and self.frag_touches(i):
+                    touches = True
+        self.reads[n] = reads
+        self.writes[n] = writes
+        self.touches[n] = touches
+
+    def frag_reads(self, n):
+        self.scan_frag(n)
+        return self.reads[n]
+
+    def frag_writes(self, n):
+        self.scan_frag(n)
+        return self.writes[n]
+
+    def frag_touches(self, n):
+        self.scan_frag(n)
+        return self.touches[n]
+
+    # The slots <instr> may read and write on the frame it runs on. A
+    # closure reads what its fragment reads, as a trimmed frame is
+    # copied when the closure is made.
+    def instr_slots(self, instr):
+        if (isinstance(instr, PushArg) or isinstance(instr, EnterArg) or
+                isinstance(instr, Spark)):
+            return [instr.k], []
+        elif isinstance(instr, Move) or isinstance(instr, MoveData):
+            return [], [instr.i]
+        elif isinstance(instr, MoveCode):
+            return self.frag_reads(instr.n).keys(), [instr.i]
+        elif isinstance(instr, PushCode):
+            return self.frag_reads(instr.n).keys(), []
+        elif isinstance(instr, Cond) or isinstance(instr, Switch):
+            reads = []
+            writes = []
+            for i in instr_frags(instr):
+                if i >= 0:
+                    reads.extend(self.frag_reads(i).keys())
+                    writes.extend(self.frag_writes(i).keys())
+            return reads, writes
+        return [], []
+
+    # <code> with closures made over trimmed copies of its frame of
+    # <size> slots, where that drops any slot.
+    def trim(self, code, size):
+        if size < 0:
+            return code
+        res = []
+        for i in xrange(len(code)):
+            instr = code[i]
+            if isinstance(instr, PushCode) or isinstance(instr, MoveCode):
+                instr = self.trim_closure(code, i, size)
+            res.append(instr)
+        return res
+
+    def trim_closure(self, code, i, size):
+        instr = code[i]
+        reads = self.frag_reads(instr.n)
+        if len(reads) == size:
+            return instr
+        # A closure made before a slot it reads is filled, as those of a
+        # letrec are, has to share the frame to see it.
+        later = {}
+        for j in xrange(i, len(code)):
+            instr_reads, instr_writes = self.instr_slots(code[j])
+            for slot in instr_writes:
+                later[slot] = None
+        for slot in reads.keys():
+            if slot in later:
+                return instr
+        slots = reads.keys()
+        slots.sort()
+        if not self.frag_touches(instr.n):
+            size = 0
+        if isinstance(instr, MoveCode):
+            return MoveTrimmedCode(instr.n, instr.i, size, slots)
+        return PushTrimmedCode(instr.n, size, slots)
+
+# The number of slots of the frame <code> makes, or -1 if it does not
+# start with a Take.
+def frame_size(code):
+    for instr in code[:2]:
+        if isinstance(instr, Take):
+            return instr.framesize
+    return -1
+
 class AddressMode(object):
     pass
 
@@ -201,6 +567,88 @@ class Label(AddressMode):
     def __init__(self, name):
         self.name = name
 
+def check_labels(code, global_indices):
+    for instr in code:
+        if isinstance(instr, PushLabel) or isinstance(instr, Call):
+            if instr.name not in global_indices:
+                raise InterpError('%s: undefined name' % instr.name)
+
+# The global an instruction refers to, if any.
+def instr_label(instr):
+    if isinstance(instr, PushLabel) or isinstance(instr, Call):
+        return instr.name
+    return None
+
+# The code fragments an instruction refers to; -1 stands for none.
+def instr_frags(instr):
+    if isinstance(instr, PushCode) or isinstance(instr, MoveCode):
+        return [instr.n]
+    elif isinstance(instr, Cond):
+        return [instr.frag_true, instr.frag_false]
+    elif isinstance(instr, Switch):
+        return instr.frags
+    return []
+
+# Instructions are shared with spj.primitive, so the ones that refer to
+# fragments are copied rather than changed.
+def renumber_frags(code, renumbered):
+    res = []
+    for instr in code:
+        if isinstance(instr, PushTrimmedCode):
+            instr = PushTrimmedCode(renumbered[instr.n], instr.size,
+                                    instr.slots)
+        elif isinstance(instr, PushCode):
+            instr = PushCode(renumbered[instr.n])
+        elif isinstance(instr, MoveTrimmedCode):
+            instr = MoveTrimmedCode(renumbered[instr.n], instr.i,
+                                    instr.size, instr.slots)
+        elif isinstance(instr, MoveCode):
+            instr = MoveCode(renumbered[instr.n], instr.i)
+        elif isinstance(instr, Cond):
+            instr = Cond(renumbered[instr.frag_true],
+                         renumbered[instr.frag_false])
+        elif isinstance(instr, Switch):
+            instr = Switch([renumbered.get(i, -1) for i in instr.frags])
+        res.append(instr)
+    return res
+
+# The supercombinators <root> refers to, directly or not, in program
+# order.
+def live_scs(prog, root):
+    scs = {}
+    for sc in prog:
+        scs[sc.name] = sc
+    live = {}
+    todo = [root]
+    while todo:
+        name = todo.pop()
+        if name in live or name not in scs:
+            continue
+        live[name] = None
+        sc = scs[name]
+        bound = {}
+        for arg in sc.args:
+            bound[arg] = None
+        fvs = {}
+        free_vars(sc.body, bound, fvs)
+        todo.extend(fvs.keys())
+    return [sc for sc in prog if sc.name in live]
+
+def is_atomic(expr):
+    return (isinstance(expr, W_EInt) or isinstance(expr, W_EVar) or
+            isinstance(expr, W_EConstr))
+
+# A saturated primitive operation, which always evaluates to an integer.
+def is_arith(expr, env):
+    nargs = 0
+    func = expr
+    while isinstance(func, W_EAp):
+        nargs += 1
+        func = func.f
+    return (nargs > 0 and isinstance(func, W_EVar) and func.name not in env
+            and func.name in module.ops
+            and nargs == module.ops[func.name].get_arity())
+
 def mk_func_env(args):
     d = {}
     for i, name in enumerate(args):
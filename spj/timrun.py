@@ -1,5 +1,13 @@
-from spj.errors import InterpError
+import sys
+
+from pypy.rlib.jit import JitDriver, elidable, promote
+
+from spj.errors import InterpError, LimitExceeded
 from spj.language import W_Root, ppr
+from spj.config import TRACE_QUIET, TRACE_STAT, TRACE_STEP
+from spj.profiler import Profile
+from spj.census import Census
+from spj.par import Scheduler
 
 class Stat(W_Root):
     def __init__(self):
@@ -9,6 +17,18 @@ class Stat(W_Root):
         self.nvpushes = 0
         self.ntakes = 0
         self.nclosure_made = 0
+        # nclosure_made by kind: integers, closures of code fragments made
+        # by PushCode and its variants, and of supercombinators.
+        self.nint_closures = 0
+        self.ncode_closures = 0
+        self.nlabel_closures = 0
+        self.nframes_made = 0 # by Take, trimming and partial applications
+        self.nboxes = 0 # W_Values made for results
+        self.nupdates = 0
+        self.ncaf_hits = 0
+        self.ncaf_evals = 0
+        self.nknown_calls = 0
+        self.nsparks = 0
         self.max_stackdepth = 0
         self.max_vstackdepth = 0
 
@@ -17,37 +37,120 @@ class Stat(W_Root):
         with p.block(2):
             p.writeln('Number of takes: %d' % self.ntakes)
             p.writeln('Number of enters: %d' % self.nenters)
+            p.writeln('Number of known calls: %d' % self.nknown_calls)
             p.writeln('Number of pushes/v: %d/%d' %
                       (self.npushes, self.nvpushes))
             p.writeln('Number of closures made: %d' % self.nclosure_made)
+            p.writeln('Closures made int/code/label: %d/%d/%d' %
+                      (self.nint_closures, self.ncode_closures,
+                       self.nlabel_closures))
+            p.writeln('Frames/boxes made: %d/%d' %
+                      (self.nframes_made, self.nboxes))
+            p.writeln('Number of updates: %d' % self.nupdates)
+            p.writeln('Number of sparks: %d' % self.nsparks)
+            p.writeln('CAF hits/evals: %d/%d' %
+                      (self.ncaf_hits, self.ncaf_evals))
             p.writeln('Max stackdepth/v: %d/%d' %
                       (self.max_stackdepth, self.max_vstackdepth))
 
+def get_printable_location(pc, code):
+    return '%s:%d' % (code.name, pc)
+
+jitdriver = JitDriver(greens=['pc', 'code'], reds=['self'],
+                      get_printable_location=get_printable_location)
+
+# The kinds of the vstack entries, so that a constructor tag is never
+# taken for an integer or the other way round.
+VALUE_INT = 0
+VALUE_CONSTR = 1
+
 class State(W_Root):
-    def __init__(self, initcode, frameptr, stack, globalenv, codefrags):
+    _immutable_fields_ = ['globals[*]', 'global_names[*]', 'codefrags[*]',
+                          'int_consts[*]', 'trace_level', 'trace_out']
+
+    def __init__(self, initcode, frameptr, stack, globals, global_names,
+                 codefrags, int_consts, trace_level=TRACE_QUIET,
+                 trace_out=None):
         self.code = initcode
         self.pc = 0
         self.frameptr = frameptr
         self.stack = stack
-        self.vstack = []
-        self.globalenv = globalenv
+        self.stackbase = 0 # Stack below this belongs to pending updates.
+        self.vstack = [0] * 16 # Raw machine integers, grows on demand.
+        self.vkinds = [VALUE_INT] * 16 # vstack index -> VALUE_INT/CONSTR
+        self.vsp = 0
+        self.dump = [] # [UpdateFrame]
+        self.papcodes = {} # nargs -> code for partial applications
+        self.constrcodes = {} # tag -> code for evaluated constructors
+        # Fields of the constructor last returned by ReturnConstr.
+        self.dataframe = None
+        self.globals = globals # global index -> Code, resolved by the linker
+        self.global_names = global_names
         self.codefrags = codefrags
+        # Closures for the integer literals in the program, made once.
+        self.int_consts = [mk_const_intclosure(ival) for ival in int_consts]
+        # global index -> Closure of a CAF, shared by every reference
+        self.cafs = [None] * len(globals)
         self.stat = Stat()
         self.curr_closure = None
+        self.trace_level = trace_level
+        self.trace_out = trace_out
+        self.profile = None # Profile, when profiling
+        self.census = None # Census, when taking heap censuses
+        self.scheduler = None # Scheduler, when sparks run in parallel
+        # Limits past which a LimitExceeded is raised, see set_limits.
+        self.max_steps = sys.maxint
+        self.max_stackdepth = sys.maxint # of the stack and of the dump
+        self.max_vstackdepth = sys.maxint
+        self.max_allocs = sys.maxint # closures and frames made
+
+    def start_profile(self):
+        self.profile = Profile(self.global_names)
+
+    def start_census(self, interval, series_out=None):
+        self.census = Census(interval, series_out)
+
+    def start_parallel(self, nworkers):
+        self.scheduler = Scheduler(nworkers, await_code)
+
+    # Each limit is checked where its Stat counter changes; 0 means none.
+    def set_limits(self, max_steps, max_stackdepth, max_vstackdepth,
+                   max_allocs):
+        if max_steps > 0:
+            self.max_steps = max_steps
+        if max_stackdepth > 0:
+            self.max_stackdepth = max_stackdepth
+        if max_vstackdepth > 0:
+            self.max_vstackdepth = max_vstackdepth
+        if max_allocs > 0:
+            self.max_allocs = max_allocs
+
+    def limit_exceeded(self, what, limit):
+        raise LimitExceeded('%s: limit of %d exceeded' % (what, limit),
+                            self.stat)
+
+    def count_alloc(self):
+        if (self.stat.nclosure_made + self.stat.nframes_made >
+                self.max_allocs):
+            self.limit_exceeded('allocations', self.max_allocs)
 
     def ppr(self, p):
-        if self.pc >= len(self.code):
+        if self.is_final():
             currinstr = 'X'
         else:
-            currinstr =  self.code[self.pc].to_s()
+            currinstr = self.code.instr_at(self.pc).to_s()
         p.writeln('State %s' % currinstr)
         with p.block(2):
             p.write('Frameptr: ')
             p.writeln(self.frameptr)
+            p.write('Dataframe: ')
+            p.writeln(self.dataframe)
             p.write('Stack: ')
             p.writeln(self.stack)
             p.write('VStack: ')
-            p.writeln(self.vstack)
+            p.writeln(self.vstack[:self.vsp])
+            p.write('Dump: ')
+            p.writeln(self.dump)
             p.writeln(self.stat)
 
     def frame_ref(self, n):
@@ -56,13 +159,41 @@ class State(W_Root):
     def frame_put(self, n, cl):
         self.frameptr[n] = cl
 
+    # A frame for a closure of a code fragment that only reads some of the
+    # slots of the current one. ops[i] is the size of the frame, 0 if the
+    # fragment uses none, then the number of slots to copy and the slots.
+    def trimmed_frame(self, ops, i):
+        size = ops[i]
+        if size == 0:
+            return None
+        self.stat.nframes_made += 1
+        self.count_alloc()
+        frameptr = [None] * size
+        for j in xrange(ops[i + 1]):
+            slot = ops[i + 2 + j]
+            frameptr[slot] = self.frameptr[slot]
+        return frameptr
+
     def mk_frameptr(self, framesize, nargs):
         self.stat.ntakes += 1
+        self.stat.nframes_made += 1
+        self.count_alloc()
         tup_w = [None] * framesize
         for i in xrange(nargs):
             tup_w[i] = self.stack_pop()
         self.frameptr = tup_w
 
+    def take(self, framesize, nargs):
+        while nargs > self.stack_depth():
+            if not self.dump:
+                raise InterpError('#<Take %d %d>: too few arguments' %
+                                  (framesize, nargs))
+            self.update_partial_app()
+        self.mk_frameptr(framesize, nargs)
+
+    def stack_depth(self):
+        return len(self.stack) - self.stackbase
+
     def stack_pop(self):
         return self.stack.pop()
 
@@ -71,78 +202,596 @@ class State(W_Root):
         self.stack.append(cl)
         self.stat.max_stackdepth = max(len(self.stack),
                                        self.stat.max_stackdepth)
+        if len(self.stack) > self.max_stackdepth:
+            self.limit_exceeded('stack depth', self.max_stackdepth)
+
+    def vstack_depth(self):
+        return self.vsp
 
+    # Pop an integer.
     def vstack_pop(self):
-        return self.vstack.pop()
+        self.vsp -= 1
+        assert self.vsp >= 0
+        if self.vkinds[self.vsp] != VALUE_INT:
+            raise InterpError('#<Constr %d>: not a number' %
+                              self.vstack[self.vsp])
+        return self.vstack[self.vsp]
 
-    def vstack_push(self, w_val):
+    # Pop the tag of a constructor.
+    def vstack_pop_tag(self):
+        self.vsp -= 1
+        assert self.vsp >= 0
+        if self.vkinds[self.vsp] != VALUE_CONSTR:
+            raise InterpError('%d: not a constructor' %
+                              self.vstack[self.vsp])
+        return self.vstack[self.vsp]
+
+    def vstack_top(self):
+        assert self.vsp > 0
+        return self.vstack[self.vsp - 1]
+
+    def vstack_push(self, ival, kind=VALUE_INT):
         self.stat.nvpushes += 1
-        self.vstack.append(w_val)
-        self.stat.max_vstackdepth = max(len(self.vstack),
-                                        self.stat.max_vstackdepth)
+        if self.vsp == len(self.vstack):
+            self.vstack.extend([0] * len(self.vstack))
+            self.vkinds.extend([VALUE_INT] * len(self.vkinds))
+        self.vstack[self.vsp] = ival
+        self.vkinds[self.vsp] = kind
+        self.vsp += 1
+        self.stat.max_vstackdepth = max(self.vsp, self.stat.max_vstackdepth)
+        if self.vsp > self.max_vstackdepth:
+            self.limit_exceeded('vstack depth', self.max_vstackdepth)
+
+    def int_binop(self, op):
+        if self.vsp < 2:
+            raise InterpError('%s: not enough argument' % binop_names[op])
+        a = self.vstack_pop()
+        b = self.vstack_pop()
+        self.vstack_push(compute_binop(op, a, b))
+
+    # The left operand is a literal that was never pushed.
+    def int_binop_lit(self, op, a):
+        if self.vsp < 1:
+            raise InterpError('%s: not enough argument' % binop_names[op])
+        b = self.vstack_pop()
+        self.vstack_push(compute_binop(op, a, b))
 
     def mk_closure(self, name, code, frameptr):
         self.stat.nclosure_made += 1
+        self.count_alloc()
         return Closure(name, code, frameptr)
 
+    # A closure of code fragment n.
+    def mk_code_closure(self, n, frameptr):
+        self.stat.ncode_closures += 1
+        return self.mk_closure('<anonymous>', self.codefrag_ref(n), frameptr)
+
+    # A closure of global n, which needs no frame.
+    def mk_label_closure(self, n):
+        self.stat.nlabel_closures += 1
+        return self.mk_closure(self.global_names[n], self.global_ref(n), None)
+
     def mk_intclosure(self, ival):
+        if SMALL_INT_MIN <= ival <= SMALL_INT_MAX:
+            return small_ints[ival - SMALL_INT_MIN]
         self.stat.nclosure_made += 1
+        self.stat.nint_closures += 1
+        self.count_alloc()
         return IntClosure(ival)
 
+    def push_update_frame(self, cl):
+        self.dump.append(UpdateFrame(cl, self.stackbase))
+        self.stackbase = len(self.stack)
+        if len(self.dump) > self.max_stackdepth:
+            self.limit_exceeded('dump depth', self.max_stackdepth)
+
+    def pop_update_frame(self):
+        uf = self.dump.pop()
+        self.stackbase = uf.stackbase
+        return uf.closure
+
+    def update_closure(self, cl, code, frameptr):
+        # Overwrite the thunk in place so every frame slot that refers to
+        # it sees the value without going through an indirection.
+        self.stat.nupdates += 1
+        if cl.is_caf:
+            self.stat.ncaf_evals += 1
+        cl.code = code
+        cl.frameptr = frameptr
+
+    def return_value(self):
+        while self.stack_depth() == 0:
+            if not self.dump:
+                raise InterpError('Return: empty stack')
+            cl = self.pop_update_frame()
+            self.update_closure(cl, int_code, None)
+            cl.ival = self.vstack_top()
+        self.dataframe = None
+        self.enter_closure(self.stack_pop())
+
+    # The current frame holds the fields of a constructor with this tag.
+    def return_constr(self, tag):
+        while self.stack_depth() == 0:
+            if not self.dump:
+                raise InterpError('ReturnConstr: empty stack')
+            cl = self.pop_update_frame()
+            self.update_closure(cl, self.constr_code(tag), self.frameptr)
+        self.vstack_push(tag, VALUE_CONSTR)
+        self.dataframe = self.frameptr
+        self.enter_closure(self.stack_pop())
+
+    def constr_code(self, tag):
+        code = self.constrcodes.get(tag, None)
+        if code is None:
+            code = assemble('<constr %d>' % tag, [ReturnConstr(tag)])
+            self.constrcodes[tag] = code
+        return code
+
+    def data_ref(self, n):
+        if self.dataframe is None or not 0 <= n < len(self.dataframe):
+            raise InterpError('case: the constructor has no field %d' % n)
+        return self.dataframe[n]
+
+    def update_partial_app(self):
+        # The thunk on top of the dump evaluated to a function that is
+        # still waiting for arguments: remember the ones we have got.
+        nargs = self.stack_depth()
+        self.stat.nframes_made += 1
+        self.count_alloc()
+        frameptr = [None] * (nargs + 1)
+        for i in xrange(nargs):
+            frameptr[i] = self.stack[self.stackbase + i]
+        frameptr[nargs] = self.curr_closure
+        cl = self.pop_update_frame()
+        self.update_closure(cl, self.partial_app_code(nargs), frameptr)
+
+    def partial_app_code(self, nargs):
+        code = self.papcodes.get(nargs, None)
+        if code is None:
+            instrs = [PushArg(i) for i in xrange(nargs)]
+            instrs.append(EnterArg(nargs))
+            code = assemble('<pap %d>' % nargs, instrs)
+            self.papcodes[nargs] = code
+        return code
+
     def enter_closure(self, cl):
         self.stat.nenters += 1
         self.curr_closure = cl
         self.enter_code(cl.code)
         self.frameptr = cl.frameptr
 
+    # The JIT specialises the trace on the code entered, so that its ops
+    # are constants.
     def enter_code(self, code):
-        self.code = code
+        self.code = promote(code)
         self.pc = 0
 
+    def global_ref(self, n):
+        return promote(self.globals[n])
+
+    def caf_ref(self, n):
+        cl = self.cafs[n]
+        if cl is None:
+            cl = self.mk_label_closure(n)
+            cl.is_caf = True
+            self.cafs[n] = cl
+        else:
+            self.stat.ncaf_hits += 1
+        return cl
+
     def codefrag_ref(self, n):
-        return self.codefrags[n]
+        return promote(self.codefrags[n])
 
     def eval(self):
-        while not self.is_final():
-            ppr(self)
-            self.step()
-        ppr(self)
-        return self.vstack[-1]
+        try:
+            self.run()
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.finish()
+        self.stat.nboxes += 1 # for the result
+        if self.profile is not None:
+            self.profile.finish(self.stat)
+        if self.trace_level >= TRACE_STEP:
+            ppr(self, self.trace_out)
+        elif self.trace_level >= TRACE_STAT:
+            ppr(self.stat, self.trace_out)
+        if self.trace_level >= TRACE_STAT and self.scheduler is not None:
+            self.scheduler.write_report(self.trace_out)
+        # main stopped without returning, e.g. as a function missing
+        # its arguments.
+        if self.vsp == 0:
+            raise InterpError('main: not a value')
+        if self.dataframe is not None:
+            return W_Constr(self.vstack_top(), self.dataframe)
+        return W_Int(self.vstack_top())
+
+    # Offer <cl>, the first argument of a par, to the worker processes.
+    def spark(self, cl):
+        self.stat.nsparks += 1
+        if self.scheduler is not None:
+            self.scheduler.spark(self, cl)
+
+    def is_int_closure(self, cl):
+        return cl.code is int_code
+
+    # A thunk not yet updated with its value, which a worker could compute.
+    def is_unevaluated(self, cl):
+        ops = cl.code.ops
+        return len(ops) > 0 and ops[0] == OP_PUSH_MARKER
+
+    # Evaluate the spark <cl> from scratch, in a worker process forked off
+    # by the scheduler. Only an integer value can be sent back.
+    def eval_spark(self, cl):
+        self.stat = Stat()
+        self.stack = [Closure('<spark>', assemble('<spark>', []), None)]
+        self.stackbase = 0
+        self.vsp = 0
+        self.dump = []
+        self.dataframe = None
+        self.enter_closure(cl)
+        self.run()
+        if self.vsp == 0:
+            raise InterpError('par: %s is not a value' % cl.to_s())
+        if self.dataframe is not None:
+            raise InterpError('par: %s is not an integer' % cl.to_s())
+        return self.vstack_top()
+
+    # A worker sent back the value of the spark <cl>.
+    def spark_value(self, cl, ival):
+        self.update_closure(cl, int_code, None)
+        cl.ival = ival
+
+    def flush_trace(self):
+        if self.trace_out is not None:
+            self.trace_out.flush()
 
     def is_final(self):
-        return self.pc >= len(self.code)
+        return self.pc >= len(self.code.ops)
+
+    def run(self):
+        code = self.code
+        pc = self.pc
+        while True:
+            jitdriver.jit_merge_point(pc=pc, code=code, self=self)
+            if pc >= len(code.ops):
+                break
+            if self.trace_level >= TRACE_STEP:
+                self.code = code
+                self.pc = pc
+                ppr(self, self.trace_out)
+            if self.profile is not None:
+                self.profile.step(code, pc, self.stat)
+            if self.census is not None:
+                self.census.step(self)
+            if self.stat.nsteps >= self.max_steps:
+                self.code = code
+                self.pc = pc
+                self.limit_exceeded('steps', self.max_steps)
+            self.stat.nsteps += 1
+            ops = code.ops
+            op = ops[pc]
+            if op == OP_TAKE:
+                self.take(ops[pc + 1], ops[pc + 2])
+                pc += 3
+            elif op == OP_MOVE:
+                self.frame_put(ops[pc + 1], self.stack_pop())
+                pc += 2
+            elif op == OP_PUSH_ARG:
+                self.stack_push(self.frame_ref(ops[pc + 1]))
+                pc += 2
+            elif op == OP_PUSH_CODE:
+                cl = self.mk_code_closure(ops[pc + 1], self.frameptr)
+                self.stack_push(cl)
+                pc += 2
+            elif op == OP_PUSH_TRIMMED_CODE:
+                cl = self.mk_code_closure(ops[pc + 1],
+                                          self.trimmed_frame(ops, pc + 2))
+                self.stack_push(cl)
+                pc += 4 + ops[pc + 3]
+            elif op == OP_PUSH_LABEL:
+                # A supercombinator starts with a Take, so its closure
+                # needs no frame, and keeping this one would keep every
+                # slot of it alive.
+                self.stack_push(self.mk_label_closure(ops[pc + 1]))
+                pc += 2
+            elif op == OP_PUSH_CAF:
+                self.stack_push(self.caf_ref(ops[pc + 1]))
+                pc += 2
+            elif op == OP_PUSH_INT:
+                self.stack_push(self.int_consts[ops[pc + 1]])
+                pc += 2
+            elif op == OP_PUSH_VSELF:
+                self.vstack_push(self.curr_closure.ival)
+                pc += 1
+            elif op == OP_PUSH_VINT:
+                self.vstack_push(ops[pc + 1])
+                pc += 2
+            elif op == OP_MK_INT_CLOSURE:
+                self.stack_push(self.mk_intclosure(self.vstack_pop()))
+                pc += 1
+            elif op == OP_MOVE_CODE:
+                cl = self.mk_code_closure(ops[pc + 1], self.frameptr)
+                self.frame_put(ops[pc + 2], cl)
+                pc += 3
+            elif op == OP_MOVE_TRIMMED_CODE:
+                cl = self.mk_code_closure(ops[pc + 1],
+                                          self.trimmed_frame(ops, pc + 3))
+                self.frame_put(ops[pc + 2], cl)
+                pc += 5 + ops[pc + 4]
+            elif op == OP_PUSH_MARKER:
+                self.push_update_frame(self.curr_closure)
+                pc += 1
+            elif op == OP_ENTER:
+                self.enter_closure(self.stack_pop())
+                code = self.code
+                pc = 0
+                jitdriver.can_enter_jit(pc=pc, code=code, self=self)
+            elif op == OP_ENTER_ARG:
+                self.enter_closure(self.frame_ref(ops[pc + 1]))
+                code = self.code
+                pc = 0
+                jitdriver.can_enter_jit(pc=pc, code=code, self=self)
+            elif op == OP_CALL:
+                # A saturated call to a known supercombinator: its
+                # arguments are on the stack, so build the frame without
+                # making a closure for it or checking the stack depth.
+                self.stat.nknown_calls += 1
+                code = self.global_ref(ops[pc + 1])
+                assert code.ops[0] == OP_TAKE
+                self.mk_frameptr(code.ops[1], code.ops[2])
+                pc = 3
+                jitdriver.can_enter_jit(pc=pc, code=code, self=self)
+            elif op == OP_RETURN:
+                self.return_value()
+                code = self.code
+                pc = 0
+                jitdriver.can_enter_jit(pc=pc, code=code, self=self)
+            elif op == OP_RETURN_CONSTR:
+                self.return_constr(ops[pc + 1])
+                code = self.code
+                pc = 0
+                jitdriver.can_enter_jit(pc=pc, code=code, self=self)
+            elif op == OP_SWITCH:
+                tag = self.vstack_pop_tag()
+                nalts = ops[pc + 1]
+                frag = -1
+                if 0 <= tag < nalts:
+                    frag = ops[pc + 2 + tag]
+                if frag < 0:
+                    raise InterpError('#<Switch>: no alternative for tag %d'
+                                      % tag)
+                code = self.codefrag_ref(frag)
+                pc = 0
+            elif op == OP_MOVE_DATA:
+                self.frame_put(ops[pc + 2], self.data_ref(ops[pc + 1]))
+                pc += 3
+            elif op == OP_COND:
+                if self.vstack_pop() != 0:
+                    code = self.codefrag_ref(ops[pc + 1])
+                else:
+                    code = self.codefrag_ref(ops[pc + 2])
+                pc = 0
+            elif op == OP_PRIMOP:
+                get_primop(ops[pc + 1]).apply(self)
+                pc += 2
+            elif OP_ADD <= op <= OP_NE:
+                self.int_binop(op)
+                pc += 1
+            elif op == OP_PUSH_VINT_OP:
+                self.int_binop_lit(ops[pc + 2], ops[pc + 1])
+                pc += 3
+            elif op == OP_SPARK:
+                self.spark(self.frame_ref(ops[pc + 1]))
+                pc += 2
+            elif op == OP_AWAIT:
+                # The closure is being evaluated by a worker: wait for its
+                # value, or for its own code back if the worker failed.
+                cl = self.curr_closure
+                self.scheduler.wait_for(self, cl)
+                self.enter_closure(cl)
+                code = self.code
+                pc = 0
+            else:
+                raise InterpError('unknown opcode %d' % op)
+        self.code = code
+        self.pc = pc
+
+def compute_binop(op, a, b):
+    if op == OP_ADD:
+        return a + b
+    elif op == OP_SUB:
+        return a - b
+    elif op == OP_MUL:
+        return a * b
+    elif op == OP_DIV:
+        if b == 0:
+            raise InterpError('/: division by zero')
+        return a / b
+    elif op == OP_LT:
+        return int(a < b)
+    elif op == OP_LE:
+        return int(a <= b)
+    elif op == OP_GT:
+        return int(a > b)
+    elif op == OP_GE:
+        return int(a >= b)
+    elif op == OP_EQ:
+        return int(a == b)
+    elif op == OP_NE:
+        return int(a != b)
+    else:
+        raise InterpError('unknown binary op %d' % op)
 
-    def step(self):
-        self.stat.nsteps += 1
-        instr = self.code[self.pc]
-        self.pc += 1
-        instr.dispatch(self)
+class UpdateFrame(W_Root):
+    def __init__(self, closure, stackbase):
+        self.closure = closure
+        self.stackbase = stackbase
+
+    def to_s(self):
+        return '#<UpdateFrame %s @%d>' % (self.closure.to_s(), self.stackbase)
 
 class Closure(W_Root):
+    is_caf = False # counted in ncaf_evals when updated
+
     def __init__(self, name, code, frameptr):
         self.name = name
         self.code = code
         self.frameptr = frameptr
+        # As in the book, where the frame pointer of an integer closure is
+        # the integer itself: int_code reads the value from here.
+        self.ival = 0
 
     def to_s(self):
         return '#<Closure %s>' % self.name
 
 class IntClosure(Closure):
     def __init__(self, ival):
-        Closure.__init__(self, '<int>', [PushVInt(ival), Return()], None)
+        Closure.__init__(self, '<int>', int_code, None)
         self.ival = ival
 
     def to_s(self):
         return '#<IntClosure %d>' % self.ival
 
+def mk_const_intclosure(ival):
+    if SMALL_INT_MIN <= ival <= SMALL_INT_MAX:
+        return small_ints[ival - SMALL_INT_MIN]
+    return IntClosure(ival)
+
+# Executable code: a flat list of opcodes and their operands. The
+# instruction objects are kept for pretty-printing only.
+class Code(W_Root):
+    _immutable_fields_ = ['name', 'instrs[*]', 'ops[*]', 'offsets[*]']
+
+    def __init__(self, name, instrs, ops, offsets):
+        self.name = name
+        self.instrs = instrs
+        self.ops = ops
+        self.offsets = offsets # instruction index -> pc
+
+    def instr_at(self, pc):
+        for i in xrange(len(self.offsets)):
+            if self.offsets[i] == pc:
+                return self.instrs[i]
+        raise InterpError('%s: no instruction at %d' % (self.to_s(), pc))
+
+    def to_s(self):
+        return '#<Code %s>' % self.name
+
+    def ppr(self, p):
+        p.write(self.instrs)
+
+# A linked program, as made by spj.timc and stored by spj.serialize.
+class Program(W_Root):
+    def __init__(self, initcode, globals, global_names, codefrags,
+                 int_consts):
+        self.initcode = initcode
+        self.globals = globals # global index -> Code
+        self.global_names = global_names
+        self.codefrags = codefrags
+        self.int_consts = int_consts # int constant index -> raw integer
+
+    def mk_state(self, trace_level=TRACE_QUIET, trace_out=None):
+        initstack = [Closure('<init>', assemble('<init>', []), None)]
+        return State(self.initcode, None, initstack, self.globals,
+                     self.global_names, self.codefrags, self.int_consts,
+                     trace_level, trace_out)
+
+    # Like ProgramCompiler.ppr, for --dump-code on a program read back
+    # from the cache.
+    def ppr(self, p):
+        p.writeln('<Program>')
+        with p.block(2):
+            p.writeln('Supercombinators:')
+            p.write_dict([(self.global_names[i], self.globals[i])
+                          for i in xrange(len(self.globals))])
+            p.newline(2)
+            p.writeln('Anonymous codes:')
+            for code in self.codefrags:
+                p.write('%s:' % code.name)
+                p.writeln(code)
+            p.writeln('')
+
+class Assembler(object):
+    def __init__(self, global_indices):
+        self.global_indices = global_indices # name -> global index
+        self.int_consts = [] # literals used by PushInt
+        self.int_const_indices = {}
+
+    def global_index(self, name):
+        return self.global_indices[name]
+
+    def int_const_index(self, ival):
+        i = self.int_const_indices.get(ival, -1)
+        if i == -1:
+            i = len(self.int_consts)
+            self.int_consts.append(ival)
+            self.int_const_indices[ival] = i
+        return i
+
+def assemble(name, instrs, asm=None):
+    ops = []
+    offsets = []
+    for instr in instrs:
+        offsets.append(len(ops))
+        instr.encode(ops, asm)
+    return Code(name, instrs, ops, offsets)
+
+# Opcodes
+OP_TAKE = 0
+OP_MOVE = 1
+OP_PUSH_ARG = 2
+OP_PUSH_CODE = 3
+OP_PUSH_LABEL = 4
+OP_PUSH_CAF = 5
+OP_PUSH_INT = 6
+OP_PUSH_VINT = 7
+OP_PUSH_MARKER = 8
+OP_ENTER = 9
+OP_RETURN = 10
+OP_COND = 11
+OP_PRIMOP = 12
+OP_PUSH_VSELF = 23
+OP_CALL = 24
+OP_RETURN_CONSTR = 28
+OP_SWITCH = 29
+OP_MOVE_DATA = 30
+OP_MK_INT_CLOSURE = 31
+OP_PUSH_TRIMMED_CODE = 32
+OP_MOVE_TRIMMED_CODE = 33
+OP_SPARK = 34
+OP_AWAIT = 35
+# Superinstructions, made by spj.peephole
+OP_ENTER_ARG = 25
+OP_MOVE_CODE = 26
+OP_PUSH_VINT_OP = 27
+# Binary operations on the two raw integers on top of the vstack.
+OP_ADD = 13
+OP_SUB = 14
+OP_MUL = 15
+OP_DIV = 16
+OP_LT = 17
+OP_LE = 18
+OP_GT = 19
+OP_GE = 20
+OP_EQ = 21
+OP_NE = 22
+
+binop_names = {OP_ADD: '+', OP_SUB: '-', OP_MUL: '*', OP_DIV: '/',
+               OP_LT: '<', OP_LE: '<=', OP_GT: '>', OP_GE: '>=',
+               OP_EQ: '==', OP_NE: '/='}
+
 class Instr(W_Root):
-    def dispatch(self, state):
-        raise NotImplementedError
+    opcode = -1
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
 
     def to_s(self):
         return '#<Instr>'
 
 class Take(Instr):
+    opcode = OP_TAKE
+
     def __init__(self, framesize, nargs=-1):
         self.framesize = framesize
         if nargs == -1: # the same as framesize
@@ -150,102 +799,268 @@ class Take(Instr):
         else:
             self.nargs = nargs
 
-    def dispatch(self, state):
-        if self.nargs > len(state.stack):
-            raise InterpError('%s: too few arguments' % self.to_s())
-        state.mk_frameptr(self.framesize, self.nargs)
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.framesize)
+        ops.append(self.nargs)
 
     def to_s(self):
         return '#<Take %d %d>' % (self.framesize, self.nargs)
 
+class PushMarker(Instr):
+    opcode = OP_PUSH_MARKER
+
+    def to_s(self):
+        return '#<PushMarker>'
+
 class Move(Instr):
+    opcode = OP_MOVE
+
     def __init__(self, i):
         self.i = i
 
-    def dispatch(self, state):
-        cl = state.stack_pop()
-        state.frame_put(self.i, cl)
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.i)
 
     def to_s(self):
         return '#<Move %d>' % self.i
 
 class PushArg(Instr):
+    opcode = OP_PUSH_ARG
+
     def __init__(self, k):
         self.k = k
-    
-    def dispatch(self, state):
-        state.stack_push(state.frame_ref(self.k))
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.k)
 
     def to_s(self):
         return '#<PushArg %d>' % self.k
 
 class PushCode(Instr):
+    opcode = OP_PUSH_CODE
+
     def __init__(self, n):
         self.n = n
 
-    def dispatch(self, state):
-        c = state.mk_closure('<anomymous>', state.codefrag_ref(self.n),
-                             state.frameptr)
-        state.stack_push(c)
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.n)
 
     def to_s(self):
         return '#<PushCode %d>' % self.n
 
+# PushCode n, over a new frame of <size> slots, or none if <size> is 0,
+# holding only the <slots> of the current frame that fragment n reads.
+# Made by spj.timc.FrameUsage.
+class PushTrimmedCode(PushCode):
+    opcode = OP_PUSH_TRIMMED_CODE
+
+    def __init__(self, n, size, slots):
+        self.n = n
+        self.size = size
+        self.slots = slots
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.n)
+        encode_slots(ops, self.size, self.slots)
+
+    def to_s(self):
+        return '#<PushTrimmedCode %d %s>' % (self.n, slots_to_s(self.size,
+                                                                self.slots))
+
+def encode_slots(ops, size, slots):
+    ops.append(size)
+    ops.append(len(slots))
+    for slot in slots:
+        ops.append(slot)
+
+def slots_to_s(size, slots):
+    if size == 0:
+        return '-'
+    return '%d[%s]' % (size, ','.join([str(slot) for slot in slots]))
+
 class PushLabel(Instr):
+    opcode = OP_PUSH_LABEL
+
     def __init__(self, name):
         self.name = name
 
-    def dispatch(self, state):
-        code = state.globalenv.get(self.name, None)
-        if code is None:
-            raise InterpError('%s: undefined name' % self.to_s())
-        cl = state.mk_closure(self.name, code, state.frameptr)
-        state.stack_push(cl)
+    def encode(self, ops, asm):
+        assert asm is not None
+        ops.append(self.opcode)
+        ops.append(asm.global_index(self.name))
 
     def to_s(self):
         return '#<PushLabel %s>' % self.name
 
+# Push the closure of a zero-arity supercombinator. It is created on first
+# use and updated with its value, so the CAF is computed once per run.
+class PushCAF(PushLabel):
+    opcode = OP_PUSH_CAF
+
+    def to_s(self):
+        return '#<PushCAF %s>' % self.name
+
+# Push the preallocated closure of an integer literal.
 class PushInt(Instr):
+    opcode = OP_PUSH_INT
+
     def __init__(self, ival):
         self.ival = ival
 
-    def dispatch(self, state):
-        cl = state.mk_intclosure(self.ival)
-        state.stack_push(cl)
+    def encode(self, ops, asm):
+        assert asm is not None
+        ops.append(self.opcode)
+        ops.append(asm.int_const_index(self.ival))
 
     def to_s(self):
         return '#<PushInt %s>' % self.ival
 
 class PushVInt(Instr):
+    opcode = OP_PUSH_VINT
+
     def __init__(self, ival):
         self.ival = ival
 
-    def dispatch(self, state):
-        state.vstack_push(W_Int(self.ival))
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.ival)
 
     def to_s(self):
         return '#<PushVInt %s>' % self.ival
 
+# Push the integer held by the closure being evaluated.
+class PushVSelf(Instr):
+    opcode = OP_PUSH_VSELF
+
+    def to_s(self):
+        return '#<PushVSelf>'
+
+# Pop an already evaluated integer off the vstack and push it as a
+# closure, for arguments found strict by spj.strictness.
+class MkIntClosure(Instr):
+    opcode = OP_MK_INT_CLOSURE
+
+    def to_s(self):
+        return '#<MkIntClosure>'
+
 class Enter(Instr):
-    def dispatch(self, state):
-        state.enter_closure(state.stack_pop())
+    opcode = OP_ENTER
 
     def to_s(self):
         return '#<Enter>'
 
+# Jump into a supercombinator, past its Take, when at least as many
+# arguments as its arity have been pushed.
+class Call(Instr):
+    opcode = OP_CALL
+
+    def __init__(self, name):
+        self.name = name
+
+    def encode(self, ops, asm):
+        assert asm is not None
+        ops.append(self.opcode)
+        ops.append(asm.global_index(self.name))
+
+    def to_s(self):
+        return '#<Call %s>' % self.name
+
+all_primops = [] # index -> BasePrimOp, only appended to at import time
+
+@elidable
+def get_primop(n):
+    return all_primops[n]
+
+# PushArg k; Enter
+class EnterArg(Instr):
+    opcode = OP_ENTER_ARG
+
+    def __init__(self, k):
+        self.k = k
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.k)
+
+    def to_s(self):
+        return '#<EnterArg %d>' % self.k
+
+# PushCode n; Move i
+class MoveCode(Instr):
+    opcode = OP_MOVE_CODE
+
+    def __init__(self, n, i):
+        self.n = n
+        self.i = i
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.n)
+        ops.append(self.i)
+
+    def to_s(self):
+        return '#<MoveCode %d %d>' % (self.n, self.i)
+
+# MoveCode over a trimmed frame, as made for PushTrimmedCode.
+class MoveTrimmedCode(MoveCode):
+    opcode = OP_MOVE_TRIMMED_CODE
+
+    def __init__(self, n, i, size, slots):
+        self.n = n
+        self.i = i
+        self.size = size
+        self.slots = slots
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.n)
+        ops.append(self.i)
+        encode_slots(ops, self.size, self.slots)
+
+    def to_s(self):
+        return '#<MoveTrimmedCode %d %d %s>' % (self.n, self.i, slots_to_s(
+            self.size, self.slots))
+
+# PushVInt ival; <binary prim-op>
+class PushVIntOp(Instr):
+    opcode = OP_PUSH_VINT_OP
+
+    def __init__(self, ival, binop):
+        self.ival = ival
+        self.binop = binop # opcode of the IntBinOp
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.ival)
+        ops.append(self.binop)
+
+    def to_s(self):
+        return '#<PushVIntOp %d %s>' % (self.ival, binop_names[self.binop])
+
 class BasePrimOp(Instr):
-    def dispatch(self, state):
-        arity = self.get_arity()
-        if len(state.vstack) < arity:
-            raise InterpError('%s: not enough argument' % self.to_s())
-
-        args_w = [None] * arity
-        for i in xrange(arity):
-            args_w[i] = state.vstack_pop()
-        res_w = self.call(state, args_w)
-        state.vstack_push(res_w)
-
-    def call(self, state, args_w):
+    opcode = OP_PRIMOP
+
+    def __init__(self):
+        "NOT_RPYTHON"
+        self.index = len(all_primops)
+        all_primops.append(self)
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.index)
+
+    # Pop the arguments off the vstack and push the result.
+    def apply(self, state):
+        raise NotImplementedError
+
+    # The result for raw integer arguments, first argument first, for
+    # machines without a vstack such as spj.gmrun.
+    def compute(self, args):
         raise NotImplementedError
 
     def get_arity(self):
@@ -254,33 +1069,271 @@ class BasePrimOp(Instr):
     def to_s(self):
         return '#<BasePrimOp>'
 
+# Compiled to its own opcode and run inline by State.run.
+class IntBinOp(BasePrimOp):
+    def __init__(self, opcode):
+        "NOT_RPYTHON"
+        BasePrimOp.__init__(self)
+        self.opcode = opcode
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+
+    def compute(self, args):
+        return compute_binop(self.opcode, args[0], args[1])
+
+    def get_arity(self):
+        return 2
+
+    def to_s(self):
+        return '#<PrimOp:%s>' % binop_names[self.opcode]
+
 class Cond(Instr):
+    opcode = OP_COND
+
     def __init__(self, frag_true, frag_false):
         self.frag_true = frag_true
         self.frag_false = frag_false
 
-    def dispatch(self, state):
-        w_v = state.vstack_pop()
-        if isinstance(w_v, W_Int):
-            if w_v.ival != 0:
-                state.enter_code(state.codefrag_ref(self.frag_true))
-            else:
-                state.enter_code(state.codefrag_ref(self.frag_false))
-        else:
-            raise InterpError('%s: wrong argument type' % self.to_s())
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.frag_true)
+        ops.append(self.frag_false)
 
     def to_s(self):
         return '#<Cond %d/%d>' % (self.frag_true, self.frag_false)
 
 class Return(Instr):
-    def dispatch(self, state):
-        cl = state.stack_pop()
-        state.enter_closure(cl)
+    opcode = OP_RETURN
 
     def to_s(self):
         return '#<Return>'
 
-# Wrapped vstack objects
+# Return a constructor whose fields are the current frame.
+class ReturnConstr(Instr):
+    opcode = OP_RETURN_CONSTR
+
+    def __init__(self, tag):
+        self.tag = tag
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.tag)
+
+    def to_s(self):
+        return '#<ReturnConstr %d>' % self.tag
+
+# Pop a tag and jump to its alternative: frags[tag] is a code fragment
+# index, or -1 when there is no alternative for that tag.
+class Switch(Instr):
+    opcode = OP_SWITCH
+
+    def __init__(self, frags):
+        self.frags = frags
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(len(self.frags))
+        for frag in self.frags:
+            ops.append(frag)
+
+    def to_s(self):
+        return '#<Switch %s>' % ' '.join([str(i) for i in self.frags])
+
+# Copy field k of the last returned constructor into frame slot i.
+class MoveData(Instr):
+    opcode = OP_MOVE_DATA
+
+    def __init__(self, k, i):
+        self.k = k
+        self.i = i
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.k)
+        ops.append(self.i)
+
+    def to_s(self):
+        return '#<MoveData %d %d>' % (self.k, self.i)
+
+# Spark the closure in frame slot k, for the par prim-op.
+class Spark(Instr):
+    opcode = OP_SPARK
+
+    def __init__(self, k):
+        self.k = k
+
+    def encode(self, ops, asm):
+        ops.append(self.opcode)
+        ops.append(self.k)
+
+    def to_s(self):
+        return '#<Spark %d>' % self.k
+
+# The code of a sparked closure while a worker evaluates it.
+class Await(Instr):
+    opcode = OP_AWAIT
+
+    def to_s(self):
+        return '#<Await>'
+
+# The inverse of assemble, for code read back by spj.serialize, so that
+# a corrupt file raises InterpError. Operands are checked against the
+# program's globals and literals, the code fragments in <frag_frames> and
+# the frame the code runs in: <framesize> slots until a Take makes
+# another. The size of the frame each fragment referenced runs in goes
+# into <frag_frames>, the smallest if there are several.
+def disassemble(name, ops, global_names, int_consts, framesize,
+                frag_frames):
+    instrs = []
+    offsets = []
+    pc = 0
+    while pc < len(ops):
+        offsets.append(pc)
+        instr, size = decode_instr(ops, pc, global_names, int_consts,
+                                   framesize, frag_frames)
+        if isinstance(instr, Take):
+            framesize = instr.framesize
+        instrs.append(instr)
+        pc += size
+    return Code(name, instrs, ops, offsets)
+
+# Operand i of the instruction at ops[pc].
+def operand(ops, pc, i):
+    if pc + i >= len(ops):
+        raise InterpError('compiled program: truncated instruction')
+    return ops[pc + i]
+
+# Operand i of the instruction at ops[pc], an index below <n>, or -1 too
+# if <allow_none>.
+def index_operand(ops, pc, i, n, allow_none=False):
+    k = operand(ops, pc, i)
+    if not (0 <= k < n or (allow_none and k == -1)):
+        raise InterpError('compiled program: operand %d out of range' % k)
+    return k
+
+# Operand i of the instruction at ops[pc], a code fragment to run in a
+# frame of <framesize> slots.
+def frag_operand(ops, pc, i, frag_frames, framesize, allow_none=False):
+    k = index_operand(ops, pc, i, len(frag_frames), allow_none)
+    if k >= 0 and framesize < frag_frames[k]:
+        frag_frames[k] = framesize
+    return k
+
+# Operand i of the instruction at ops[pc], the size of a frame.
+def size_operand(ops, pc, i):
+    size = operand(ops, pc, i)
+    if size < 0:
+        raise InterpError('compiled program: bad frame size %d' % size)
+    return size
+
+# Operands i and on of the instruction at ops[pc]: a count, then that many
+# slots of a frame of <framesize>.
+def slots_operand(ops, pc, i, framesize):
+    count = operand(ops, pc, i)
+    if count < 0:
+        raise InterpError('compiled program: bad count %d' % count)
+    for j in xrange(count):
+        index_operand(ops, pc, i + 1 + j, framesize)
+    return ops[pc + i + 1:pc + i + 1 + count]
+
+# The instruction at ops[pc] and the number of ops it takes up.
+def decode_instr(ops, pc, global_names, int_consts, framesize,
+                 frag_frames):
+    op = ops[pc]
+    nglobals = len(global_names)
+    if op == OP_TAKE:
+        newsize = size_operand(ops, pc, 1)
+        return Take(newsize, index_operand(ops, pc, 2, newsize + 1)), 3
+    elif op == OP_MOVE:
+        return Move(index_operand(ops, pc, 1, framesize)), 2
+    elif op == OP_PUSH_ARG:
+        return PushArg(index_operand(ops, pc, 1, framesize)), 2
+    elif op == OP_PUSH_CODE:
+        return PushCode(frag_operand(ops, pc, 1, frag_frames,
+                                     framesize)), 2
+    elif op == OP_PUSH_LABEL:
+        return PushLabel(global_names[index_operand(ops, pc, 1,
+                                                    nglobals)]), 2
+    elif op == OP_PUSH_CAF:
+        return PushCAF(global_names[index_operand(ops, pc, 1, nglobals)]), 2
+    elif op == OP_PUSH_INT:
+        return PushInt(int_consts[index_operand(ops, pc, 1,
+                                                len(int_consts))]), 2
+    elif op == OP_PUSH_VINT:
+        return PushVInt(operand(ops, pc, 1)), 2
+    elif op == OP_PUSH_MARKER:
+        return PushMarker(), 1
+    elif op == OP_ENTER:
+        return Enter(), 1
+    elif op == OP_RETURN:
+        return Return(), 1
+    elif op == OP_COND:
+        return Cond(frag_operand(ops, pc, 1, frag_frames, framesize),
+                    frag_operand(ops, pc, 2, frag_frames, framesize)), 3
+    elif op == OP_PRIMOP:
+        return get_primop(index_operand(ops, pc, 1, len(all_primops))), 2
+    elif OP_ADD <= op <= OP_NE:
+        for prim_op in all_primops:
+            if isinstance(prim_op, IntBinOp) and prim_op.opcode == op:
+                return prim_op, 1
+    elif op == OP_PUSH_VSELF:
+        return PushVSelf(), 1
+    elif op == OP_CALL:
+        return Call(global_names[index_operand(ops, pc, 1, nglobals)]), 2
+    elif op == OP_ENTER_ARG:
+        return EnterArg(index_operand(ops, pc, 1, framesize)), 2
+    elif op == OP_MOVE_CODE:
+        return MoveCode(frag_operand(ops, pc, 1, frag_frames, framesize),
+                        index_operand(ops, pc, 2, framesize)), 3
+    elif op == OP_PUSH_VINT_OP:
+        binop = operand(ops, pc, 2)
+        if not OP_ADD <= binop <= OP_NE:
+            raise InterpError('compiled program: bad binary op %d' % binop)
+        return PushVIntOp(operand(ops, pc, 1), binop), 3
+    elif op == OP_RETURN_CONSTR:
+        return ReturnConstr(operand(ops, pc, 1)), 2
+    elif op == OP_SWITCH:
+        nalts = operand(ops, pc, 1)
+        if nalts < 0:
+            raise InterpError('compiled program: bad count %d' % nalts)
+        for j in xrange(nalts):
+            frag_operand(ops, pc, 2 + j, frag_frames, framesize, True)
+        return Switch(ops[pc + 2:pc + 2 + nalts]), 2 + nalts
+    elif op == OP_MOVE_DATA:
+        return MoveData(operand(ops, pc, 1),
+                        index_operand(ops, pc, 2, framesize)), 3
+    elif op == OP_MK_INT_CLOSURE:
+        return MkIntClosure(), 1
+    elif op == OP_PUSH_TRIMMED_CODE:
+        trimmed = size_operand(ops, pc, 2)
+        slots = slots_operand(ops, pc, 3, min(framesize, trimmed))
+        return (PushTrimmedCode(frag_operand(ops, pc, 1, frag_frames,
+                                             trimmed), trimmed, slots),
+                4 + len(slots))
+    elif op == OP_MOVE_TRIMMED_CODE:
+        trimmed = size_operand(ops, pc, 3)
+        slots = slots_operand(ops, pc, 4, min(framesize, trimmed))
+        return (MoveTrimmedCode(frag_operand(ops, pc, 1, frag_frames,
+                                             trimmed),
+                                index_operand(ops, pc, 2, framesize),
+                                trimmed, slots), 5 + len(slots))
+    elif op == OP_SPARK:
+        return Spark(index_operand(ops, pc, 1, framesize)), 2
+    elif op == OP_AWAIT:
+        return Await(), 1
+    raise InterpError('unknown opcode %d' % op)
+
+# Shared by every integer closure and every thunk updated with an integer.
+int_code = assemble('<int>', [PushVSelf(), Return()])
+
+await_code = assemble('<await>', [Await()])
+
+SMALL_INT_MIN = -16
+SMALL_INT_MAX = 256
+small_ints = [IntClosure(i) for i in range(SMALL_INT_MIN, SMALL_INT_MAX + 1)]
+
+# Wrapped results of State.eval; the vstack itself holds raw integers.
 class W_Value(W_Root):
     def to_s(self):
         return '#<W_Value>'
@@ -292,3 +1345,11 @@ class W_Int(W_Value):
     def to_s(self):
         return '#<W_Int %d>' % self.ival
 
+class W_Constr(W_Value):
+    def __init__(self, tag, fields):
+        self.tag = tag
+        self.fields = fields # [Closure]
+
+    def to_s(self):
+        return '#<W_Constr %d [%s]>' % (self.tag, ', '.join(
+            [field.to_s() for field in self.fields]))
@@ -1,4 +1,7 @@
 import functools
+import os
+
+from spj.errors import InterpError
 
 def contextmanager(func):
     class Man(object):
@@ -28,3 +31,40 @@ def write_str(s):
     f = fdopen_as_stream(1, 'w')
     f.write(s)
     f.flush()
+
+# Output to a file descriptor, written in chunks of at least <size> bytes.
+# Whoever owns one flushes it before exiting or forking.
+class BufferedWriter(object):
+    def __init__(self, fd, size=65536):
+        self.fd = fd
+        self.size = size
+        self.buf = []
+        self.nbuffered = 0
+        self.refusal = None # why writes fail, if they do
+
+    # Make every write from now on raise InterpError(<what>).
+    def refuse_writes(self, what):
+        self.buf = []
+        self.nbuffered = 0
+        self.refusal = what
+
+    def write(self, s):
+        if self.refusal is not None:
+            raise InterpError(self.refusal)
+        self.buf.append(s)
+        self.nbuffered += len(s)
+        if self.nbuffered >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.buf:
+            return
+        data = ''.join(self.buf)
+        self.buf = []
+        self.nbuffered = 0
+        while data:
+            n = os.write(self.fd, data)
+            data = data[n:]
+
+# The output of the print prim-ops.
+stdout = BufferedWriter(1)
@@ -7,6 +7,10 @@ def target(driver, *argl):
     driver.exe_name = 'runspj-%(backend)s'
     return main, None
 
+def jitpolicy(driver):
+    from pypy.jit.codewriter.policy import JitPolicy
+    return JitPolicy()
+
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
 
@@ -0,0 +1,18 @@
+compose f g = \x -> f (g x);
+
+twice f = compose f f;
+
+addSquare n = \x -> x + (n * n);
+
+foldr f z xs = case xs of
+                 <1> -> z;
+                 <2> y ys -> f y (foldr f z ys);;
+
+range n = if (n < 1) Pack{1, 0} (Pack{2, 2} n (range (n - 1)));
+
+sum xs = foldr (\x acc -> x + acc) 0 xs;
+
+sumMapped f xs = foldr (\x acc -> f x + acc) 0 xs;
+
+main = let k = 3;
+       in sumMapped (\x -> x * k) (range 4) + (twice (addSquare k) (sum (range 10)));
@@ -0,0 +1,3 @@
+f x = printInt x 7;
+
+main = let a = f 5; in par a (a + (f 6));
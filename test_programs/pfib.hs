@@ -0,0 +1,9 @@
+nfib n = if (n < 2) 1 ((nfib (n - 1)) + (nfib (n - 2)) + 1);
+
+pfib n = if (n < 15)
+            (nfib n)
+            (let a = pfib (n - 1);
+                 b = pfib (n - 2);
+             in par a ((a + b) + 1));
+
+main = pfib 25;